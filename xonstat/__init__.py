@@ -2,8 +2,16 @@ import sqlahelper
 from pyramid.config import Configurator
 from pyramid.renderers import JSONP
 from sqlalchemy import engine_from_config
+from xonstat.d0_blind_id import start_verifier_pool
 from xonstat.models import initialize_db
+from xonstat.pagination import configure_pagination
+from xonstat.ranks import configure_ranks
 from xonstat.views import *
+from xonstat.views.main import configure_leaderboard_cache
+from xonstat.views.submission import configure_verify_cache
+from xonstat.views.submission import configure_identity_caches
+from xonstat.views.submission import configure_submission_spool
+from xonstat.views.submission import configure_weapon_codes
 
 def main(global_config, **settings):
     """ This function returns a Pyramid WSGI application.
@@ -15,6 +23,26 @@ def main(global_config, **settings):
     # initialize database structures
     initialize_db(engine)
 
+    # resident signature verifiers for stats submissions
+    try:
+        verifier_pool_size = int(settings['xonstat.verifier_pool_size'])
+    except:
+        verifier_pool_size = 0
+
+    try:
+        verifier_timeout = float(settings['xonstat.verifier_timeout'])
+    except:
+        verifier_timeout = 10
+
+    start_verifier_pool(verifier_pool_size, verifier_timeout)
+    configure_verify_cache(settings)
+    configure_identity_caches(settings)
+    configure_submission_spool(settings)
+    configure_weapon_codes()
+    configure_ranks(settings)
+    configure_leaderboard_cache(settings)
+    configure_pagination(settings)
+
     config = Configurator(settings=settings)
 
     config.add_static_view('static', 'xonstat:static')
@@ -0,0 +1,79 @@
+#-*- coding: utf-8 -*-
+
+import sys
+import time
+from datetime import datetime, timedelta
+from pyramid.paster import bootstrap
+import sqlalchemy.sql.functions as func
+from xonstat.models import *
+from xonstat.rollups import backfill_rollups
+
+# Rebuilds the daily leaderboard rollups (player_daily_stats and
+# server_map_daily_stats) from player_game_stats and games. The submission
+# handler keeps them up to date as games come in, so this is only needed
+# once to start with, or to repair days check_rollups.py reports.
+#
+# Each day is rebuilt and committed on its own. Days being written to by
+# the submission handler at the same time should be rebuilt again later.
+
+# first and last day to rebuild, by default from the first game until today
+start = None
+end = None
+
+def parse_date(value):
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+ini_file = '../../development.ini'
+args = sys.argv[1:]
+while len(args) > 0:
+    arg = args.pop(0)
+    if arg == "-start" and len(args) > 0:
+        start = parse_date(args.pop(0))
+    elif arg == "-end" and len(args) > 0:
+        end = parse_date(args.pop(0))
+    elif arg == "-days" and len(args) > 0:
+        start = datetime.utcnow().date() - timedelta(days=int(args.pop(0)) - 1)
+    elif arg.startswith("-"):
+        print """Usage:  backfill_rollups.py [options] [ini file]
+    Rebuilds the daily leaderboard rollups from the raw game tables.
+    Options:
+        -start YYYY-MM-DD   First day to rebuild (default: the first game)
+        -end YYYY-MM-DD     Last day to rebuild (default: today, UTC)
+        -days N             Rebuild the last N days
+        -help               Show this help text
+    The ini file defaults to ../../development.ini
+"""
+        sys.exit(-1)
+    else:
+        ini_file = arg
+
+env = bootstrap(ini_file)
+
+session = DBSession()
+
+if start is None:
+    first_game = session.query(func.min(Game.create_dt)).scalar()
+    if first_game is None:
+        print "No games, nothing to do."
+        sys.exit(0)
+    start = first_game.date()
+
+if end is None:
+    end = datetime.utcnow().date()
+
+began = time.time()
+day = start
+total_players, total_server_maps = 0, 0
+while day <= end:
+    (players, server_maps) = backfill_rollups(session, day,
+            day + timedelta(days=1))
+    session.commit()
+
+    total_players += players
+    total_server_maps += server_maps
+    print "%s %8d player rows %6d server/map rows" % (day, players,
+            server_maps)
+    day += timedelta(days=1)
+
+print "Rebuilt %d player and %d server/map rows in %.1f seconds" % (
+        total_players, total_server_maps, time.time() - began)
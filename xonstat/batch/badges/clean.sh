@@ -1,3 +1,4 @@
 #!/bin/sh
 find output -name "*.png" -exec rm {} \;
 
+find output -name "manifest.json" -exec rm {} \;
@@ -1,16 +1,19 @@
 #-*- coding: utf-8 -*-
 
+import json
+import multiprocessing
+import os
 import sys
 from datetime import datetime
 import sqlalchemy as sa
 import sqlalchemy.sql.functions as func
-from sqlalchemy import distinct
+from sqlalchemy import distinct, engine_from_config
 from pyramid.paster import bootstrap
 from xonstat.models import *
 from xonstat.util import datetime_seconds
 
 from skin import Skin
-from playerdata import PlayerData
+from playerdata import load_player_data
 
 
 # maximal number of query results (for testing, set to None to get all)
@@ -19,6 +22,22 @@ NUM_PLAYERS = None
 # we look for players who have activity within the past DELTA hours
 DELTA = 6
 
+# redraw every badge instead of skipping the ones whose fingerprint didn't
+# change (see Skin.fingerprint)
+FORCE = False
+
+# number of processes rendering badges, each with its own database
+# connection (1 renders everything in this process)
+WORKERS = 1
+
+# players handed to a worker at a time
+CHUNK_SIZE = 50
+
+# PNG compression level and scanline filter for all skins (None keeps the
+# skin's own, see xonstat/png.py and bench_png.py)
+PNG_LEVEL = None
+PNG_FILTER = None
+
 
 # classic skin WITHOUT NAME - writes PNGs into "output//###.png"
 skin_classic = Skin( "",
@@ -83,18 +102,33 @@ skin_minimal = Skin( "minimal",
 # parse cmdline parameters (for testing)
 
 skins = []
-for arg in sys.argv[1:]:
+args = sys.argv[1:]
+while len(args) > 0:
+    arg = args.pop(0)
     if arg.startswith("-"):
         arg = arg[1:]
         if arg == "force":
             DELTA = 2**24   # large enough to enforce update, and doesn't result in errors
+            FORCE = True
         elif arg == "test":
             NUM_PLAYERS = 100
+        elif arg == "workers" and len(args) > 0:
+            WORKERS = int(args.pop(0))
+        elif arg == "png-level" and len(args) > 0:
+            PNG_LEVEL = int(args.pop(0))
+        elif arg == "png-filter" and len(args) > 0:
+            PNG_FILTER = args.pop(0)
         else:
             print """Usage:  gen_badges.py [options] [skin list]
     Options:
-        -force      Force updating all badges (delta = 2^24)
+        -force      Redraw all badges (delta = 2^24), updating the
+                    manifests of their fingerprints
         -test       Limit number of players to 100 (for testing)
+        -workers N  Render with N processes (default 1, 0 for one per CPU)
+        -png-level N
+                    zlib compression level of the PNGs, 0-9 (default 9)
+        -png-filter none|sub|up
+                    PNG scanline filter (default none)
         -help       Show this help text
     Skin list:
         Space-separated list of skins to use when creating badges.
@@ -111,70 +145,205 @@ for arg in sys.argv[1:]:
         elif arg == "archer":
             skins.append(skin_archer)
 
+if WORKERS < 1:
+    WORKERS = multiprocessing.cpu_count()
+
 if len(skins) == 0:
     skins = [ skin_classic, skin_minimal ]
 
+for sk in skins:
+    if PNG_LEVEL is not None:
+        sk.params['png_level'] = PNG_LEVEL
+    if PNG_FILTER is not None:
+        sk.params['png_filter'] = PNG_FILTER
+
+
+# Each skin's output directory has a manifest, mapping the player ids to the
+# fingerprints of their badges there. A badge is only drawn when its
+# fingerprint isn't the one in the manifest, or the file is missing. The
+# manifests are read before the workers start and written when all badges
+# are done, with the fingerprints the workers return.
+
+def manifest_file(sk):
+    return "output/%s/manifest.json" % str(sk)
+
+
+def load_manifest(sk):
+    """The manifest of a skin, empty if there is none or it can't be read."""
+    try:
+        f = open(manifest_file(sk))
+        try:
+            return json.load(f)
+        finally:
+            f.close()
+    except (IOError, ValueError) as e:
+        print "Not using the manifest %s: %s" % (manifest_file(sk), e)
+        return {}
+
+
+def save_manifest(sk, manifest):
+    """Replaces the manifest of a skin, through a temporary file."""
+    filename = manifest_file(sk)
+    f = open(filename + ".tmp", "w")
+    try:
+        json.dump(manifest, f)
+    finally:
+        f.close()
+    os.rename(filename + ".tmp", filename)
+
+
+def render_badges(player_ids):
+    """
+    Gets the data of a chunk of players and renders the badges whose
+    fingerprint changed with every skin. Returns the number of players done,
+    the seconds spent getting data and rendering, a list of (player_id,
+    error) for the players that failed, a list of (skin name, player_id,
+    fingerprint) for the badges drawn and the number of badges skipped.
+    """
+    data_time, render_time = 0,0
+    failures = []
+    drawn = []
+    skipped = 0
+    try:
+        sstart = datetime.now()
+        player_data = load_player_data(player_ids)
+        sstop = datetime.now()
+        td = sstop-sstart
+        data_time += datetime_seconds(td)
+    except Exception as e:
+        DBSession.remove()
+        error = "%s: %s" % (e.__class__.__name__, e)
+        return (len(player_ids), data_time, render_time,
+                [(player_id, error) for player_id in player_ids], drawn,
+                skipped)
+
+    for playerdata in player_data:
+        player_id = playerdata.player.player_id
+        try:
+            sstart = datetime.now()
+            for sk in skins:
+                filename = "output/%s/%d.png" % (str(sk), player_id)
+                fingerprint = sk.fingerprint(playerdata)
+                if not FORCE and \
+                        manifests[str(sk)].get(str(player_id)) == fingerprint \
+                        and os.path.exists(filename):
+                    skipped += 1
+                    continue
+                sk.render_image(playerdata, filename)
+                drawn.append((str(sk), player_id, fingerprint))
+            sstop = datetime.now()
+            td = sstop-sstart
+            render_time += datetime_seconds(td)
+        except Exception as e:
+            failures.append((player_id, "%s: %s" % (e.__class__.__name__, e)))
+
+    DBSession.remove()
+    return (len(player_ids), data_time, render_time, failures, drawn, skipped)
+
+
+def player_chunks(conn, query):
+    """
+    Yields the player ids of query in lists of CHUNK_SIZE, fetched that many
+    at a time from a server-side cursor on conn.
+    """
+    result = conn.execution_options(stream_results=True).execute(query.statement)
+    while True:
+        rows = result.fetchmany(CHUNK_SIZE)
+        if not rows:
+            break
+        yield [row[0] for row in rows]
+
+
+def init_worker(settings):
+    """Gives a worker process its own engine, instead of the parent's."""
+    DBSession.remove()
+    DBSession.configure(bind=engine_from_config(settings, 'sqlalchemy.'))
+
+
 # environment setup
 env = bootstrap('../../../development.ini')
-req = env['request']
-req.matchdict = {'id':3}
 
-print "Requesting player data from db ..."
 cutoff_dt = datetime.utcnow() - timedelta(hours=DELTA)
-start = datetime.now()
-players = []
+players = DBSession.query(distinct(Player.player_id)).\
+        filter(Player.player_id == PlayerElo.player_id).\
+        filter(Player.player_id == PlayerGameStat.player_id).\
+        filter(PlayerGameStat.create_dt > cutoff_dt).\
+        filter(Player.nick != None).\
+        filter(Player.player_id > 2).\
+        filter(Player.active_ind == True)
 if NUM_PLAYERS:
-    players = DBSession.query(distinct(Player.player_id)).\
-            filter(Player.player_id == PlayerElo.player_id).\
-            filter(Player.player_id == PlayerGameStat.player_id).\
-            filter(PlayerGameStat.create_dt > cutoff_dt).\
-            filter(Player.nick != None).\
-            filter(Player.player_id > 2).\
-            filter(Player.active_ind == True).\
-            limit(NUM_PLAYERS).all()
+    players = players.limit(NUM_PLAYERS)
+
+# a forced run overwrites the fingerprints of the badges it draws and keeps
+# the others, so a -test or interrupted run doesn't lose them
+manifests = {}
+for sk in skins:
+    manifests[str(sk)] = load_manifest(sk)
+
+print "Creating badges with %d worker(s) ..." % WORKERS
+start = datetime.now()
+engine = DBSession.bind
+if WORKERS > 1:
+    # the workers must not share the connections of this process
+    DBSession.remove()
+    engine.dispose()
+    pool = multiprocessing.Pool(WORKERS, init_worker,
+            (env['registry'].settings,))
 else:
-    players = DBSession.query(distinct(Player.player_id)).\
-            filter(Player.player_id == PlayerElo.player_id).\
-            filter(Player.player_id == PlayerGameStat.player_id).\
-            filter(PlayerGameStat.create_dt > cutoff_dt).\
-            filter(Player.nick != None).\
-            filter(Player.player_id > 2).\
-            filter(Player.active_ind == True).\
-            all()
-
-playerdata = PlayerData()
-
-if len(players) > 0:
-    stop = datetime.now()
-    td = stop-start
-    print "Query took %.2f seconds" % (datetime_seconds(td))
+    pool = None
 
-    print "Creating badges for %d players ..." % len(players)
-    start = datetime.now()
-    data_time, render_time = 0,0
-    for player_id in players:
-        req.matchdict['id'] = player_id
+# the player ids are read while the badges are made, on a connection of
+# their own
+conn = engine.connect()
+chunks = player_chunks(conn, players)
+if pool is not None:
+    results = pool.imap_unordered(render_badges, chunks)
+else:
+    results = (render_badges(chunk) for chunk in chunks)
 
-        sstart = datetime.now()
-        playerdata.get_data(player_id)
-        sstop = datetime.now()
-        td = sstop-sstart
-        data_time += datetime_seconds(td)
+done, data_time, render_time = 0,0,0
+failures = []
+drawn, skipped = 0,0
+for (count, chunk_data_time, chunk_render_time, chunk_failures, chunk_drawn,
+        chunk_skipped) in results:
+    done += count
+    data_time += chunk_data_time
+    render_time += chunk_render_time
+    failures.extend(chunk_failures)
+    for (skin_name, player_id, fingerprint) in chunk_drawn:
+        manifests[skin_name][str(player_id)] = fingerprint
+    drawn += len(chunk_drawn)
+    skipped += chunk_skipped
+    print "%d players done, %d failed" % (done, len(failures))
 
-        sstart = datetime.now()
-        for sk in skins:
-            sk.render_image(playerdata, "output/%s/%d.png" % (str(sk), player_id[0]))
-        sstop = datetime.now()
-        td = sstop-sstart
-        render_time += datetime_seconds(td)
+conn.close()
+if pool is not None:
+    pool.close()
+    pool.join()
+
+for sk in skins:
+    save_manifest(sk, manifests[str(sk)])
 
+if done > 0:
     stop = datetime.now()
     td = stop-start
     total_seconds = datetime_seconds(td)
-    print "Creating the badges took %.1f seconds (%.3f s per player)" % (total_seconds, total_seconds/float(len(players)))
-    print "Total time for rendering images: %.3f s" % render_time
+    print "Creating the badges took %.1f seconds (%.3f s per player)" % (total_seconds, total_seconds/float(done))
+    print "Drew %d badges, %d were unchanged" % (drawn, skipped)
+    if drawn > 0:
+        # includes drawing each skin's background once per process, see
+        # Skin.background()
+        print "Total time for rendering images: %.3f s (%.2f ms per badge)" % (render_time, 1000*render_time/drawn)
+    else:
+        print "Total time for rendering images: %.3f s" % render_time
     print "Total time for getting data: %.3f s" % data_time
+    if WORKERS > 1:
+        print "(rendering and data times are summed over the workers)"
+
+    if len(failures) > 0:
+        print "Failed to create the badges of %d players:" % len(failures)
+        for (player_id, error) in failures:
+            print "    %d: %s" % (player_id, error)
 
 else:
     print "No active players found!"
-
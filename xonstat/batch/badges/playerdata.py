@@ -1,6 +1,7 @@
 import sqlalchemy as sa
 import sqlalchemy.sql.functions as func
 from xonstat.models import *
+from xonstat.player_profile import load_profiles
 
 
 class PlayerData:
@@ -19,93 +20,83 @@ class PlayerData:
     def get_data(self, player_id):
         """Return player data as dict.
 
-        This function is similar to the function in player.py but more optimized
-        for this purpose.
+        The totals come from the same loader as the player page
+        (xonstat.player_profile). To get the data of many players, use
+        load_player_data instead.
         """
-        # total games
-        # wins/losses
-        # kills/deaths
-        # duel/dm/tdm/ctf elo + rank
-
-        player = DBSession.query(Player).filter(Player.player_id == player_id).one()
-
-        games_played = DBSession.query(
-                Game.game_type_cd, func.count(), func.sum(PlayerGameStat.alivetime)).\
-                filter(Game.game_id == PlayerGameStat.game_id).\
-                filter(PlayerGameStat.player_id == player_id).\
-                group_by(Game.game_type_cd).\
-                order_by(func.count().desc()).\
-                all()
-
-        total_stats = {}
-        total_stats['games'] = 0
-        total_stats['games_breakdown'] = {}  # this is a dictionary inside a dictionary .. dictception?
-        total_stats['games_alivetime'] = {}
-        total_stats['gametypes'] = []
-        for (game_type_cd, games, alivetime) in games_played:
-            total_stats['games'] += games
-            total_stats['gametypes'].append(game_type_cd)
-            total_stats['games_breakdown'][game_type_cd] = games
-            total_stats['games_alivetime'][game_type_cd] = alivetime
-
-        (total_stats['kills'], total_stats['deaths'], total_stats['alivetime'],) = DBSession.query(
-                func.sum(PlayerGameStat.kills),
-                func.sum(PlayerGameStat.deaths),
-                func.sum(PlayerGameStat.alivetime)).\
-                filter(PlayerGameStat.player_id == player_id).\
-                one()
-
-        (total_stats['wins'], total_stats['losses']) = DBSession.\
-                query("wins", "losses").\
-                from_statement(
-                    "SELECT SUM(win) wins, SUM(loss) losses "
-                    "FROM   (SELECT  g.game_id, "
-                    "                CASE "
-                    "                  WHEN g.winner = pgs.team THEN 1 "
-                    "                  WHEN pgs.rank = 1 THEN 1 "
-                    "                  ELSE 0 "
-                    "                END win, "
-                    "                CASE "
-                    "                  WHEN g.winner = pgs.team THEN 0 "
-                    "                  WHEN pgs.rank = 1 THEN 0 "
-                    "                  ELSE 1 "
-                    "                END loss "
-                    "        FROM    games g, "
-                    "                player_game_stats pgs "
-                    "        WHERE   g.game_id = pgs.game_id "
-                    "                AND pgs.player_id = :player_id) win_loss").\
-                params(player_id=player_id).one()
-
-        ranks = DBSession.query("game_type_cd", "rank", "max_rank").\
-                from_statement(
-                    "SELECT  pr.game_type_cd, pr.rank, overall.max_rank "
-                    "FROM    player_ranks pr, "
-                    "        (SELECT  game_type_cd, max(rank) max_rank "
-                    "        FROM     player_ranks "
-                    "        GROUP BY game_type_cd) overall "
-                    "WHERE   pr.game_type_cd = overall.game_type_cd  "
-                    "        AND player_id = :player_id "
-                    "ORDER BY rank").\
-                params(player_id=player_id).all()
-
-        ranks_dict = {}
-        for gtc,rank,max_rank in ranks:
-            ranks_dict[gtc] = (rank, max_rank)
-
-        elos = DBSession.query(PlayerElo).\
-                filter_by(player_id=player_id).\
-                order_by(PlayerElo.elo.desc()).\
-                all()
-
-        elos_dict = {}
-        for elo in elos:
-            if elo.games >= 32:
-                elos_dict[elo.game_type_cd] = elo.elo
-
-        self.data = {
-                'player':player,
-                'total_stats':total_stats,
-                'ranks':ranks_dict,
-                'elos':elos_dict,
+        self.data = load_player_data([player_id])[0].data
+
+
+def total_stats(profile):
+    """The total_stats of a player's badge, from their PlayerProfile."""
+    # total games
+    # wins/losses
+    # kills/deaths
+    total_stats = {}
+    total_stats['games'] = 0
+    total_stats['games_breakdown'] = {}  # this is a dictionary inside a dictionary .. dictception?
+    total_stats['games_alivetime'] = profile.games_alivetime
+    total_stats['gametypes'] = []
+    for gp in profile.games_played:
+        if gp.game_type_cd == 'overall':
+            (total_stats['wins'], total_stats['losses']) = (gp.wins, gp.losses)
+            continue
+        total_stats['games'] += gp.games
+        total_stats['gametypes'].append(gp.game_type_cd)
+        total_stats['games_breakdown'][gp.game_type_cd] = gp.games
+
+    overall = profile.overall_stats.get('overall')
+    if overall is not None:
+        total_stats['kills'] = overall.total_kills
+        total_stats['deaths'] = overall.total_deaths
+        total_stats['alivetime'] = overall.total_playing_time
+    else:
+        total_stats['kills'] = None
+        total_stats['deaths'] = None
+        total_stats['alivetime'] = None
+
+    return total_stats
+
+
+def load_player_data(player_ids):
+    """
+    Returns a PlayerData for each of a list of player ids, in the same
+    order, getting them all with a few queries: the players, their
+    profiles, ranks and Elos. Players that don't exist are left out.
+    """
+    players = dict((player.player_id, player) for player in
+            DBSession.query(Player).filter(Player.player_id.in_(player_ids)))
+
+    profiles = load_profiles(DBSession, player_ids)
+
+    # duel/dm/tdm/ctf elo + rank
+    ranks = {}
+    for (player_id, gtc, rank, max_rank) in DBSession.query(
+            PlayerRank.player_id, PlayerRank.game_type_cd, PlayerRank.rank,
+            PlayerRankSummary.max_rank).\
+            filter(PlayerRank.game_type_cd == PlayerRankSummary.game_type_cd).\
+            filter(PlayerRank.player_id.in_(player_ids)):
+        ranks.setdefault(player_id, {})[gtc] = (rank, max_rank)
+
+    elos = {}
+    for (player_id, gtc, elo) in DBSession.query(PlayerElo.player_id,
+            PlayerElo.game_type_cd, PlayerElo.elo).\
+            filter(PlayerElo.player_id.in_(player_ids)).\
+            filter(PlayerElo.games >= 32):
+        elos.setdefault(player_id, {})[gtc] = elo
+
+    player_data = []
+    for player_id in player_ids:
+        if player_id not in players:
+            continue
+
+        playerdata = PlayerData()
+        playerdata.data = {
+                'player':players[player_id],
+                'total_stats':total_stats(profiles[player_id]),
+                'ranks':ranks.get(player_id, {}),
+                'elos':elos.get(player_id, {}),
             }
+        player_data.append(playerdata)
 
+    return player_data
@@ -1,8 +1,9 @@
+import hashlib
 import math
 import re
-import zlib, struct
 import cairo as C
 from colorsys import rgb_to_hls, hls_to_rgb
+from xonstat.png import write_png
 from xonstat.util import strip_colors, qfont_decode, _all_colors
 
 # similar to html_colors() from util.py
@@ -22,29 +23,6 @@ _dec_colors = [ (0.5,0.5,0.5),
             ]
 
 
-# function to write compressed PNG (using zlib)
-def write_png(filename, buf, width, height):
-    width_byte_4 = width * 4
-    # fix color ordering (BGRA -> RGBA)
-    for byte in xrange(width*height):
-        pos = byte * 4
-        buf[pos:pos+4] = buf[pos+2] + buf[pos+1] + buf[pos+0] + buf[pos+3]
-    raw_data = b"".join(b'\x00' + buf[span:span + width_byte_4] for span in range(0, (height-1) * width * 4 + 1, width_byte_4))
-    def png_pack(png_tag, data):
-        chunk_head = png_tag + data
-        return struct.pack("!I", len(data)) + chunk_head + struct.pack("!I", 0xFFFFFFFF & zlib.crc32(chunk_head))
-    data = b"".join([
-        b'\x89PNG\r\n\x1a\n',
-        png_pack(b'IHDR', struct.pack("!2I5B", width, height, 8, 6, 0, 0, 0)),
-        png_pack(b'IDAT', zlib.compress(raw_data, 9)),
-        png_pack(b'IEND', b'')])
-    f = open(filename, "wb")
-    try:
-        f.write(data)
-    finally:
-        f.close()
-
-
 class Skin:
 
     # skin parameters, can be overriden by init
@@ -56,9 +34,17 @@ class Skin:
     # render context
     ctx = None
 
+    # the badge background, see background()
+    _background = None
+
+    # font faces by (bold, italic), see font_face()
+    _font_faces = {}
+
     def __init__(self, name, **params):
         # default parameters
         self.name = name
+        self._background = None
+        self._font_faces = {}
         self.params = {
             'bg':               None,           # None - plain; otherwise use given texture
             'bgcolor':          None,           # transparent bg when bgcolor==None
@@ -139,6 +125,8 @@ class Skin:
             'ptime_color':      (0.1, 0.1, 0.1),
             'ptime_text':       "Playing Time: %s",
             'ptime_align':      0,
+            'png_level':        9,              # zlib compression level, 0-9
+            'png_filter':       'none',         # PNG scanline filter, see xonstat.png
         }
         
         for k,v in params.items():
@@ -170,12 +158,9 @@ class Skin:
         ctx.restore()
 
     def set_font(self, fontsize, color, bold=False, italic=False):
-        ctx    = self.ctx
-        font   = self.font
-        slant  = C.FONT_SLANT_ITALIC if italic else C.FONT_SLANT_NORMAL
-        weight = C.FONT_WEIGHT_BOLD  if bold   else C.FONT_WEIGHT_NORMAL
+        ctx = self.ctx
 
-        ctx.select_font_face(font, slant, weight)
+        ctx.set_font_face(self.font_face(bold, italic))
         ctx.set_font_size(fontsize)
         if len(color) == 1:
             ctx.set_source_rgb(color[0], color[0], color[0])
@@ -186,28 +171,19 @@ class Skin:
         else:
             ctx.set_source_rgb(1, 1, 1)
 
-    def render_image(self, data, output_filename):
-        """Render an image for the given player id."""
-
-        # setup variables
-
-        player          = data.player
-        elos            = data.elos
-        ranks           = data.ranks
-        #games           = data.total_stats['games']
-        wins, losses    = data.total_stats['wins'], data.total_stats['losses']
-        games           = wins + losses
-        kills, deaths   = data.total_stats['kills'], data.total_stats['deaths']
-        alivetime       = data.total_stats['alivetime']
-
-
-        # build image
+    def background(self):
+        """
+        Returns the background of the skin's badges, the tiled texture or
+        fill color with the overlay graphic on top, as an image surface. It
+        is drawn on first use and kept, so the images are loaded once.
+        """
+        if self._background is not None:
+            return self._background
 
         surf = C.ImageSurface(C.FORMAT_ARGB32, self.width, self.height)
         ctx = C.Context(surf)
-        self.ctx = ctx
         ctx.set_antialias(C.ANTIALIAS_GRAY)
-        
+
         # draw background
         if self.bg == None:
             if self.bgcolor != None:
@@ -250,6 +226,64 @@ class Skin:
                 #print "Error: Can't load overlay texture: %s" % self.overlay
                 pass
 
+        surf.flush()
+        self._background = surf
+        return surf
+
+    def font_face(self, bold=False, italic=False):
+        """Returns the skin's font face in a style, looked up once."""
+        key = (bold, italic)
+        if not self._font_faces.has_key(key):
+            slant  = C.FONT_SLANT_ITALIC if italic else C.FONT_SLANT_NORMAL
+            weight = C.FONT_WEIGHT_BOLD  if bold   else C.FONT_WEIGHT_NORMAL
+            self._font_faces[key] = C.ToyFontFace(self.font, slant, weight)
+        return self._font_faces[key]
+
+    def fingerprint(self, data):
+        """
+        Returns a hash of what render_image draws for the given player data:
+        the skin's parameters and the nick and numbers shown. Badges with
+        the same fingerprint are the same image.
+        """
+        elos, ranks = data.elos, data.ranks
+        gametypes = [(gt, round(elos[gt], 0), ranks[gt])
+                for gt in data.total_stats['gametypes'][:self.num_gametypes]
+                if elos.has_key(gt) and ranks.has_key(gt)]
+        shown = (sorted(self.params.items()), data.player.nick, gametypes,
+                data.total_stats['wins'], data.total_stats['losses'],
+                data.total_stats['kills'], data.total_stats['deaths'],
+                str(data.total_stats['alivetime']))
+        return hashlib.sha1(repr(shown)).hexdigest()
+
+    def render_image(self, data, output_filename):
+        """Render an image for the given player id."""
+
+        # setup variables
+
+        player          = data.player
+        elos            = data.elos
+        ranks           = data.ranks
+        #games           = data.total_stats['games']
+        wins, losses    = data.total_stats['wins'], data.total_stats['losses']
+        games           = wins + losses
+        kills, deaths   = data.total_stats['kills'], data.total_stats['deaths']
+        alivetime       = data.total_stats['alivetime']
+
+
+        # build image
+
+        surf = C.ImageSurface(C.FORMAT_ARGB32, self.width, self.height)
+        ctx = C.Context(surf)
+        self.ctx = ctx
+        ctx.set_antialias(C.ANTIALIAS_GRAY)
+        
+        # start from the background and overlay, the same for every badge
+        ctx.save()
+        ctx.set_operator(C.OPERATOR_SOURCE)
+        ctx.set_source_surface(self.background(), 0, 0)
+        ctx.paint()
+        ctx.restore()
+
 
         ## draw player's nickname with fancy colors
         
@@ -264,7 +298,7 @@ class Skin:
         stripped_nick = strip_colors(qstr.replace(' ', '_'))
         
         # fontsize is reduced if width gets too large
-        ctx.select_font_face(self.font, C.FONT_SLANT_NORMAL, C.FONT_WEIGHT_NORMAL)
+        ctx.set_font_face(self.font_face())
         shrinknick = 0
         while shrinknick < 0.6 * self.nick_fontsize:
             ctx.set_font_size(self.nick_fontsize - shrinknick)
@@ -477,5 +511,6 @@ class Skin:
         #surf.write_to_png(output_filename)
         surf.flush()
         imgdata = surf.get_data()
-        write_png(output_filename, imgdata, self.width, self.height)
+        write_png(output_filename, imgdata, self.width, self.height,
+                self.png_level, self.png_filter)
 
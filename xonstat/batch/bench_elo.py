@@ -0,0 +1,48 @@
+#-*- coding: utf-8 -*-
+
+import random
+import sys
+import timeit
+from xonstat import elo
+
+# Times the pairwise Elo adjustments of a game, the pure Python loop against
+# the NumPy engine, for a range of player counts. No database needed.
+
+
+class BenchElo(object):
+    def __init__(self, player_id, elo):
+        self.player_id = player_id
+        self.elo = elo
+        self.k = 1.0
+        self.games = 0
+
+
+if elo.numpy is None:
+    print "NumPy is not installed, only the loop can be timed."
+
+sizes = [int(arg) for arg in sys.argv[1:]]
+if len(sizes) == 0:
+    sizes = [2, 8, 16, 32, 64]
+
+ROUNDS = 200
+rand = random.Random(0)
+
+print "%8s %12s %12s %8s" % ("players", "loop ms", "numpy ms", "speedup")
+for n in sizes:
+    elos = {}
+    scores = {}
+    for pid in range(3, n + 3):
+        elos[pid] = BenchElo(pid, rand.uniform(100, 1500))
+        scores[pid] = rand.randint(-20, 200) / float(rand.randint(60, 600))
+
+    loop = min(timeit.repeat(lambda: elo.elo_adjustments('dm', elos, scores,
+        elo.ELOPARMS), number=ROUNDS, repeat=3)) / ROUNDS * 1000
+
+    if elo.numpy is None:
+        print "%8d %12.3f %12s %8s" % (n, loop, "-", "-")
+        continue
+
+    vectorized = min(timeit.repeat(lambda: elo.elo_adjustments_numpy('dm',
+        elos, scores, elo.ELOPARMS), number=ROUNDS, repeat=3)) / ROUNDS * 1000
+
+    print "%8d %12.3f %12.3f %7.2fx" % (n, loop, vectorized, loop/vectorized)
@@ -0,0 +1,283 @@
+#-*- coding: utf-8 -*-
+
+import os
+import random
+import sys
+import time
+import timeit
+from datetime import datetime, timedelta
+import sqlalchemy
+import sqlalchemy.sql.functions as func
+import sqlalchemy.sql.expression as expr
+from xonstat import leaderboards, rollups
+from xonstat.models import *
+
+# Compares the server and map info page queries as they were, ORM instances
+# sliced in Python after fetching every group and every game, with the
+# leaderboard queries they use now. Runs against a SQLite database seeded
+# with GAMES games, a fifth of which are on one busy server and map, so no
+# PostgreSQL is needed.
+#
+# SQLite can't sum intervals, so the leaderboards by playing time are left
+# out. They are built the same way as the ones by score.
+
+GAMES = 100000
+SERVERS = 200
+MAPS = 300
+PLAYERS = 20000
+ROUNDS = 5
+
+# days the games are spread over, and the leaderboard lifetime
+DAYS = 60
+LIFETIME = 30
+
+LEADERBOARD_COUNT = 10
+RECENT_GAMES_COUNT = 20
+
+# the tables initialize_db maps, with the columns the pages use
+SCHEMA = """
+CREATE TABLE achievements (achievement_id INTEGER PRIMARY KEY);
+CREATE TABLE cd_achievement (achievement_cd VARCHAR(10) PRIMARY KEY);
+CREATE TABLE cd_game_type (game_type_cd VARCHAR(10) PRIMARY KEY);
+CREATE TABLE cd_weapon (weapon_cd VARCHAR(15) PRIMARY KEY);
+CREATE TABLE db_version (version VARCHAR(10) PRIMARY KEY);
+CREATE TABLE hashkeys (hashkey VARCHAR(44) PRIMARY KEY, player_id INTEGER);
+CREATE TABLE player_weapon_stats (player_weapon_stats_id INTEGER PRIMARY KEY);
+CREATE TABLE player_nicks (player_id INTEGER, stripped_nick VARCHAR(128),
+    PRIMARY KEY (player_id, stripped_nick));
+CREATE TABLE player_elos (player_id INTEGER, game_type_cd VARCHAR(10),
+    PRIMARY KEY (player_id, game_type_cd));
+CREATE TABLE player_ranks (player_id INTEGER, game_type_cd VARCHAR(10),
+    PRIMARY KEY (player_id, game_type_cd));
+CREATE TABLE players (player_id INTEGER PRIMARY KEY, nick VARCHAR(128),
+    stripped_nick VARCHAR(128), active_ind BOOLEAN, location VARCHAR(100),
+    create_dt TIMESTAMP);
+CREATE TABLE servers (server_id INTEGER PRIMARY KEY, name VARCHAR(64),
+    location VARCHAR(50), ip_addr VARCHAR(50), revision VARCHAR(50),
+    hashkey VARCHAR(44), active_ind BOOLEAN, create_dt TIMESTAMP);
+CREATE TABLE maps (map_id INTEGER PRIMARY KEY, name VARCHAR(64),
+    version INTEGER, pk3_name VARCHAR(100), create_dt TIMESTAMP);
+CREATE TABLE games (game_id INTEGER PRIMARY KEY, start_dt TIMESTAMP,
+    game_type_cd VARCHAR(10), server_id INTEGER, map_id INTEGER,
+    duration INTEGER, winner INTEGER, match_id VARCHAR(64),
+    create_dt TIMESTAMP);
+CREATE INDEX games_server_ix ON games (server_id);
+CREATE INDEX games_map_ix ON games (map_id);
+CREATE INDEX games_start_dt_ix ON games (start_dt);
+CREATE TABLE player_game_stats (player_game_stat_id INTEGER PRIMARY KEY,
+    player_id INTEGER, game_id INTEGER, nick VARCHAR(128),
+    stripped_nick VARCHAR(128), team INTEGER, rank INTEGER, score INTEGER,
+    alivetime INTEGER, kills INTEGER, deaths INTEGER, suicides INTEGER,
+    elo_delta NUMERIC, create_dt TIMESTAMP);
+CREATE INDEX player_game_stats_game_ix ON player_game_stats (game_id);
+CREATE INDEX player_game_stats_player_ix ON player_game_stats (player_id);
+"""
+
+
+def seed(engine):
+    """Fills the database, returning the number of stats and rollup rows."""
+    for statement in SCHEMA.split(';'):
+        if statement.strip():
+            engine.execute(statement)
+    initialize_db(engine)
+
+    rng = random.Random(42)
+    now = datetime.utcnow()
+    conn = engine.connect()
+    trans = conn.begin()
+
+    conn.execute("INSERT INTO players (player_id, nick, active_ind, create_dt) "
+            "VALUES (?, ?, 1, ?)",
+            [(pid, "player %d" % pid, now) for pid in range(1, PLAYERS + 1)])
+    conn.execute("INSERT INTO servers (server_id, name, create_dt) "
+            "VALUES (?, ?, ?)",
+            [(sid, "server %d" % sid, now) for sid in range(1, SERVERS + 1)])
+    conn.execute("INSERT INTO maps (map_id, name, create_dt) VALUES (?, ?, ?)",
+            [(mid, "map%d" % mid, now) for mid in range(1, MAPS + 1)])
+
+    games = []
+    pgstats = []
+    player_days = {}
+    server_map_days = {}
+    for game_id in range(1, GAMES + 1):
+        if rng.random() < 0.2:
+            (server_id, map_id) = (1, 1)
+        else:
+            server_id = rng.randint(2, SERVERS)
+            map_id = rng.randint(2, MAPS)
+        create_dt = now - timedelta(seconds=rng.randint(0, DAYS * 86400))
+        games.append((game_id, create_dt, 'dm', server_id, map_id, create_dt))
+
+        key = (create_dt.date(), server_id, map_id)
+        server_map_days[key] = server_map_days.get(key, 0) + 1
+
+        for (rank, player_id) in enumerate(rng.sample(xrange(3, PLAYERS + 1),
+                rng.randint(2, 8))):
+            score = rng.randint(0, 50)
+            pgstats.append((len(pgstats) + 1, player_id, game_id,
+                "player %d" % player_id, rank + 1, score, create_dt))
+
+            key = (create_dt.date(), player_id, server_id, map_id)
+            (count, total) = player_days.get(key, (0, 0))
+            player_days[key] = (count + 1, total + score)
+
+    conn.execute("INSERT INTO games (game_id, start_dt, game_type_cd, "
+            "server_id, map_id, create_dt) VALUES (?, ?, ?, ?, ?, ?)", games)
+    conn.execute("INSERT INTO player_game_stats (player_game_stat_id, "
+            "player_id, game_id, nick, rank, score, create_dt) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)", pgstats)
+
+    # what store_submission would have added to the rollups
+    conn.execute(PlayerDailyStat.__table__.insert(), [
+        {'stat_date':stat_date, 'player_id':player_id, 'server_id':server_id,
+            'map_id':map_id, 'games':count, 'score':score,
+            'alivetime':timedelta(0)}
+        for ((stat_date, player_id, server_id, map_id), (count, score))
+            in player_days.items()])
+    conn.execute(ServerMapDailyStat.__table__.insert(), [
+        {'stat_date':stat_date, 'server_id':server_id, 'map_id':map_id,
+            'games':count}
+        for ((stat_date, server_id, map_id), count)
+            in server_map_days.items()])
+
+    trans.commit()
+    conn.close()
+
+    return (len(pgstats), len(player_days))
+
+
+def since():
+    return datetime.utcnow() - timedelta(days=LIFETIME)
+
+
+# the queries the pages ran before
+
+def legacy_server_top_maps(server_id):
+    return DBSession.query(Game.map_id, Map.name, func.count()).\
+            filter(Map.map_id==Game.map_id).\
+            filter(Game.server_id==server_id).\
+            filter(Game.create_dt > since()).\
+            order_by(expr.desc(func.count())).\
+            group_by(Game.map_id).\
+            group_by(Map.name).all()[0:LEADERBOARD_COUNT]
+
+def legacy_server_top_scorers(server_id):
+    return DBSession.query(Player.player_id, Player.nick,
+            func.sum(PlayerGameStat.score)).\
+            filter(Player.player_id == PlayerGameStat.player_id).\
+            filter(Game.game_id == PlayerGameStat.game_id).\
+            filter(Game.server_id == server_id).\
+            filter(Player.player_id > 2).\
+            filter(PlayerGameStat.create_dt > since()).\
+            order_by(expr.desc(func.sum(PlayerGameStat.score))).\
+            group_by(Player.nick).\
+            group_by(Player.player_id).all()[0:LEADERBOARD_COUNT]
+
+def legacy_server_recent_games(server_id):
+    return DBSession.query(Game, Server, Map, PlayerGameStat).\
+            filter(Game.server_id==Server.server_id).\
+            filter(Game.map_id==Map.map_id).\
+            filter(PlayerGameStat.game_id==Game.game_id).\
+            filter(PlayerGameStat.rank==1).\
+            filter(Server.server_id==server_id).\
+            order_by(expr.desc(Game.start_dt)).all()[0:RECENT_GAMES_COUNT]
+
+def legacy_map_top_servers(map_id):
+    return DBSession.query(Server.server_id, Server.name,
+            func.count(Game.game_id)).\
+            filter(Game.server_id == Server.server_id).\
+            filter(Game.map_id == map_id).\
+            filter(Game.create_dt > since()).\
+            order_by(expr.desc(func.count(Game.game_id))).\
+            group_by(Server.name).\
+            group_by(Server.server_id).all()[0:LEADERBOARD_COUNT]
+
+def legacy_map_recent_games(map_id):
+    return DBSession.query(Game, Server, Map, PlayerGameStat).\
+            filter(Game.server_id==Server.server_id).\
+            filter(Game.map_id==Map.map_id).\
+            filter(Game.map_id==map_id).\
+            filter(PlayerGameStat.game_id==Game.game_id).\
+            filter(PlayerGameStat.rank==1).\
+            order_by(expr.desc(Game.start_dt)).all()[0:RECENT_GAMES_COUNT]
+
+
+# the queries the pages run now
+
+def server_top_maps(server_id):
+    return rollups.top_maps(DBSession, LIFETIME, LEADERBOARD_COUNT,
+            server_id=server_id)
+
+def server_top_scorers(server_id):
+    return rollups.top_scorers(DBSession, LIFETIME, LEADERBOARD_COUNT,
+            server_id=server_id)
+
+def server_recent_games(server_id):
+    return leaderboards.recent_games(DBSession, RECENT_GAMES_COUNT,
+            server_id=server_id)
+
+def map_top_servers(map_id):
+    return rollups.top_servers(DBSession, LIFETIME, LEADERBOARD_COUNT,
+            map_id=map_id)
+
+def map_recent_games(map_id):
+    return leaderboards.recent_games(DBSession, RECENT_GAMES_COUNT,
+            map_id=map_id)
+
+
+def timed(function, arg):
+    def run():
+        function(arg)
+        DBSession.remove()
+    return min(timeit.repeat(run, number=1, repeat=ROUNDS)) * 1000
+
+
+db_file = None
+for arg in sys.argv[1:]:
+    if arg.startswith("-"):
+        print """Usage:  bench_leaderboards.py [sqlite file]
+    Seeds a SQLite database with %d games and times the server and map
+    info page queries before and after moving the LIMIT into SQL. The
+    database is kept in memory unless a file is given, an existing file
+    is reused as it is.
+""" % GAMES
+        sys.exit(-1)
+    else:
+        db_file = arg
+
+if db_file is None:
+    engine = sqlalchemy.create_engine('sqlite://')
+else:
+    engine = sqlalchemy.create_engine('sqlite:///' + db_file)
+
+if db_file is not None and os.path.exists(db_file):
+    initialize_db(engine)
+else:
+    start = time.time()
+    (pgstat_count, player_day_count) = seed(engine)
+    print "Seeded %d games, %d player game stats and %d player rollup rows " \
+            "in %.1f seconds" % (GAMES, pgstat_count, player_day_count,
+                    time.time() - start)
+
+print "%-22s %10s %10s %10s %8s" % ("query", "rows", "legacy ms", "new ms",
+        "speedup")
+for (name, legacy, new, arg) in (
+        ("busy server top maps", legacy_server_top_maps, server_top_maps, 1),
+        ("busy server scorers", legacy_server_top_scorers, server_top_scorers, 1),
+        ("busy server games", legacy_server_recent_games, server_recent_games, 1),
+        ("busy map top servers", legacy_map_top_servers, map_top_servers, 1),
+        ("busy map games", legacy_map_recent_games, map_recent_games, 1),
+        ("quiet server scorers", legacy_server_top_scorers, server_top_scorers, 2),
+        ("quiet server games", legacy_server_recent_games, server_recent_games, 2)):
+    legacy_rows = legacy(arg)
+    new_rows = new(arg)
+    # the leaderboards count whole days now, so only the games must match
+    if name.endswith("games") and [row[0].game_id for row in legacy_rows] != \
+            [row.game_id for row in new_rows]:
+        print "%s: results differ!" % name
+    DBSession.remove()
+
+    legacy_ms = timed(legacy, arg)
+    new_ms = timed(new, arg)
+    print "%-22s %10d %10.1f %10.1f %7.1fx" % (name, len(new_rows), legacy_ms,
+            new_ms, legacy_ms / new_ms)
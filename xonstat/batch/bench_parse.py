@@ -0,0 +1,142 @@
+#-*- coding: utf-8 -*-
+
+import glob
+import os
+import re
+import sys
+import timeit
+from xonstat.submission_parser import parse_submission, set_known_weapons
+
+# Compares parsing plus the precondition scans of the submission handler
+# (is_blank_game, and num_real_players twice) between the legacy dictionary
+# based code, copied below, and the single-pass parser. No database needed.
+
+
+def legacy_parse_body(body):
+    game_meta = {}
+    player_events = {}
+    players = []
+
+    for line in body.split('\n'):
+        try:
+            (key, value) = line.strip().split(' ', 1)
+
+            if key in 'S' 'n':
+                value = unicode(value, 'utf-8')
+
+            if key in 'V' 'T' 'G' 'M' 'S' 'C' 'R' 'W' 'I':
+                game_meta[key] = value
+
+            if key == 'P':
+                if len(player_events) != 0:
+                    players.append(player_events)
+                    player_events = {}
+
+                player_events[key] = value
+
+            if key == 'e':
+                (subkey, subvalue) = value.split(' ', 1)
+                player_events[subkey] = subvalue
+            if key == 'n':
+                player_events[key] = value
+            if key == 't':
+                player_events[key] = value
+        except:
+            pass
+
+    if len(player_events) > 0:
+        players.append(player_events)
+
+    return (game_meta, players)
+
+
+def legacy_is_real_player(events, count_bots=False):
+    if 'matches' in events and 'scoreboardvalid' in events:
+        if (events['P'].startswith('bot') and count_bots) or \
+            not events['P'].startswith('bot'):
+            return True
+    return False
+
+
+def legacy_checks(players):
+    r = re.compile(r'acc-.*-cnt-fired')
+    flg_nonzero_score = False
+    flg_acc_events = False
+    for events in players:
+        if legacy_is_real_player(events):
+            for (key,value) in events.items():
+                if key == 'scoreboard-score' and value != '0':
+                    flg_nonzero_score = True
+                if r.search(key):
+                    flg_acc_events = True
+
+    real = len([e for e in players if legacy_is_real_player(e)])
+    real_with_bots = len([e for e in players if legacy_is_real_player(e, True)])
+    return (flg_nonzero_score and flg_acc_events, real, real_with_bots)
+
+
+def is_real_player(player, count_bots=False):
+    return player.matches and player.scoreboardvalid and \
+            (count_bots or not player.is_bot())
+
+
+def checks(players):
+    flg_nonzero_score = False
+    flg_acc_events = False
+    for player in players:
+        if is_real_player(player):
+            if player.scoreboard.get('score', 0) != 0:
+                flg_nonzero_score = True
+            if not flg_acc_events and player.has_accuracy():
+                flg_acc_events = True
+
+    real = len([p for p in players if is_real_player(p)])
+    real_with_bots = len([p for p in players if is_real_player(p, True)])
+    return (flg_nonzero_score and flg_acc_events, real, real_with_bots)
+
+
+def run_legacy(body):
+    (game_meta, players) = legacy_parse_body(body)
+    return legacy_checks(players)
+
+
+def run_single_pass(body):
+    (game_meta, players) = parse_submission(body.split('\n'))
+    return checks(players)
+
+
+bodies = sys.argv[1:]
+if len(bodies) == 0:
+    bodies = sorted(glob.glob(os.path.join(os.path.dirname(
+        os.path.abspath(__file__)), "corpus", "*.txt")))
+
+ROUNDS = 200
+
+# the app loads the weapon codes from cd_weapon at startup, here we take
+# the ones the bodies use
+weapon_cds = set()
+for filename in bodies:
+    for player in parse_submission(open(filename).read().split('\n'))[1]:
+        weapon_cds.update(player.weapons)
+set_known_weapons(weapon_cds)
+
+print "%-16s %8s %12s %12s %8s" % ("body", "bytes", "legacy ms", "new ms", "speedup")
+total_legacy, total_new = 0.0, 0.0
+for filename in bodies:
+    body = open(filename).read()
+
+    if run_legacy(body) != run_single_pass(body):
+        print "%s: results differ!" % filename
+
+    legacy = min(timeit.repeat(lambda: run_legacy(body), number=ROUNDS,
+        repeat=3)) / ROUNDS * 1000
+    new = min(timeit.repeat(lambda: run_single_pass(body), number=ROUNDS,
+        repeat=3)) / ROUNDS * 1000
+    total_legacy += legacy
+    total_new += new
+
+    print "%-16s %8d %12.3f %12.3f %7.2fx" % (os.path.basename(filename),
+            len(body), legacy, new, legacy/new)
+
+print "%-16s %8s %12.3f %12.3f %7.2fx" % ("total", "", total_legacy, total_new,
+        total_legacy/total_new)
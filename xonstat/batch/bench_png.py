@@ -0,0 +1,82 @@
+#-*- coding: utf-8 -*-
+
+import random
+import sys
+import timeit
+import zlib
+from xonstat import png
+
+# Times the encoding of a badge-sized image, the former per-pixel encoder
+# against encode_png at several compression levels and filters, and shows
+# the size of the PNGs. No database or cairo needed, the images are made up
+# to look like the two kinds of skins: a noisy background texture (classic)
+# and a flat color with some text on it (minimal).
+
+WIDTH = 560
+HEIGHT = 70
+ROUNDS = 10
+
+rand = random.Random(0)
+
+
+def noisy_badge():
+    buf = bytearray(WIDTH * HEIGHT * 4)
+    for pos in xrange(0, len(buf), 4):
+        shade = 40 + rand.randint(0, 24)
+        buf[pos:pos + 4] = bytearray([shade, shade, shade + 4, 255])
+    return add_text(buf)
+
+
+def flat_badge():
+    buf = bytearray([10, 10, 10, 255]) * (WIDTH * HEIGHT)
+    return add_text(buf)
+
+
+def add_text(buf):
+    # some blocks of antialiased "glyphs"
+    for n in range(60):
+        (x0, y0) = (rand.randint(0, WIDTH - 12), rand.randint(0, HEIGHT - 14))
+        for y in range(y0, y0 + 12):
+            for x in range(x0, x0 + 8):
+                if rand.random() < 0.4:
+                    value = rand.choice((90, 180, 255))
+                    pos = (y * WIDTH + x) * 4
+                    buf[pos:pos + 4] = bytearray([value, value, 255, 255])
+    return str(buf)
+
+
+def former_png(buf, width, height):
+    """The PNG of buf as the badges encoded it before encode_png."""
+    buf = bytearray(buf)
+    width_byte_4 = width * 4
+    # fix color ordering (BGRA -> RGBA)
+    for byte in xrange(width*height):
+        pos = byte * 4
+        buf[pos:pos+4] = bytearray([buf[pos+2], buf[pos+1], buf[pos+0], buf[pos+3]])
+    raw_data = b"".join(b'\x00' + bytes(buf[span:span + width_byte_4]) for span in range(0, (height-1) * width * 4 + 1, width_byte_4))
+    return png._png(width, height, zlib.compress(raw_data, 9))
+
+
+encoders = [("former encoder", lambda buf: former_png(buf, WIDTH,
+    HEIGHT))]
+for level in (9, 6, 1):
+    for png_filter in ('none', 'sub', 'up'):
+        encoders.append(("level %d, %s" % (level, png_filter),
+            lambda buf, level=level, png_filter=png_filter:
+                png.encode_png(buf, WIDTH, HEIGHT, level, png_filter)))
+
+if png.numpy is None:
+    print "NumPy is not installed, the sub and up filters will be slow."
+
+for (name, buf) in (("classic-like", noisy_badge()),
+        ("minimal-like", flat_badge())):
+    print "%s badge, %dx%d:" % (name, WIDTH, HEIGHT)
+    print "    %-18s %10s %10s %8s" % ("", "ms/badge", "bytes", "speedup")
+    former = None
+    for (encoder_name, encode) in encoders:
+        ms = min(timeit.repeat(lambda: encode(buf), number=ROUNDS,
+            repeat=3)) / ROUNDS * 1000
+        if former is None:
+            former = ms
+        print "    %-18s %10.2f %10d %7.1fx" % (encoder_name, ms,
+                len(encode(buf)), former / ms)
@@ -0,0 +1,85 @@
+#-*- coding: utf-8 -*-
+
+import glob
+import os
+import sys
+import time
+from pyramid.paster import bootstrap
+from sqlalchemy import event
+from xonstat.models import *
+from xonstat.views.submission import parse_body, check_preconditions
+from xonstat.views.submission import store_submission
+
+# Counts the database round-trips needed to store a submission. Every body
+# is stored inside a transaction that is rolled back afterwards, so this can
+# be pointed at a development database without leaving anything behind.
+#
+# The legacy column is what the old per-row code needed for the player game
+# and weapon stats alone: one sequence fetch and one INSERT per row.
+
+ini_file = '../../development.ini'
+bodies = []
+for arg in sys.argv[1:]:
+    if arg.startswith("-"):
+        print """Usage:  bench_submission.py [ini file] [body files]
+    Stores each recorded submission body in a transaction that is rolled
+    back and reports the statements it took. Without body files, the
+    samples in corpus/ are used.
+"""
+        sys.exit(-1)
+    elif arg.endswith(".ini"):
+        ini_file = arg
+    else:
+        bodies.append(arg)
+
+if len(bodies) == 0:
+    bodies = sorted(glob.glob(os.path.join(os.path.dirname(
+        os.path.abspath(__file__)), "corpus", "*.txt")))
+
+env = bootstrap(ini_file)
+settings = env['registry'].settings
+
+# statements writing the player game and weapon stats
+stat_markers = ["INSERT INTO player_game_stats", "INSERT INTO player_weapon_stats",
+        "player_game_stats_player_game_stat_id_seq",
+        "player_weapon_stats_player_weapon_stats_id_seq"]
+
+statements = []
+def count_statement(conn, cursor, statement, parameters, context, executemany):
+    statements.append(statement)
+
+event.listen(DBSession.bind, "before_cursor_execute", count_statement)
+
+print "%-16s %8s %8s %10s %10s %10s %8s" % ("body", "players", "weapons",
+        "total", "stats", "legacy", "ms")
+for filename in bodies:
+    body = open(filename).read()
+    (game_meta, players) = parse_body(body)
+
+    # a unique match id, so the duplicate check doesn't stop us
+    game_meta['I'] = "bench-%f" % time.time()
+    check_preconditions(settings, game_meta, players)
+
+    session = DBSession()
+    del statements[:]
+    start = time.time()
+    try:
+        game = store_submission(session=session, idfp="bench",
+                ip_addr="127.0.0.1", game_meta=game_meta, players=players)
+        session.flush()
+        elapsed = (time.time() - start) * 1000
+
+        pgstats = session.query(PlayerGameStat).\
+                filter(PlayerGameStat.game_id == game.game_id).count()
+        pwstats = session.query(PlayerWeaponStat).\
+                filter(PlayerWeaponStat.game_id == game.game_id).count()
+    finally:
+        session.rollback()
+
+    # the two counting queries above aren't part of the submission
+    total = len(statements) - 2
+    stats = len([s for s in statements[:total]
+        if [marker for marker in stat_markers if marker in s]])
+
+    print "%-16s %8d %8d %10d %10d %10d %8.1f" % (os.path.basename(filename),
+            pgstats, pwstats, total, stats, 2*pgstats + 2*pwstats, elapsed)
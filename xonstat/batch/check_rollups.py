@@ -0,0 +1,64 @@
+#-*- coding: utf-8 -*-
+
+import sys
+from datetime import datetime, timedelta
+from pyramid.paster import bootstrap
+from xonstat.models import *
+from xonstat.rollups import check_rollups
+
+# Compares the daily leaderboard rollups with what player_game_stats and
+# games add up to, and reports the rows that differ. Differences for today
+# can come from games stored while the check runs. Exits with 1 when there
+# are differences, so it can run from cron. Repair with backfill_rollups.py.
+
+# number of days to check, ending today
+DAYS = 30
+
+# differences to report at most
+LIMIT = 100
+
+ini_file = '../../development.ini'
+args = sys.argv[1:]
+while len(args) > 0:
+    arg = args.pop(0)
+    if arg == "-days" and len(args) > 0:
+        DAYS = int(args.pop(0))
+    elif arg == "-limit" and len(args) > 0:
+        LIMIT = int(args.pop(0))
+    elif arg.startswith("-"):
+        print """Usage:  check_rollups.py [options] [ini file]
+    Checks the daily leaderboard rollups against the raw game tables.
+    Options:
+        -days N     Check the last N days (default 30)
+        -limit N    Report at most N differences (default 100)
+        -help       Show this help text
+    The ini file defaults to ../../development.ini
+"""
+        sys.exit(-1)
+    else:
+        ini_file = arg
+
+env = bootstrap(ini_file)
+
+session = DBSession()
+
+end = datetime.utcnow().date() + timedelta(days=1)
+start = end - timedelta(days=DAYS)
+
+differences = check_rollups(session, start, end, LIMIT)
+session.rollback()
+
+for (table, key, rollup, raw) in differences:
+    print "%-24s %-40s rollup %-30s raw %s" % (table,
+            ", ".join([str(k) for k in key]),
+            ", ".join([str(v) for v in rollup]),
+            ", ".join([str(v) for v in raw]))
+
+if len(differences) == 0:
+    print "The rollups from %s to %s match the raw tables." % (start,
+            end - timedelta(days=1))
+else:
+    print "%d differences from %s to %s%s" % (len(differences), start,
+            end - timedelta(days=1),
+            " (limit reached)" if len(differences) >= LIMIT else "")
+    sys.exit(1)
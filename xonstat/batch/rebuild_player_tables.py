@@ -0,0 +1,119 @@
+#-*- coding: utf-8 -*-
+
+import sys
+import time
+from pyramid.paster import bootstrap
+from xonstat.models import *
+from xonstat.player_profile import rebuild_career_stats
+from xonstat.rollups import max_untracked_player_id
+from xonstat.weapon_series import rebuild_weapon_series
+
+# Rebuilds the per player tables derived from the raw game tables (see
+# xonstat/player_tables.py). The submission handler adds each game to the
+# players already in them and to new players, so this fills them in for the
+# players who played before, and repairs them.
+#
+# Players are rebuilt and committed BATCH_SIZE at a time, in player_id
+# order, so an interrupted run can be continued with -start. It can run
+# while games are submitted: the players a submission is adding a game for
+# are skipped, and retried after the last batch.
+
+# the tables, by name, and the function rebuilding some players in each
+tables = {
+    'player_career_stats': rebuild_career_stats,
+    'player_weapon_series': rebuild_weapon_series,
+}
+
+# players rebuilt per transaction
+BATCH_SIZE = 1000
+
+# first player_id to rebuild
+start = max_untracked_player_id + 1
+
+# times the skipped players are retried, and the seconds between the tries
+RETRIES = 10
+RETRY_WAIT = 1
+
+rebuild = []
+ini_file = '../../development.ini'
+args = sys.argv[1:]
+while len(args) > 0:
+    arg = args.pop(0)
+    if arg == "-start" and len(args) > 0:
+        start = int(args.pop(0))
+    elif arg == "-batch" and len(args) > 0:
+        BATCH_SIZE = int(args.pop(0))
+    elif arg == "-table" and len(args) > 0 and args[0] in tables:
+        rebuild.append(args.pop(0))
+    elif arg.startswith("-"):
+        print """Usage:  rebuild_player_tables.py [options] [ini file]
+    Rebuilds the per player tables of the player pages and badges from the
+    raw game tables.
+    Options:
+        -table NAME     Table to rebuild, can be repeated (default: all)
+                        Tables: %s
+        -start ID       First player_id to rebuild (default: all players)
+        -batch N        Players per transaction (default 1000)
+        -help           Show this help text
+    The ini file defaults to ../../development.ini
+""" % ", ".join(sorted(tables))
+        sys.exit(-1)
+    else:
+        ini_file = arg
+
+if len(rebuild) == 0:
+    rebuild = sorted(tables)
+
+env = bootstrap(ini_file)
+
+session = DBSession()
+
+
+def rebuild_batch(player_ids):
+    """
+    Rebuilds the tables of a batch of players and commits. Returns the
+    number of rows written and the players skipped.
+    """
+    rows, skipped = 0, set()
+    for table in rebuild:
+        (table_rows, table_skipped) = tables[table](session, player_ids)
+        rows += table_rows
+        skipped.update(table_skipped)
+    session.commit()
+    return (rows, skipped)
+
+
+began = time.time()
+players, rows = 0, 0
+skipped = set()
+while True:
+    player_ids = [player_id for (player_id,) in session.query(
+            Player.player_id).\
+            filter(Player.player_id >= start).\
+            order_by(Player.player_id).\
+            limit(BATCH_SIZE).all()]
+    if len(player_ids) == 0:
+        break
+
+    (batch_rows, batch_skipped) = rebuild_batch(player_ids)
+    rows += batch_rows
+    skipped.update(batch_skipped)
+
+    players += len(player_ids)
+    start = player_ids[-1] + 1
+    print "%d players rebuilt, up to player %d" % (players, player_ids[-1])
+
+# a player skipped in one table is rebuilt again in all of them
+for attempt in range(RETRIES):
+    if len(skipped) == 0:
+        break
+    time.sleep(RETRY_WAIT)
+    print "Retrying %d players skipped for submissions" % len(skipped)
+    (retry_rows, skipped) = rebuild_batch(sorted(skipped))
+    rows += retry_rows
+
+print "Rebuilt %d rows for %d players in %.1f seconds" % (rows, players,
+        time.time() - began)
+if len(skipped) > 0:
+    print "Could not rebuild %d players, busy with submissions: %s" % (
+            len(skipped), " ".join(str(player_id) for player_id in sorted(skipped)))
@@ -0,0 +1,42 @@
+#-*- coding: utf-8 -*-
+
+import sys
+import time
+from pyramid.paster import bootstrap
+from xonstat.models import *
+from xonstat.ranks import ensure_rank_indexes, rebuild_ranks
+
+# Rebuilds player_ranks and player_rank_summary from player_elos. The
+# submission handler keeps both up to date as games come in, so this is
+# only needed once to start with, after replaying the Elo history
+# (replay_elos.py) or to recover from failed rank updates.
+
+ini_file = '../../development.ini'
+game_type_cd = None
+for arg in sys.argv[1:]:
+    if arg.startswith("-"):
+        print """Usage:  rebuild_ranks.py [ini file] [game type]
+    Rebuilds the player ranks of one game type (e.g. duel) or, by default,
+    of all game types. The ini file defaults to ../../development.ini
+"""
+        sys.exit(-1)
+    elif arg.endswith(".ini"):
+        ini_file = arg
+    else:
+        game_type_cd = arg
+
+env = bootstrap(ini_file)
+
+session = DBSession()
+start = time.time()
+
+ensure_rank_indexes(session)
+rebuild_ranks(session, game_type_cd)
+session.commit()
+
+for summary in session.query(PlayerRankSummary).\
+        order_by(PlayerRankSummary.game_type_cd).all():
+    print "%-8s %8d players ranked, max rank %d" % (summary.game_type_cd,
+            summary.player_count, summary.max_rank)
+
+print "Rebuilt the ranks in %.1f seconds" % (time.time() - start)
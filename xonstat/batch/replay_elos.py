@@ -0,0 +1,354 @@
+#-*- coding: utf-8 -*-
+
+import cPickle as pickle
+import itertools
+import os
+import sys
+import time
+from array import array
+from collections import namedtuple
+from datetime import timedelta
+from pyramid.paster import bootstrap
+from sqlalchemy import BigInteger, Integer, Numeric, String, select, text
+from sqlalchemy.orm import class_mapper
+import sqlalchemy.sql.functions as func
+from xonstat import elo
+from xonstat.elo import ELOPARMS, apply_k_reduction, pgstat_scores, update_elos
+from xonstat.models import *
+from xonstat.util import sql_values
+
+# Recomputes player_elos and player_game_stats.elo_delta from the whole game
+# history, e.g. after changing ELOPARMS or KREDUCTION in elo.py. Games are
+# streamed in game_id order from a server-side cursor and the Elo of every
+# player is kept in memory, applying the same rules as process_elos.
+#
+# Every CHECKPOINT games the elo_deltas computed so far are written and the
+# in-memory state is saved to the state file, so an interrupted run can be
+# continued with -resume. player_elos is only rewritten once all games are
+# replayed.
+
+# games between checkpoints
+CHECKPOINT = 10000
+
+# rows fetched from the server-side cursor at a time
+FETCH_SIZE = 5000
+
+# rows per UPDATE/INSERT statement
+CHUNK_SIZE = 1000
+
+# compute and report only, nothing is written
+DRY_RUN = False
+
+# continue from the state file instead of starting over
+RESUME = False
+
+STATE_FILE = 'replay_elos.state'
+
+# width of the histogram buckets, in Elo points
+BUCKET = 5
+
+
+class EloTable(object):
+    """
+    The Elo and number of games of every player for one game type, in two
+    arrays indexed by player_id. A player without an Elo has games -1.
+    """
+    def __init__(self):
+        self.elos = array('d')
+        self.games = array('l')
+
+    def get(self, player_id):
+        if player_id < len(self.games) and self.games[player_id] >= 0:
+            return (self.elos[player_id], self.games[player_id])
+        return None
+
+    def set(self, player_id, elo, games):
+        if player_id >= len(self.games):
+            grow = max(player_id + 1 - len(self.games), 1024)
+            self.elos.extend(array('d', [0.0]) * grow)
+            self.games.extend(array('l', [-1]) * grow)
+        self.elos[player_id] = elo
+        self.games[player_id] = games
+
+    def items(self):
+        for player_id in xrange(len(self.games)):
+            if self.games[player_id] >= 0:
+                yield (player_id, self.elos[player_id], self.games[player_id])
+
+    def dump(self):
+        return (self.elos.tostring(), self.games.tostring())
+
+    @classmethod
+    def load(cls, dumped):
+        table = cls()
+        table.elos.fromstring(dumped[0])
+        table.games.fromstring(dumped[1])
+        return table
+
+
+class ReplayElo(object):
+    """Stands in for PlayerElo in the elo.py functions."""
+    def __init__(self, player_id, elo, games):
+        self.player_id = player_id
+        self.elo = elo
+        self.games = games
+        self.k = 0
+
+
+ReplayGame = namedtuple('ReplayGame', ['game_id', 'game_type_cd'])
+
+
+def replay_game(tables, game, rows):
+    """
+    Applies one game to the in-memory state, exactly like process_elos.
+    Sets elo_delta on the rows of the players whose Elo changed.
+    """
+    (duration, scores, alivetimes) = pgstat_scores(rows)
+
+    table = tables.setdefault(game.game_type_cd, EloTable())
+    elos = {}
+    for pid in scores:
+        current = table.get(pid)
+        if current is None:
+            elos[pid] = ReplayElo(pid, ELOPARMS.initial, 0)
+        else:
+            elos[pid] = ReplayElo(pid, current[0], current[1])
+
+    apply_k_reduction(elos, scores, alivetimes, duration)
+    elos = update_elos(game, None, elos, scores, ELOPARMS, rows)
+
+    for e in elos.values():
+        table.set(e.player_id, e.elo, e.games)
+
+
+def stream_games(conn, after_game_id):
+    """
+    Yields (ReplayGame, rows) for every game after after_game_id, in
+    game_id order. The rows are player_game_stats as dictionaries.
+    """
+    pgstats = class_mapper(PlayerGameStat).mapped_table
+    games = class_mapper(Game).mapped_table
+
+    query = select([games.c.game_id, games.c.game_type_cd,
+            pgstats.c.player_game_stat_id, pgstats.c.player_id,
+            func.coalesce(pgstats.c.score, 0).label('score'),
+            pgstats.c.alivetime]).\
+            where(games.c.game_id == pgstats.c.game_id).\
+            where(games.c.game_id > after_game_id).\
+            order_by(games.c.game_id)
+
+    result = conn.execution_options(stream_results=True).execute(query)
+    def all_rows():
+        while True:
+            rows = result.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+
+    for ((game_id, game_type_cd), rows) in itertools.groupby(all_rows(),
+            lambda row: (row.game_id, row.game_type_cd)):
+        yield (ReplayGame(game_id, game_type_cd), [{
+            'player_game_stat_id':row.player_game_stat_id,
+            'player_id':row.player_id,
+            'score':row.score,
+            'alivetime':row.alivetime or timedelta(seconds=0)}
+            for row in rows])
+
+
+def write_elo_deltas(conn, deltas):
+    """
+    Sets elo_delta for a list of (player_game_stat_id, elo_delta), using
+    one UPDATE ... FROM (VALUES ...) per chunk. A delta of None clears it.
+    """
+    for i in range(0, len(deltas), CHUNK_SIZE):
+        (values, bindparams) = sql_values(deltas[i:i + CHUNK_SIZE],
+                (BigInteger, Numeric))
+        conn.execute(text("UPDATE player_game_stats AS p "
+            "SET elo_delta = v.elo_delta "
+            "FROM (" + values + ") AS v(id, elo_delta) "
+            "WHERE p.player_game_stat_id = v.id", bindparams=bindparams))
+
+
+def write_player_elos(conn, tables):
+    """
+    Replaces the contents of player_elos with the replayed state, keeping
+    the rows (and their other columns) of players that still have an Elo.
+    """
+    conn.execute("CREATE TEMPORARY TABLE replay_elos ("
+            "player_id INTEGER, game_type_cd VARCHAR(10), "
+            "elo NUMERIC, games INTEGER) ON COMMIT DROP")
+
+    rows = []
+    for (game_type_cd, table) in tables.items():
+        for (player_id, elo_value, games) in table.items():
+            rows.append((player_id, game_type_cd, elo_value, games))
+
+    for i in range(0, len(rows), CHUNK_SIZE):
+        (values, bindparams) = sql_values(rows[i:i + CHUNK_SIZE],
+                (Integer, String, Numeric, Integer))
+        conn.execute(text("INSERT INTO replay_elos " + values,
+            bindparams=bindparams))
+
+    conn.execute("UPDATE player_elos AS p "
+            "SET elo = r.elo, games = r.games "
+            "FROM replay_elos AS r "
+            "WHERE p.player_id = r.player_id "
+            "AND p.game_type_cd = r.game_type_cd")
+    conn.execute("INSERT INTO player_elos (player_id, game_type_cd, elo, games) "
+            "SELECT r.player_id, r.game_type_cd, r.elo, r.games "
+            "FROM replay_elos AS r "
+            "WHERE NOT EXISTS (SELECT 1 FROM player_elos AS p "
+                "WHERE p.player_id = r.player_id "
+                "AND p.game_type_cd = r.game_type_cd)")
+    conn.execute("DELETE FROM player_elos AS p "
+            "WHERE NOT EXISTS (SELECT 1 FROM replay_elos AS r "
+                "WHERE p.player_id = r.player_id "
+                "AND p.game_type_cd = r.game_type_cd)")
+
+    return len(rows)
+
+
+def save_state(tables, last_game_id, games_done):
+    tmp_file = STATE_FILE + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        pickle.dump({'last_game_id':last_game_id, 'games_done':games_done,
+            'tables':dict((game_type_cd, table.dump())
+                for (game_type_cd, table) in tables.items())},
+            f, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_file, STATE_FILE)
+
+
+def load_state():
+    with open(STATE_FILE, 'rb') as f:
+        state = pickle.load(f)
+    tables = dict((game_type_cd, EloTable.load(dumped))
+            for (game_type_cd, dumped) in state['tables'].items())
+    return (tables, state['last_game_id'], state['games_done'])
+
+
+def histogram(title, values):
+    """Prints how many values fall in each bucket of BUCKET points."""
+    print title
+    if len(values) == 0:
+        print "    (none)"
+        return
+
+    buckets = {}
+    for value in values:
+        bucket = int(value // BUCKET) * BUCKET
+        buckets[bucket] = buckets.get(bucket, 0) + 1
+
+    widest = max(buckets.values())
+    for bucket in sorted(buckets):
+        count = buckets[bucket]
+        print "    %+6d .. %+6d %9d %s" % (bucket, bucket + BUCKET, count,
+                '#' * int(round(50.0 * count / widest)))
+
+    values = sorted(values)
+    print "    n=%d min=%.2f median=%.2f max=%.2f" % (len(values), values[0],
+            values[len(values) // 2], values[-1])
+
+
+ini_file = '../../development.ini'
+args = sys.argv[1:]
+while len(args) > 0:
+    arg = args.pop(0)
+    if arg == "-dry-run":
+        DRY_RUN = True
+    elif arg == "-resume":
+        RESUME = True
+    elif arg == "-checkpoint" and len(args) > 0:
+        CHECKPOINT = int(args.pop(0))
+    elif arg == "-state" and len(args) > 0:
+        STATE_FILE = args.pop(0)
+    elif arg.startswith("-"):
+        print """Usage:  replay_elos.py [options] [ini file]
+    Recomputes player_elos and player_game_stats.elo_delta from all games,
+    using the current parameters in elo.py.
+    Options:
+        -dry-run        Report the distribution of the rating changes,
+                        without writing anything
+        -resume         Continue an interrupted run from its state file
+        -checkpoint N   Write progress every N games (default 10000)
+        -state FILE     State file (default replay_elos.state)
+        -help           Show this help text
+    The ini file defaults to ../../development.ini
+"""
+        sys.exit(-1)
+    else:
+        ini_file = arg
+
+env = bootstrap(ini_file)
+
+if RESUME:
+    (tables, last_game_id, games_done) = load_state()
+    print "Resuming after game %d (%d games done) ..." % (last_game_id,
+            games_done)
+else:
+    (tables, last_game_id, games_done) = ({}, 0, 0)
+
+if elo.numpy is None:
+    print "NumPy is not installed, large games will be slower to replay."
+
+engine = DBSession.bind
+read_conn = engine.connect()
+write_conn = engine.connect()
+
+deltas = []
+elo_deltas = []
+start = time.time()
+for (game, rows) in stream_games(read_conn, last_game_id):
+    replay_game(tables, game, rows)
+
+    for row in rows:
+        delta = row.get('elo_delta')
+        deltas.append((row['player_game_stat_id'], delta))
+        if DRY_RUN and delta is not None:
+            elo_deltas.append(delta)
+
+    last_game_id = game.game_id
+    games_done += 1
+
+    if games_done % CHECKPOINT == 0:
+        if not DRY_RUN:
+            trans = write_conn.begin()
+            write_elo_deltas(write_conn, deltas)
+            trans.commit()
+            save_state(tables, last_game_id, games_done)
+        deltas = []
+
+        print "%d games replayed, up to game %d (%.0f games/s)" % (games_done,
+                last_game_id, games_done / (time.time() - start))
+
+read_conn.close()
+
+if DRY_RUN:
+    current = {}
+    for pe in DBSession.query(PlayerElo).all():
+        current[(pe.game_type_cd, pe.player_id)] = float(pe.elo)
+
+    changes = []
+    for (game_type_cd, table) in tables.items():
+        for (player_id, elo_value, games) in table.items():
+            old_elo = current.get((game_type_cd, player_id), ELOPARMS.initial)
+            changes.append(elo_value - old_elo)
+
+    print "Replayed %d games in %.1f seconds, nothing was written." % (
+            games_done, time.time() - start)
+    histogram("Elo changes per game (elo_delta):", elo_deltas)
+    histogram("Elo changes per player and game type, against player_elos:",
+            changes)
+else:
+    trans = write_conn.begin()
+    write_elo_deltas(write_conn, deltas)
+    count = write_player_elos(write_conn, tables)
+    trans.commit()
+
+    if os.path.exists(STATE_FILE):
+        os.remove(STATE_FILE)
+
+    print "Replayed %d games in %.1f seconds, wrote %d player Elos." % (
+            games_done, time.time() - start, count)
+
+write_conn.close()
@@ -0,0 +1,105 @@
+#-*- coding: utf-8 -*-
+
+import sys
+import time
+import pyramid.httpexceptions
+from pyramid.paster import bootstrap
+from xonstat.models import *
+from xonstat.spool import spool_from_settings
+from xonstat.views.submission import parse_body, check_preconditions
+from xonstat.views.submission import store_submission, update_ranks
+
+
+# how many spooled submissions to claim at once
+BATCH_SIZE = 50
+
+# seconds to sleep when the spool is empty
+IDLE_SLEEP = 2
+
+# exit when the spool is empty instead of waiting for more
+ONCE = False
+
+
+def apply_submission(spool, settings, submission):
+    """
+    Stores one spooled submission in its own transaction. Games already
+    stored for the same (server, match_id) and submissions that fail the
+    preconditions are dropped from the spool, anything else is retried.
+    """
+    session = DBSession()
+    try:
+        (game_meta, players) = parse_body(submission.body)
+        check_preconditions(settings, game_meta, players)
+        game = store_submission(session=session, idfp=submission.idfp,
+                ip_addr=submission.ip_addr, game_meta=game_meta,
+                players=players)
+        (game_id, game_type_cd) = (game.game_id, game.game_type_cd)
+        session.commit()
+        spool.complete(submission.submission_id)
+
+        update_ranks(session, game_id, game_type_cd)
+        return True
+    except pyramid.httpexceptions.HTTPOk:
+        # duplicate game or nothing worth storing
+        session.rollback()
+        spool.complete(submission.submission_id)
+        return True
+    except pyramid.httpexceptions.HTTPClientError as e:
+        session.rollback()
+        spool.fail(submission.submission_id, str(e), retry=False)
+        return False
+    except Exception as e:
+        session.rollback()
+        spool.fail(submission.submission_id, str(e))
+        return False
+    finally:
+        DBSession.remove()
+
+
+ini_file = '../../development.ini'
+args = sys.argv[1:]
+while len(args) > 0:
+    arg = args.pop(0)
+    if arg == "-once":
+        ONCE = True
+    elif arg == "-batch" and len(args) > 0:
+        BATCH_SIZE = int(args.pop(0))
+    elif arg.startswith("-"):
+        print """Usage:  submission_worker.py [options] [ini file]
+    Stores the submissions spooled by stats/submit when
+    xonstat.async_submissions is enabled.
+    Options:
+        -once       Exit when the spool is empty
+        -batch N    Claim N submissions at a time (default 50)
+        -help       Show this help text
+    The ini file defaults to ../../development.ini
+"""
+        sys.exit(-1)
+    else:
+        ini_file = arg
+
+env = bootstrap(ini_file)
+settings = env['registry'].settings
+spool = spool_from_settings(settings)
+
+print "Draining the submission spool at %s ..." % spool.path
+stored, failed = 0, 0
+while True:
+    submissions = spool.claim(BATCH_SIZE)
+    if len(submissions) == 0:
+        if ONCE:
+            break
+        time.sleep(IDLE_SLEEP)
+        continue
+
+    start = time.time()
+    for submission in submissions:
+        if apply_submission(spool, settings, submission):
+            stored += 1
+        else:
+            failed += 1
+
+    print "Processed %d submissions in %.2f seconds (%d stored, %d failed so far)" % \
+            (len(submissions), time.time() - start, stored, failed)
+
+print "Spool is empty: %s" % spool.counts()
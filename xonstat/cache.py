@@ -0,0 +1,182 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    A size-bounded, thread-safe cache living in the process. Entries expire
+    after ttl seconds (or the ttl given to set() for that entry) and the least
+    recently used entry is dropped once maxsize is reached. A ttl of None
+    means entries never expire.
+
+    Hit and miss counts are kept so callers can report how well it works.
+    """
+    def __init__(self, maxsize=1000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                (value, expires) = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expires is not None and expires < time.time():
+                self.misses += 1
+                return default
+
+            # re-insert to mark it as the most recently used
+            self._data[key] = (value, expires)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+
+        if ttl is None:
+            expires = None
+        else:
+            expires = time.time() + ttl
+
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expires)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def hit_rate(self):
+        try:
+            return float(self.hits)/(self.hits + self.misses)
+        except ZeroDivisionError:
+            return 0.0
+
+    def stats(self):
+        return {'size':len(self._data), 'maxsize':self.maxsize,
+                'hits':self.hits, 'misses':self.misses,
+                'hit_rate':self.hit_rate()}
+
+
+class CachedValue(object):
+    """
+    A single value computed by compute(), kept for ttl seconds. Once it is
+    stale, one caller recomputes it while the others keep getting the stale
+    value, so an expensive value is never computed by several threads at
+    once. Only when there is no value at all do callers wait for it.
+
+    With start_refresher() a background thread recomputes the value every
+    ttl seconds instead, and callers never wait after the first time.
+    """
+    def __init__(self, compute, ttl=60):
+        self.compute = compute
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._value = None
+        self._computed_at = None
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._refresher = None
+
+    def get(self):
+        now = time.time()
+        with self._lock:
+            computed_at = self._computed_at
+            value = self._value
+            if computed_at is not None and now - computed_at < self.ttl:
+                self.hits += 1
+                return value
+            self.misses += 1
+
+        if computed_at is None:
+            # nothing to fall back on, wait for whoever is computing it
+            with self._refresh_lock:
+                if self._computed_at is None:
+                    self._refresh()
+                return self._value
+
+        # stale: refresh it unless someone already is (or the background
+        # refresher will)
+        if self._refresher is None and self._refresh_lock.acquire(False):
+            try:
+                self._refresh()
+            finally:
+                self._refresh_lock.release()
+            return self._value
+
+        return value
+
+    def _refresh(self):
+        value = self.compute()
+        with self._lock:
+            self._value = value
+            self._computed_at = time.time()
+
+    def refresh(self):
+        """Recomputes the value now."""
+        with self._refresh_lock:
+            self._refresh()
+
+    def invalidate(self):
+        """Makes the value stale, it is recomputed by the next get()."""
+        with self._lock:
+            if self._computed_at is not None:
+                self._computed_at = 0
+
+    def age(self):
+        """Seconds since the value was computed, or None."""
+        if self._computed_at is None:
+            return None
+        return time.time() - self._computed_at
+
+    def start_refresher(self, on_error=None, cleanup=None):
+        """
+        Starts a daemon thread recomputing the value every ttl seconds.
+        Errors are passed to on_error and the old value is kept. cleanup is
+        called in the thread after each refresh.
+        """
+        def refresh_forever():
+            while True:
+                try:
+                    self.refresh()
+                except Exception as e:
+                    if on_error is not None:
+                        on_error(e)
+                finally:
+                    if cleanup is not None:
+                        cleanup()
+                time.sleep(self.ttl)
+
+        if self._refresher is None:
+            self._refresher = threading.Thread(target=refresh_forever,
+                    name="CachedValue refresher")
+            self._refresher.daemon = True
+            self._refresher.start()
+
+    def hit_rate(self):
+        try:
+            return float(self.hits)/(self.hits + self.misses)
+        except ZeroDivisionError:
+            return 0.0
+
+    def stats(self):
+        return {'age':self.age(), 'ttl':self.ttl, 'hits':self.hits,
+                'misses':self.misses, 'hit_rate':self.hit_rate()}
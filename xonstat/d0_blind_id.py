@@ -1,8 +1,16 @@
-import subprocess
-import os
-import fcntl
+import Queue
+import atexit
 import base64
+import fcntl
+import logging
+import os
 import select
+import struct
+import subprocess
+import sys
+import time
+
+log = logging.getLogger(__name__)
 
 d0_blind_id_keygen = "./crypto-keygen-standalone"
 d0_blind_id_d0pk = "key_0.d0pk"
@@ -83,7 +91,209 @@ def d0_blind_id_verify(sig, querystring, postdata=None): #-> (idfp, status)
 			return (None, None)
 		return (idfp, (status == "1"))
 
+# Resident verifier pool
+#
+# Forking the keygen binary from a large web worker is expensive, so a few
+# small helper processes (this file run with --serve) are kept around. They
+# receive verification requests over a framed stdin/stdout protocol and do
+# the actual verification. Each frame is a field count followed by the
+# length-prefixed fields; a length of _NONE_FIELD encodes None.
+
+_NONE_FIELD = 0xFFFFFFFF
+
+class VerifierUnavailable(Exception):
+	pass
+
+class VerifierError(Exception):
+	pass
+
+def _write_frame(f, fields):
+	parts = [struct.pack("!I", len(fields))]
+	for field in fields:
+		if field is None:
+			parts.append(struct.pack("!I", _NONE_FIELD))
+		else:
+			parts.append(struct.pack("!I", len(field)))
+			parts.append(field)
+	f.write("".join(parts))
+	f.flush()
+
+def _read_exactly(f, n):
+	data = f.read(n)
+	if len(data) != n:
+		raise EOFError("verifier stream closed")
+	return data
+
+def _read_frame(f):
+	(count, ) = struct.unpack("!I", _read_exactly(f, 4))
+	fields = []
+	for i in range(count):
+		(size, ) = struct.unpack("!I", _read_exactly(f, 4))
+		if size == _NONE_FIELD:
+			fields.append(None)
+		else:
+			fields.append(_read_exactly(f, size))
+	return fields
+
+def d0_blind_id_serve(infile, outfile):
+	"""Request loop of a resident verifier worker. Runs until stdin closes."""
+	while True:
+		try:
+			request = _read_frame(infile)
+		except EOFError:
+			break
+
+		if request[0] == "ping":
+			_write_frame(outfile, ["pong"])
+			continue
+
+		(op, sig, querystring, postdata) = request
+		try:
+			result = d0_blind_id_verify(sig, querystring, postdata)
+		except Exception, e:
+			_write_frame(outfile, ["error", str(e)])
+			continue
+
+		if result is None:
+			(idfp, status) = (None, None)
+		else:
+			(idfp, status) = result
+		if status is not None:
+			status = "1" if status else "0"
+		_write_frame(outfile, ["ok", idfp, status])
+
+class VerifierWorker:
+	def __init__(self):
+		script = os.path.splitext(os.path.abspath(__file__))[0] + ".py"
+		self.proc = subprocess.Popen([sys.executable, script, "--serve"],
+				stdin=subprocess.PIPE, stdout=subprocess.PIPE, close_fds=True)
+		self.last_used = time.time()
+
+	def alive(self):
+		return self.proc.poll() is None
+
+	def call(self, fields, timeout):
+		_write_frame(self.proc.stdin, fields)
+		(readers, writers, errorers) = select.select([self.proc.stdout], [], [], timeout)
+		if not readers:
+			raise VerifierUnavailable("verifier worker %d timed out" % self.proc.pid)
+		response = _read_frame(self.proc.stdout)
+		self.last_used = time.time()
+		return response
+
+	def ping(self, timeout):
+		try:
+			return self.call(["ping"], timeout) == ["pong"]
+		except Exception:
+			return False
+
+	def close(self):
+		try:
+			self.proc.stdin.close()
+			if self.alive():
+				self.proc.kill()
+			self.proc.wait()
+		except Exception:
+			pass
+
+class VerifierPool:
+	"""
+	A fixed number of resident verifier workers. Workers that died or fail
+	their health check are restarted when they are checked out; a worker that
+	times out or breaks the protocol is killed and replaced.
+	"""
+	def __init__(self, size=2, timeout=10, health_interval=60):
+		self.size = size
+		self.timeout = timeout
+		self.health_interval = health_interval
+		self.idle = Queue.Queue()
+		for i in range(size):
+			self.idle.put(VerifierWorker())
+
+	def _healthy(self, worker):
+		if not worker.alive():
+			return False
+		if time.time() - worker.last_used > self.health_interval:
+			return worker.ping(self.timeout)
+		return True
+
+	def _checkout(self):
+		try:
+			worker = self.idle.get(timeout=self.timeout)
+		except Queue.Empty:
+			raise VerifierUnavailable("no idle verifier worker")
+
+		if self._healthy(worker):
+			return worker
+
+		log.warn("Restarting verifier worker {0}".format(worker.proc.pid))
+		worker.close()
+		try:
+			return VerifierWorker()
+		except Exception, e:
+			# keep the slot so that a later checkout retries the restart
+			self.idle.put(worker)
+			raise VerifierUnavailable("could not restart verifier worker: %s" % e)
+
+	def verify(self, sig, querystring, postdata=None): #-> (idfp, status)
+		worker = self._checkout()
+		try:
+			response = worker.call(["verify", sig, querystring, postdata], self.timeout)
+		except Exception:
+			# the worker is in an unknown state, it is replaced on next checkout
+			worker.close()
+			self.idle.put(worker)
+			raise
+		self.idle.put(worker)
+
+		if response[0] != "ok":
+			raise VerifierError(response[1])
+
+		(idfp, status) = response[1:]
+		if status is not None:
+			status = (status == "1")
+		return (idfp, status)
+
+	def close(self):
+		while True:
+			try:
+				self.idle.get_nowait().close()
+			except Queue.Empty:
+				break
+
+_verifier_pool = None
+
+def start_verifier_pool(size, timeout=10):
+	"""Start the resident verifier pool. A size of 0 disables it."""
+	global _verifier_pool
+	if size <= 0:
+		return None
+	try:
+		_verifier_pool = VerifierPool(size=size, timeout=timeout)
+		atexit.register(_verifier_pool.close)
+		log.info("Started {0} resident signature verifiers".format(size))
+	except Exception, e:
+		log.warn("Could not start the verifier pool: {0}".format(e))
+		_verifier_pool = None
+	return _verifier_pool
+
+def d0_blind_id_verify_pooled(sig, querystring, postdata=None): #-> (idfp, status)
+	"""
+	Verify using the resident pool, falling back to a one-shot keygen process
+	when the pool is disabled or unavailable.
+	"""
+	if _verifier_pool is not None:
+		try:
+			return _verifier_pool.verify(sig, querystring, postdata)
+		except Exception, e:
+			log.warn("Verifier pool failed, using one-shot verification: {0}".format(e))
+	return d0_blind_id_verify(sig, querystring, postdata)
+
 if __name__ == "__main__":
+	if sys.argv[1:] == ["--serve"]:
+		d0_blind_id_serve(sys.stdin, sys.stdout)
+		sys.exit(0)
+
 	sig = "gQEBERjDsnVNr4qrYkvaevguF4ypPZHq0yiXfMMKwlu7+kY3HuI8zHx2WhiYj+q26re5uamQ9r8umh54CEJ7zqZAz8IavVblWYznzee9WjIBAB1FeHwILGlKOCDpGBikoZBkMxI4MqjCPzDPAkDMrd1DK0FsWOTpWljLgNGfACTKcgKBAQGPqnGoD6GhuHLYN+Sf73ROColneBdJ7ttuVwm32FvI8LuD5aLDll7bpqfHTWhgbTW02CYvkTAYtoz2RZmIGK5ZHHaM/V6vcSXnq2ab/7mFRiag7D5OUsmIFY9E3IqcqtP7+wXSVgiNFY3DBPy27bXjk8ZJ9nUD5dQBL9sG8TzWd4EBAYrTMfF82EBgsVArIaQjeOuJC3bkPzP5b3El/ZCHkDShpu7wZ82h/82B4W5Ep3KXpgu+YAEULt+5i2WbsfRSXeVZctzD4A++MBqQx9VuN/KsxgHS/20tRiBgd1VElhRD8KJ0lbkxYNcHSkpWSMDFS+eFmizcM3/XQNQ7ukAmM3lkgQEBIZR+FpDFLoGg9mIu2RH9O7lWdifpVhqjrEnvkr4KdB6JzBXAwVPmt1NAVDjGRI/ELlTysOx1b9F2EgdJejY5LgcVxz6irwEckx0z+L10A6Ca2lsGR1E+rViFffNNIJv34dNKgaCInyUNCeBei0AF8KLXLHhRTiBvSVBi6ANb/lY="
 	querystring = ""
 	postdata = "hello world"
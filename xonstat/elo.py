@@ -4,6 +4,15 @@ import random
 import sys
 from xonstat.models import *
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# below this many players the pairwise loop beats setting up the matrices
+# (see xonstat/batch/bench_elo.py)
+NUMPY_MIN_PLAYERS = 10
+
 
 log = logging.getLogger(__name__)
 
@@ -42,10 +51,67 @@ class KReduction:
         return k
 
 
-def process_elos(game, session, game_type_cd=None):
+def process_elos(game, session, game_type_cd=None, pgstats=None):
+    """
+    Updates the Elo of the players in a game and records each player's
+    elo_delta.
+
+    pgstats is an optional list of the game's player_game_stats rows as
+    dictionaries (see create_player_game_stat), before they are written.
+    When given, the scores and alivetimes are read from it and elo_delta is
+    set on the rows themselves, so the only query is for the players'
+    PlayerElo. Otherwise the game's stats are read from the database.
+    """
     if game_type_cd is None:
         game_type_cd = game.game_type_cd
 
+    if pgstats is None:
+        (duration, scores, alivetimes) = game_scores(game, session)
+    else:
+        (duration, scores, alivetimes) = pgstat_scores(pgstats)
+
+    player_ids = scores.keys()
+
+    elos = {}
+    for e in session.query(PlayerElo).\
+            filter(PlayerElo.player_id.in_(player_ids)).\
+            filter(PlayerElo.game_type_cd==game_type_cd).all():
+                elos[e.player_id] = e
+
+    # ensure that all player_ids have an elo record
+    for pid in player_ids:
+        if pid not in elos.keys():
+            elos[pid] = PlayerElo(pid, game_type_cd, ELOPARMS.initial)
+
+    apply_k_reduction(elos, scores, alivetimes, duration)
+
+    elos = update_elos(game, session, elos, scores, ELOPARMS, pgstats)
+
+    # add the elos to the session for committing
+    for e in elos:
+        session.add(elos[e])
+
+
+def apply_k_reduction(elos, scores, alivetimes, duration):
+    """
+    Sets the K factor of each player's Elo for a game of the given duration.
+    Players whose K comes out as zero are removed from all three
+    dictionaries, their Elo doesn't change.
+    """
+    for pid in elos.keys():
+        elos[pid].k = KREDUCTION.eval(elos[pid].games, alivetimes[pid],
+                duration)
+        if elos[pid].k == 0:
+            del(elos[pid])
+            del(scores[pid])
+            del(alivetimes[pid])
+
+
+def game_scores(game, session):
+    """
+    Returns the duration of a stored game along with the per-second scores
+    and alivetimes of its tracked players, keyed by player_id.
+    """
     # we do not have the actual duration of the game, so use the 
     # maximum alivetime of the players instead
     duration = 0
@@ -66,38 +132,34 @@ def process_elos(game, session, game_type_cd=None):
                 scores[p] = s/float(a.seconds)
                 alivetimes[p] = a.seconds
 
-    player_ids = scores.keys()
-
-    elos = {}
-    for e in session.query(PlayerElo).\
-            filter(PlayerElo.player_id.in_(player_ids)).\
-            filter(PlayerElo.game_type_cd==game_type_cd).all():
-                elos[e.player_id] = e
-
-    # ensure that all player_ids have an elo record
-    for pid in player_ids:
-        if pid not in elos.keys():
-            elos[pid] = PlayerElo(pid, game_type_cd, ELOPARMS.initial)
+    return (duration, scores, alivetimes)
 
-    for pid in player_ids:
-        elos[pid].k = KREDUCTION.eval(elos[pid].games, alivetimes[pid],
-                duration)
-        if elos[pid].k == 0:
-            del(elos[pid])
-            del(scores[pid])
-            del(alivetimes[pid])
 
-    elos = update_elos(game, session, elos, scores, ELOPARMS)
+def pgstat_scores(pgstats):
+    """
+    Same as game_scores, from the player_game_stats rows of a game that
+    hasn't been written yet.
+    """
+    duration = 0
+    scores = {}
+    alivetimes = {}
+    for pgstat in pgstats:
+        a = pgstat['alivetime']
+        duration = max(duration, a.seconds)
 
-    # add the elos to the session for committing
-    for e in elos:
-        session.add(elos[e])
+        if a > timedelta(seconds=0) and pgstat['player_id'] > 2:
+            # scores are per second
+            scores[pgstat['player_id']] = pgstat['score']/float(a.seconds)
+            alivetimes[pgstat['player_id']] = a.seconds
 
+    return (duration, scores, alivetimes)
 
-def update_elos(game, session, elos, scores, ep):
-    if len(elos) < 2:
-        return elos
 
+def elo_adjustments(game_type_cd, elos, scores, ep):
+    """
+    Compares every pair of players and returns the sum of each player's
+    adjustments (before K is applied), keyed by player_id.
+    """
     pids = elos.keys()
 
     eloadjust = {}
@@ -123,7 +185,7 @@ def update_elos(game, session, elos, scores, ep):
 
             # duels are done traditionally - a win nets
             # full points, not the score factor
-            if game.game_type_cd == 'duel':
+            if game_type_cd == 'duel':
                 # player i won
                 if scorefactor_real > 0.5:
                     scorefactor_real = 1.0
@@ -170,6 +232,88 @@ def update_elos(game, session, elos, scores, ep):
             eloadjust[ei.player_id] += adjustmenti
             eloadjust[ej.player_id] += adjustmentj
 
+    return eloadjust
+
+
+def elo_adjustments_numpy(game_type_cd, elos, scores, ep):
+    """
+    Same as elo_adjustments, with the pairs compared all at once as
+    matrices. Entry [i, j] is player i against player j, and only the upper
+    triangle (i < j) counts, as in the pairwise loop.
+    """
+    pids = elos.keys()
+    n = len(pids)
+
+    s = numpy.array([scores[elos[pid].player_id] for pid in pids], dtype=float)
+    e = numpy.array([float(elos[pid].elo) for pid in pids], dtype=float)
+
+    si = numpy.repeat(s[:, numpy.newaxis], n, axis=1)
+    sj = numpy.repeat(s[numpy.newaxis, :], n, axis=0)
+
+    # normalize scores
+    ofs = numpy.minimum(0, numpy.minimum(si, sj))
+    si -= ofs
+    sj -= ofs
+    draw = (si + sj) == 0
+    si[draw] = 1
+    sj[draw] = 1
+
+    # real score factor
+    scorefactor_real = si / (si + sj)
+
+    # duels are done traditionally - a win nets
+    # full points, not the score factor
+    if game_type_cd == 'duel':
+        scorefactor_real = numpy.where(scorefactor_real > 0.5, 1.0,
+                numpy.where(scorefactor_real < 0.5, 0.0, scorefactor_real))
+
+    # expected score factor by elo
+    elodiff = numpy.clip((e[:, numpy.newaxis] - e[numpy.newaxis, :]) *
+            ep.logdistancefactor, -ep.maxlogdistance, ep.maxlogdistance)
+    scorefactor_elo = 1 / (1 + numpy.exp(-elodiff))
+
+    # initial adjustment values, which we may modify with additional rules
+    adjustmenti = scorefactor_real - scorefactor_elo
+    adjustmentj = scorefactor_elo - scorefactor_real
+
+    i_expected = scorefactor_elo > 0.5
+    won = scorefactor_real > 0.5
+
+    # player i is expected to win: if he did, he never loses points,
+    # otherwise he loses less points the closer it was
+    adjustmenti = numpy.where(i_expected & won,
+            numpy.maximum(0, adjustmenti), adjustmenti)
+    adjustmenti = numpy.where(i_expected & ~won,
+            (2 * scorefactor_real - 1) * scorefactor_elo, adjustmenti)
+
+    # player j is expected to win: the same the other way around
+    adjustmentj = numpy.where(~i_expected & won,
+            (1 - 2 * scorefactor_real) * (1 - scorefactor_elo), adjustmentj)
+    adjustmentj = numpy.where(~i_expected & ~won,
+            numpy.maximum(0, adjustmentj), adjustmentj)
+
+    pairs = numpy.triu(numpy.ones((n, n), dtype=bool), 1)
+    totals = numpy.where(pairs, adjustmenti, 0).sum(axis=1) + \
+            numpy.where(pairs, adjustmentj, 0).sum(axis=0)
+
+    eloadjust = {}
+    for (index, pid) in enumerate(pids):
+        eloadjust[pid] = float(totals[index])
+
+    return eloadjust
+
+
+def update_elos(game, session, elos, scores, ep, pgstats=None):
+    if len(elos) < 2:
+        return elos
+
+    pids = elos.keys()
+
+    if numpy is not None and len(elos) >= NUMPY_MIN_PLAYERS:
+        eloadjust = elo_adjustments_numpy(game.game_type_cd, elos, scores, ep)
+    else:
+        eloadjust = elo_adjustments(game.game_type_cd, elos, scores, ep)
+
     elo_deltas = {}
     for pid in pids:
         old_elo = float(elos[pid].elo)
@@ -181,7 +325,12 @@ def update_elos(game, session, elos, scores, ep):
 
         log.debug("Setting Player {0}'s Elo delta to {1}. Elo is now {2} (was {3}).".format(pid, elo_deltas[pid], new_elo, old_elo))
 
-    save_elo_deltas(game, session, elo_deltas)
+    if pgstats is None:
+        save_elo_deltas(game, session, elo_deltas)
+    else:
+        for pgstat in pgstats:
+            if pgstat['player_id'] in elo_deltas:
+                pgstat['elo_delta'] = elo_deltas[pgstat['player_id']]
 
     return elos
 
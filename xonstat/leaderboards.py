@@ -0,0 +1,74 @@
+import logging
+import sqlalchemy.sql.expression as expr
+from calendar import timegm
+from collections import namedtuple
+from xonstat.models import *
+from xonstat.util import html_colors, pretty_date
+
+log = logging.getLogger(__name__)
+
+# The queries behind the leaderboards and recent games lists of the main,
+# server and map pages. They select only the columns the pages show, let the
+# database apply the LIMIT and return plain tuples instead of ORM instances,
+# so a busy server or map costs no more than a quiet one.
+
+
+def leaderboard(session, columns, value, filters=(), count=10):
+    """
+    Groups by columns and returns the count groups with the highest value,
+    as (column..., value) tuples. filters are SQL expressions the rows have
+    to match, which also join the tables involved.
+    """
+    query = session.query(*(list(columns) + [value]))
+    for criterion in filters:
+        query = query.filter(criterion)
+    for column in columns:
+        query = query.group_by(column)
+
+    return query.order_by(expr.desc(value)).limit(count).all()
+
+
+class RecentGame(namedtuple('RecentGame', ['game_id', 'game_type_cd',
+        'start_dt', 'server_id', 'server_name', 'map_id', 'map_name',
+        'player_id', 'nick'])):
+    """
+    A game in a recent games list, along with its server, map and winner
+    (the player ranked first).
+    """
+    __slots__ = ()
+
+    def fuzzy_date(self):
+        return pretty_date(self.start_dt)
+
+    def epoch(self):
+        return timegm(self.start_dt.timetuple())
+
+    def nick_html_colors(self):
+        if self.nick is None:
+            return "Anonymous Player"
+        else:
+            return html_colors(self.nick)
+
+
+def recent_games(session, count, server_id=None, map_id=None, since=None):
+    """
+    The count most recently started games, optionally on one server or
+    map, or created after since, as a list of RecentGame.
+    """
+    query = session.query(Game.game_id, Game.game_type_cd, Game.start_dt,
+            Server.server_id, Server.name, Map.map_id, Map.name,
+            PlayerGameStat.player_id, PlayerGameStat.nick).\
+            filter(Game.server_id == Server.server_id).\
+            filter(Game.map_id == Map.map_id).\
+            filter(PlayerGameStat.game_id == Game.game_id).\
+            filter(PlayerGameStat.rank == 1)
+
+    if server_id is not None:
+        query = query.filter(Game.server_id == server_id)
+    if map_id is not None:
+        query = query.filter(Game.map_id == map_id)
+    if since is not None:
+        query = query.filter(Game.create_dt > since)
+
+    return [RecentGame(*row) for row in
+            query.order_by(expr.desc(Game.start_dt)).limit(count).all()]
@@ -5,6 +5,7 @@ import sqlalchemy
 import sqlalchemy.sql.functions as sfunc
 from calendar import timegm
 from datetime import timedelta
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.orm import mapper
 from sqlalchemy.orm import scoped_session
 from sqlalchemy.orm import sessionmaker
@@ -243,6 +244,133 @@ class PlayerRank(object):
         return {'player_id':self.player_id, 'game_type_cd':self.game_type_cd, 'rank':self.rank}
 
 
+class PlayerRankSummary(Base):
+    """
+    The number of ranked players and the highest (worst) rank of each game
+    type, kept up to date along with player_ranks (see xonstat.ranks).
+    """
+    __tablename__ = 'player_rank_summary'
+
+    game_type_cd = sqlalchemy.Column(sqlalchemy.String(10), primary_key=True)
+    max_rank = sqlalchemy.Column(sqlalchemy.Integer, nullable=False, default=0)
+    player_count = sqlalchemy.Column(sqlalchemy.Integer, nullable=False,
+            default=0)
+    update_dt = sqlalchemy.Column(sqlalchemy.DateTime, nullable=False,
+            default=sfunc.now(), onupdate=sfunc.now())
+
+    def __repr__(self):
+        return "<PlayerRankSummary(gametype=%s, max_rank=%s, players=%s)>" % (self.game_type_cd, self.max_rank, self.player_count)
+
+    def to_dict(self):
+        return {'game_type_cd':self.game_type_cd, 'max_rank':self.max_rank, 'player_count':self.player_count}
+
+
+class PlayerDailyStat(Base):
+    """
+    A player's games, alivetime and score per day, server and map, kept up
+    to date as games are stored (see xonstat.rollups).
+    """
+    __tablename__ = 'player_daily_stats'
+    __table_args__ = (
+        sqlalchemy.Index('player_daily_stats_server_ix', 'server_id', 'stat_date'),
+        sqlalchemy.Index('player_daily_stats_map_ix', 'map_id', 'stat_date'),
+    )
+
+    stat_date = sqlalchemy.Column(sqlalchemy.Date, primary_key=True)
+    player_id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True,
+            autoincrement=False)
+    server_id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True,
+            autoincrement=False)
+    map_id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True,
+            autoincrement=False)
+    games = sqlalchemy.Column(sqlalchemy.Integer, nullable=False, default=0)
+    alivetime = sqlalchemy.Column(sqlalchemy.Interval, nullable=False)
+    score = sqlalchemy.Column(sqlalchemy.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return "<PlayerDailyStat(%s, pid=%s, sid=%s, mid=%s)>" % (self.stat_date, self.player_id, self.server_id, self.map_id)
+
+
+class ServerMapDailyStat(Base):
+    """
+    The number of games per day, server and map (see xonstat.rollups).
+    """
+    __tablename__ = 'server_map_daily_stats'
+    __table_args__ = (
+        sqlalchemy.Index('server_map_daily_stats_map_ix', 'map_id', 'stat_date'),
+    )
+
+    stat_date = sqlalchemy.Column(sqlalchemy.Date, primary_key=True)
+    server_id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True,
+            autoincrement=False)
+    map_id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True,
+            autoincrement=False)
+    games = sqlalchemy.Column(sqlalchemy.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return "<ServerMapDailyStat(%s, sid=%s, mid=%s)>" % (self.stat_date, self.server_id, self.map_id)
+
+
+class PlayerCareerStat(Base):
+    """
+    A player's career totals per game type and map, kept up to date as games
+    are stored (see xonstat.player_profile). The totals are NULL where all of
+    the player's games left them NULL, like SUM over player_game_stats.
+    """
+    __tablename__ = 'player_career_stats'
+
+    player_id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True,
+            autoincrement=False)
+    game_type_cd = sqlalchemy.Column(sqlalchemy.String(10), primary_key=True)
+    map_id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True,
+            autoincrement=False)
+    games = sqlalchemy.Column(sqlalchemy.Integer, nullable=False, default=0)
+    wins = sqlalchemy.Column(sqlalchemy.Integer, nullable=False, default=0)
+    kills = sqlalchemy.Column(sqlalchemy.Integer)
+    deaths = sqlalchemy.Column(sqlalchemy.Integer)
+    last_played = sqlalchemy.Column(sqlalchemy.DateTime)
+    alivetime = sqlalchemy.Column(sqlalchemy.Interval)
+    pickups = sqlalchemy.Column(sqlalchemy.Integer)
+    captures = sqlalchemy.Column(sqlalchemy.Integer)
+    carrier_frags = sqlalchemy.Column(sqlalchemy.Integer)
+
+    def __repr__(self):
+        return "<PlayerCareerStat(pid=%s, %s, mid=%s)>" % (self.player_id, self.game_type_cd, self.map_id)
+
+
+def _array(item_type):
+    """
+    An ARRAY column type on PostgreSQL. Elsewhere, as in the SQLite
+    benchmarks, the column is created as TEXT and goes unused.
+    """
+    return sqlalchemy.Text().with_variant(postgresql.ARRAY(item_type),
+            'postgresql')
+
+
+class PlayerWeaponSeries(Base):
+    """
+    A player's career totals with a weapon, and the values of their last
+    games with it (at most xonstat.weapon_series.series_length, oldest
+    first), kept up to date as games are stored (see xonstat.weapon_series).
+    """
+    __tablename__ = 'player_weapon_series'
+
+    player_id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True,
+            autoincrement=False)
+    weapon_cd = sqlalchemy.Column(sqlalchemy.String(15), primary_key=True)
+    games = sqlalchemy.Column(sqlalchemy.Integer, nullable=False, default=0)
+    fired = sqlalchemy.Column(sqlalchemy.BigInteger, nullable=False, default=0)
+    hit = sqlalchemy.Column(sqlalchemy.BigInteger, nullable=False, default=0)
+    actual = sqlalchemy.Column(sqlalchemy.BigInteger, nullable=False, default=0)
+    game_ids = sqlalchemy.Column(_array(sqlalchemy.BigInteger), nullable=False)
+    fireds = sqlalchemy.Column(_array(sqlalchemy.Integer), nullable=False)
+    hits = sqlalchemy.Column(_array(sqlalchemy.Integer), nullable=False)
+    actuals = sqlalchemy.Column(_array(sqlalchemy.Integer), nullable=False)
+
+    def __repr__(self):
+        return "<PlayerWeaponSeries(pid=%s, %s)>" % (self.player_id, self.weapon_cd)
+
+
 def initialize_db(engine=None):
     DBSession.configure(bind=engine)
     Base.metadata.bind = engine
@@ -0,0 +1,262 @@
+import base64
+import json
+import logging
+import pyramid.httpexceptions
+import sqlalchemy.sql.expression as expr
+import sqlalchemy.types
+from xonstat.cache import LRUCache
+
+log = logging.getLogger(__name__)
+
+# Total row counts of the listings, by a key the view picks. Counting all
+# games on every request was most of the cost of the game index, and the
+# pages only show the total as an indication.
+count_cache = LRUCache(maxsize=1000, ttl=300)
+
+# Page numbers are served with an OFFSET, whose cost grows with the page.
+# They are only accepted up to this page, further pages are reached with
+# the before/after cursors.
+max_offset_page = 10
+
+
+def configure_pagination(settings):
+    """
+    Reads the listing settings: how long counts are cached
+    (xonstat.listing_count_ttl, in seconds) and the last page reachable by
+    number (xonstat.max_offset_page).
+    """
+    global count_cache, max_offset_page
+
+    try:
+        count_ttl = int(settings['xonstat.listing_count_ttl'])
+    except:
+        count_ttl = 300
+
+    try:
+        max_offset_page = int(settings['xonstat.max_offset_page'])
+    except:
+        max_offset_page = 10
+
+    count_cache = LRUCache(maxsize=1000, ttl=count_ttl)
+
+
+def cached_count(key, query):
+    """
+    The number of rows query returns, counted at most once per
+    xonstat.listing_count_ttl seconds for the same key.
+    """
+    count = count_cache.get(key)
+    if count is None:
+        count = query.order_by(None).count()
+        count_cache.set(key, count)
+    return count
+
+
+def encode_cursor(key):
+    """Turns a (sort value, ..., id) tuple into an opaque URL-safe token."""
+    return base64.urlsafe_b64encode(json.dumps(list(key),
+        separators=(',', ':'))).rstrip('=')
+
+
+# the values the integer column types hold, smallest type first
+_integer_ranges = ((sqlalchemy.types.SmallInteger, 2**15),
+        (sqlalchemy.types.BigInteger, 2**63),
+        (sqlalchemy.types.Integer, 2**31))
+
+
+def _fits(column, value):
+    """Whether a value from a cursor can be compared with column."""
+    if hasattr(column, '__clause_element__'):
+        column = column.__clause_element__()
+
+    if isinstance(column.type, sqlalchemy.types.Integer):
+        if isinstance(value, bool) or not isinstance(value, (int, long)):
+            return False
+        for (type_, limit) in _integer_ranges:
+            if isinstance(column.type, type_):
+                return -limit <= value < limit
+
+    if isinstance(column.type, sqlalchemy.types.String):
+        return isinstance(value, basestring)
+
+    return isinstance(value, (int, long, float)) and \
+            not isinstance(value, bool)
+
+
+def decode_cursor(token, columns):
+    """
+    Turns a token made by encode_cursor back into a list of values of
+    columns, or returns None if it isn't one: it doesn't decode, or a value
+    isn't of its column's type or is out of its range.
+    """
+    try:
+        token = str(token)
+        key = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    except (TypeError, ValueError, UnicodeError):
+        return None
+
+    if not isinstance(key, list) or len(key) != len(columns):
+        return None
+    for (column, value) in zip(columns, key):
+        if not _fits(column, value):
+            return None
+    return key
+
+
+def _beyond(columns, key, descending):
+    """The rows after key in the listing order."""
+    if len(columns) == 1:
+        if descending:
+            return columns[0] < key[0]
+        return columns[0] > key[0]
+
+    left = expr.tuple_(*columns)
+    right = expr.tuple_(*[expr.literal(value) for value in key])
+    if descending:
+        return left < right
+    return left > right
+
+
+class CursorPage(object):
+    """
+    A page of a listing ordered by one or more sort columns ending in a
+    unique id column, e.g. (rank, player_id). Pages are addressed by a
+    cursor, the key of the row they continue from, instead of an OFFSET, so
+    a page deep into the listing costs as much as the first:
+
+    after - a cursor token, the page is the rows following that row
+    before - a cursor token, the page is the rows preceding that row
+    page - without a cursor, this page number is served with an OFFSET,
+        up to max_offset_page
+
+    query - the listing query, its ORDER BY is replaced
+    columns - the sort columns, the last being unique
+    key_of - returns the values of the sort columns for an item (a row of
+        query), as a tuple
+    descending - whether the listing is in descending order
+    item_count - the total number of items, if known (see cached_count)
+
+    The page is iterable. next_cursor and previous_cursor are the after
+    and before tokens of the neighbouring pages, or None when there is no
+    such page. page is the page number when it is known.
+    """
+    def __init__(self, query, columns, key_of, descending=True,
+            before=None, after=None, page=1, items_per_page=10,
+            item_count=None):
+        self.items_per_page = items_per_page
+        self.item_count = item_count
+
+        if before is not None:
+            before = decode_cursor(before, columns)
+        if after is not None:
+            after = decode_cursor(after, columns)
+
+        query = query.order_by(None)
+        if before is not None:
+            # walk backwards from the cursor, then put the rows back in order
+            if descending:
+                query = query.order_by(*[column.asc() for column in columns])
+            else:
+                query = query.order_by(*[column.desc() for column in columns])
+            items = query.filter(_beyond(columns, before, not descending)).\
+                    limit(items_per_page + 1).all()
+            has_previous = len(items) > items_per_page
+            items = items[:items_per_page]
+            items.reverse()
+            has_next = True
+            self.page = None
+        else:
+            if descending:
+                query = query.order_by(*[column.desc() for column in columns])
+            else:
+                query = query.order_by(*[column.asc() for column in columns])
+            if after is not None:
+                query = query.filter(_beyond(columns, after, descending))
+                has_previous = True
+                self.page = None
+            else:
+                page = max(page, 1)
+                query = query.offset((page - 1) * items_per_page)
+                has_previous = page > 1
+                self.page = page
+            items = query.limit(items_per_page + 1).all()
+            has_next = len(items) > items_per_page
+            items = items[:items_per_page]
+
+        self.items = items
+
+        if len(items) > 0 and has_previous:
+            self.previous_cursor = encode_cursor(key_of(items[0]))
+        else:
+            self.previous_cursor = None
+
+        if len(items) > 0 and has_next:
+            self.next_cursor = encode_cursor(key_of(items[-1]))
+        else:
+            self.next_cursor = None
+
+    @classmethod
+    def from_request(cls, request, query, columns, key_of, **kwargs):
+        """
+        Builds the page asked for by the before, after and page parameters
+        of a request. A page number in the route takes precedence over the
+        query string. Page numbers past max_offset_page are not found.
+        """
+        try:
+            page = int((request.matchdict or {}).get('page') or
+                    request.params.get('page') or 1)
+        except ValueError:
+            page = 1
+
+        before = request.params.get('before')
+        after = request.params.get('after')
+
+        if before is None and after is None and page > max_offset_page:
+            raise pyramid.httpexceptions.HTTPNotFound(
+                    "Use the next and previous links past page {0}".format(
+                        max_offset_page))
+
+        return cls(query, columns, key_of, before=before, after=after,
+                page=page, **kwargs)
+
+    def page_count(self):
+        """
+        The number of pages reachable by number, as far as the item count
+        tells, or None without a count.
+        """
+        if self.item_count is None:
+            return None
+        pages = (self.item_count + self.items_per_page - 1) // \
+                self.items_per_page
+        return max(min(pages, max_offset_page), 1)
+
+    def add_link_header(self, request):
+        """
+        Adds the URLs of the neighbouring pages to the response as a Link
+        header (rel="prev" and rel="next"), for JSON views.
+        """
+        query = dict((key, value) for (key, value) in request.GET.items()
+                if key not in ('before', 'after', 'page'))
+
+        links = []
+        if self.previous_cursor is not None:
+            links.append('<{0}>; rel="prev"'.format(request.current_route_url(
+                _query=dict(query, before=self.previous_cursor))))
+        if self.next_cursor is not None:
+            links.append('<{0}>; rel="next"'.format(request.current_route_url(
+                _query=dict(query, after=self.next_cursor))))
+
+        if len(links) > 0:
+            request.response.headers['Link'] = ', '.join(links)
+
+    def to_dict(self):
+        """The paging information for the JSON views."""
+        return {'items_per_page':self.items_per_page,
+                'item_count':self.item_count, 'page':self.page,
+                'before':self.previous_cursor, 'after':self.next_cursor}
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
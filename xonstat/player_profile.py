@@ -0,0 +1,354 @@
+import datetime
+import logging
+import sqlalchemy.sql.expression as expr
+import sqlalchemy.sql.functions as func
+from calendar import timegm
+from collections import namedtuple
+from sqlalchemy import DateTime, Integer, Interval
+from xonstat.models import *
+from xonstat.player_tables import add_game, rebuild_players
+from xonstat.rollups import max_untracked_player_id
+from xonstat.util import pretty_date, sql_add
+
+log = logging.getLogger(__name__)
+
+# The career summary of a player shown on the player page, in its JSON and
+# on the badges: games, wins and losses, totals and favorite maps per game
+# type. It is added up here from the player's totals per game type and map,
+# which come from player_career_stats, or from one pass over the player's
+# player_game_stats for players that table doesn't have yet.
+#
+# store_submission adds each game to player_career_stats in the transaction
+# that stores it (update_career_stats), for the players already there and
+# new ones. xonstat/batch/rebuild_player_tables.py fills it in for the rest,
+# see xonstat.player_tables.
+
+GamesPlayed = namedtuple('GamesPlayed', ['game_type_cd', 'games', 'wins',
+    'losses', 'win_pct'])
+
+OverallStats = namedtuple('OverallStats', ['total_kills', 'total_deaths',
+    'k_d_ratio', 'last_played', 'last_played_epoch', 'last_played_fuzzy',
+    'total_playing_time', 'total_pickups', 'total_captures', 'cap_ratio',
+    'total_carrier_frags', 'game_type_cd'])
+
+FavMap = namedtuple('FavMap', ['map_name', 'map_id', 'times_played',
+    'game_type_cd'])
+
+PlayerProfile = namedtuple('PlayerProfile', ['games_played', 'overall_stats',
+    'fav_maps', 'games_alivetime'])
+
+# the totals kept per game type, in the order of the history query
+_totals = ('games', 'wins', 'kills', 'deaths', 'last_played', 'alivetime',
+        'pickups', 'captures', 'carrier_frags')
+
+
+def _ratio(numerator, denominator):
+    try:
+        return float(numerator)/denominator
+    except:
+        return None
+
+
+def histories(session, player_ids):
+    """
+    The games of several players grouped by game type and map, as a
+    dictionary of player_id to rows of game_type_cd, map_id, map_name,
+    games, wins, kills, deaths, last_played, alivetime, pickups, captures
+    and carrier_frags, aggregated from player_game_stats. Players without
+    games are left out.
+
+    A game is won when the player was on the winning team or ranked first.
+    """
+    win = expr.case([(Game.winner == PlayerGameStat.team, 1),
+            (PlayerGameStat.rank == 1, 1)], else_=0)
+
+    rows = session.query(PlayerGameStat.player_id, Game.game_type_cd,
+            Map.map_id, Map.name, func.count(), func.sum(win),
+            func.sum(PlayerGameStat.kills), func.sum(PlayerGameStat.deaths),
+            func.max(PlayerGameStat.create_dt),
+            func.sum(PlayerGameStat.alivetime),
+            func.sum(PlayerGameStat.pickups),
+            func.sum(PlayerGameStat.captures),
+            func.sum(PlayerGameStat.carrier_frags)).\
+            filter(PlayerGameStat.player_id.in_(player_ids)).\
+            filter(PlayerGameStat.game_id == Game.game_id).\
+            filter(Game.map_id == Map.map_id).\
+            group_by(PlayerGameStat.player_id, Game.game_type_cd, Map.map_id,
+                    Map.name).\
+            all()
+
+    return _by_player(rows)
+
+
+def career_histories(session, player_ids):
+    """
+    The same as histories(), read from player_career_stats. Players the
+    table has nothing on are left out.
+    """
+    rows = session.query(PlayerCareerStat.player_id,
+            PlayerCareerStat.game_type_cd, Map.map_id, Map.name,
+            PlayerCareerStat.games, PlayerCareerStat.wins,
+            PlayerCareerStat.kills, PlayerCareerStat.deaths,
+            PlayerCareerStat.last_played, PlayerCareerStat.alivetime,
+            PlayerCareerStat.pickups, PlayerCareerStat.captures,
+            PlayerCareerStat.carrier_frags).\
+            filter(PlayerCareerStat.player_id.in_(player_ids)).\
+            filter(PlayerCareerStat.map_id == Map.map_id).\
+            all()
+
+    return _by_player(rows)
+
+
+def _by_player(rows):
+    by_player = {}
+    for row in rows:
+        by_player.setdefault(row[0], []).append(tuple(row[1:]))
+    return by_player
+
+
+def build_profile(rows, fav_game_type_cd=None):
+    """
+    Adds up a player's rows of histories() into a PlayerProfile:
+
+    games_played - a list of GamesPlayed per game type and 'overall',
+        ordered by the number of games
+    overall_stats - OverallStats by game type and 'overall'
+    fav_maps - the most played map (a FavMap) by game type, and 'overall',
+        the favorite map of fav_game_type_cd or else of the game type
+        with the most played favorite map
+    games_alivetime - the playing time by game type
+    """
+    by_game_type = {}
+    favs = {}
+    for row in rows:
+        (game_type_cd, map_id, map_name) = row[0:3]
+        values = row[3:]
+
+        totals = by_game_type.get(game_type_cd)
+        if totals is None:
+            by_game_type[game_type_cd] = list(values)
+        else:
+            for (i, value) in enumerate(values):
+                if _totals[i] == 'last_played':
+                    if totals[i] is None or (value is not None and
+                            value > totals[i]):
+                        totals[i] = value
+                else:
+                    totals[i] = sql_add(totals[i], value)
+
+        # the most played map, the lowest map_id on a tie
+        games = values[0]
+        fav = favs.get(game_type_cd)
+        if fav is None or games > fav.times_played or \
+                (games == fav.times_played and map_id < fav.map_id):
+            favs[game_type_cd] = FavMap(map_name=map_name, map_id=map_id,
+                    times_played=games, game_type_cd=game_type_cd)
+
+    games_played = []
+    overall_stats = {}
+    games_alivetime = {}
+    overall = dict.fromkeys(_totals)
+    for (game_type_cd, values) in by_game_type.items():
+        totals = dict(zip(_totals, values))
+        wins = totals['wins'] or 0
+        games_played.append(GamesPlayed(game_type_cd, totals['games'], wins,
+            totals['games'] - wins, float(wins)/totals['games'] * 100))
+
+        overall_stats[game_type_cd] = OverallStats(
+                total_kills=totals['kills'],
+                total_deaths=totals['deaths'],
+                k_d_ratio=_ratio(totals['kills'], totals['deaths']),
+                last_played=totals['last_played'],
+                last_played_epoch=timegm(totals['last_played'].timetuple()),
+                last_played_fuzzy=pretty_date(totals['last_played']),
+                total_playing_time=totals['alivetime'],
+                total_pickups=totals['pickups'],
+                total_captures=totals['captures'],
+                cap_ratio=_ratio(totals['captures'], totals['pickups']),
+                total_carrier_frags=totals['carrier_frags'],
+                game_type_cd=game_type_cd)
+
+        games_alivetime[game_type_cd] = totals['alivetime']
+
+        for key in ('games', 'wins', 'kills', 'deaths', 'alivetime',
+                'carrier_frags'):
+            overall[key] = sql_add(overall[key], totals[key])
+        if overall['last_played'] is None or \
+                totals['last_played'] > overall['last_played']:
+            overall['last_played'] = totals['last_played']
+
+    overall_games = overall['games'] or 0
+    overall_wins = overall['wins'] or 0
+    if overall_games > 0:
+        overall_win_pct = float(overall_wins)/overall_games * 100
+    else:
+        overall_win_pct = 0.0
+    games_played.append(GamesPlayed('overall', overall_games, overall_wins,
+        overall_games - overall_wins, overall_win_pct))
+
+    # sort the resulting list by # of games played
+    games_played.sort(key=lambda x:x.games, reverse=True)
+
+    if overall['last_played'] is not None:
+        overall_stats['overall'] = OverallStats(
+                total_kills=overall['kills'] or 0,
+                total_deaths=overall['deaths'] or 0,
+                k_d_ratio=_ratio(overall['kills'] or 0, overall['deaths'] or 0),
+                last_played=overall['last_played'],
+                last_played_epoch=timegm(overall['last_played'].timetuple()),
+                last_played_fuzzy=pretty_date(overall['last_played']),
+                total_playing_time=overall['alivetime'] or \
+                        datetime.timedelta(seconds=0),
+                total_pickups=None,
+                total_captures=None,
+                cap_ratio=None,
+                total_carrier_frags=overall['carrier_frags'] or 0,
+                game_type_cd='overall')
+
+    fav_maps = dict(favs)
+    if fav_game_type_cd in favs:
+        fav_maps['overall'] = favs[fav_game_type_cd]
+    elif len(favs) > 0:
+        fav_maps['overall'] = max(favs.values(),
+                key=lambda fav:(fav.times_played, -fav.map_id))
+
+    return PlayerProfile(games_played=games_played,
+            overall_stats=overall_stats, fav_maps=fav_maps,
+            games_alivetime=games_alivetime)
+
+
+def load_profiles(session, player_ids, fav_game_type_cd=None):
+    """
+    The PlayerProfile of several players (see build_profile) as a
+    dictionary by player_id, from player_career_stats or, for the players
+    without rows there, from the raw game history.
+    """
+    rows = career_histories(session, player_ids)
+    missing = [player_id for player_id in player_ids if player_id not in rows]
+    if len(missing) > 0:
+        rows.update(histories(session, missing))
+
+    return dict((player_id, build_profile(rows.get(player_id, []),
+        fav_game_type_cd)) for player_id in player_ids)
+
+
+def load_profile(session, player_id, fav_game_type_cd=None):
+    """The PlayerProfile of one player, see load_profiles."""
+    return load_profiles(session, [player_id], fav_game_type_cd)[player_id]
+
+
+# the totals of player_career_stats, in the order of the rows written
+_career_columns = ('player_id', 'games', 'wins', 'kills', 'deaths',
+        'last_played', 'alivetime', 'pickups', 'captures', 'carrier_frags')
+
+_career_types = (Integer, Integer, Integer, Integer, Integer, DateTime,
+        Interval, Integer, Integer, Integer)
+
+
+def career_totals(game, pgstats):
+    """
+    Sums a game's player_game_stats rows per player into rows of
+    _career_columns, leaving out the bots and anonymous players. Call it
+    once all the rows are built, when the game's winner is known.
+    """
+    totals = {}
+    for pgstat in pgstats:
+        player_id = pgstat['player_id']
+        if player_id <= max_untracked_player_id:
+            continue
+
+        if (game.winner is not None and pgstat.get('team') == game.winner) \
+                or pgstat.get('rank') == 1:
+            win = 1
+        else:
+            win = 0
+
+        row = [1, win, pgstat.get('kills'), pgstat.get('deaths'),
+                pgstat.get('create_dt'), pgstat.get('alivetime'),
+                pgstat.get('pickups'), pgstat.get('captures'),
+                pgstat.get('carrier_frags')]
+
+        if player_id in totals:
+            total = totals[player_id]
+            for (i, value) in enumerate(row):
+                if _career_columns[i + 1] == 'last_played':
+                    total[i] = max(total[i], value)
+                else:
+                    total[i] = sql_add(total[i], value)
+        else:
+            totals[player_id] = row
+
+    return [tuple([player_id] + row) for (player_id, row) in totals.items()]
+
+
+# the player_career_stats rows of some players as computed from the raw
+# tables
+_raw_career_stats = \
+    "SELECT pgs.player_id, g.game_type_cd, g.map_id, count(*) AS games, " \
+        "sum(CASE WHEN g.winner = pgs.team THEN 1 " \
+            "WHEN pgs.rank = 1 THEN 1 ELSE 0 END) AS wins, " \
+        "sum(pgs.kills) AS kills, sum(pgs.deaths) AS deaths, " \
+        "max(pgs.create_dt) AS last_played, " \
+        "sum(pgs.alivetime) AS alivetime, sum(pgs.pickups) AS pickups, " \
+        "sum(pgs.captures) AS captures, " \
+        "sum(pgs.carrier_frags) AS carrier_frags " \
+    "FROM player_game_stats pgs " \
+    "JOIN games g ON g.game_id = pgs.game_id " \
+    "WHERE pgs.player_id = ANY(:player_ids) " \
+    "GROUP BY pgs.player_id, g.game_type_cd, g.map_id"
+
+
+def rebuild_career_stats(session, player_ids):
+    """
+    Rebuilds the player_career_stats rows of a list of players from
+    player_game_stats and games, see rebuild_players. The caller commits.
+    Returns the number of rows written and the players skipped.
+    """
+    return rebuild_players(session, 'player_career_stats',
+        "INSERT INTO player_career_stats (player_id, game_type_cd, map_id, "
+            "games, wins, kills, deaths, last_played, alivetime, pickups, "
+            "captures, carrier_frags) "
+        "SELECT player_id, game_type_cd, map_id, games, wins, kills, deaths, "
+            "last_played, alivetime, pickups, captures, carrier_frags "
+        "FROM (" + _raw_career_stats + ") AS r", player_ids)
+
+
+# adds the VALUES rows v to the career stats of a game type and map. A total
+# stays NULL only when both sides are
+_add_career_stats = \
+    "UPDATE player_career_stats AS c " \
+    "SET games = c.games + v.games, " \
+        "wins = c.wins + v.wins, " \
+        "kills = coalesce(c.kills + v.kills, c.kills, v.kills), " \
+        "deaths = coalesce(c.deaths + v.deaths, c.deaths, v.deaths), " \
+        "last_played = greatest(c.last_played, v.last_played), " \
+        "alivetime = coalesce(c.alivetime + v.alivetime, c.alivetime, " \
+            "v.alivetime), " \
+        "pickups = coalesce(c.pickups + v.pickups, c.pickups, v.pickups), " \
+        "captures = coalesce(c.captures + v.captures, c.captures, " \
+            "v.captures), " \
+        "carrier_frags = coalesce(c.carrier_frags + v.carrier_frags, " \
+            "c.carrier_frags, v.carrier_frags) " \
+    "FROM ({values}) AS v({columns}) " \
+    "WHERE c.player_id = v.player_id " \
+    "AND c.game_type_cd = :game_type_cd AND c.map_id = :map_id"
+
+_insert_career_stats = \
+    "INSERT INTO player_career_stats (game_type_cd, map_id, {columns}) " \
+    "SELECT :game_type_cd, :map_id, {columns} " \
+    "FROM ({values}) AS v({columns}) " \
+    "WHERE NOT EXISTS (SELECT 1 FROM player_career_stats AS c " \
+        "WHERE c.player_id = v.player_id " \
+        "AND c.game_type_cd = :game_type_cd AND c.map_id = :map_id)"
+
+
+def update_career_stats(session, game, pgstats):
+    """
+    Adds a stored game to player_career_stats, see add_game. The stats rows
+    have to be written already. The caller commits.
+    """
+    add_game(session, 'player_career_stats', 'player_game_stats',
+            game.game_id, career_totals(game, pgstats), _career_types,
+            (_add_career_stats, _insert_career_stats),
+            {'game_type_cd':game.game_type_cd, 'map_id':game.map_id},
+            columns=', '.join(_career_columns))
@@ -0,0 +1,125 @@
+import logging
+from sqlalchemy import text
+from xonstat.util import retry_in_savepoint, sql_values
+
+log = logging.getLogger(__name__)
+
+# Per player tables derived from the raw game tables, like
+# player_career_stats (xonstat.player_profile). A player is either in such a
+# table with their whole history or not at all, and the pages read the
+# players it doesn't have from the raw tables.
+#
+# store_submission adds each game to the tables (add_game) for the players
+# already in them and for the players the game is the first of. Everyone
+# else is filled in by xonstat/batch/rebuild_player_tables.py
+# (rebuild_players), so a submission never aggregates a player's history.
+#
+# A rebuild and a submission adding a game of the same player are
+# serialized with transaction level advisory locks on the player: adding a
+# game takes a shared one, rebuilding an exclusive one. Otherwise a rebuild
+# could miss a game not committed yet and the submission then not find the
+# rows it adds it to. The rebuild only tries to take the locks and skips the
+# players that are busy, so it never waits on a submission, which may hold
+# other locks of the player (e.g. its players row, for a new nick).
+
+# the first key of the advisory locks, the second is the player_id
+lock_class = 1
+
+
+def _lock_shared(session, player_ids):
+    session.execute(text(
+        "SELECT pg_advisory_xact_lock_shared(:lock_class, player_id) "
+        "FROM unnest(CAST(:player_ids AS INTEGER[])) AS player_id "
+        "ORDER BY player_id"),
+        {'lock_class':lock_class, 'player_ids':sorted(player_ids)}).fetchall()
+
+
+def _try_lock(session, player_ids):
+    return [player_id for (player_id,) in session.execute(text(
+        "SELECT player_id "
+        "FROM unnest(CAST(:player_ids AS INTEGER[])) AS player_id "
+        "WHERE pg_try_advisory_xact_lock(:lock_class, player_id)"),
+        {'lock_class':lock_class, 'player_ids':list(player_ids)})]
+
+
+def _with_rows(session, table, player_ids, game_id=None):
+    """The players of player_ids with rows in table, other than game_id's."""
+    other_games = ""
+    if game_id is not None:
+        other_games = "AND t.game_id <> :game_id "
+
+    return set(player_id for (player_id,) in session.execute(text(
+        "SELECT p.player_id "
+        "FROM unnest(CAST(:player_ids AS INTEGER[])) AS p(player_id) "
+        "WHERE EXISTS (SELECT 1 FROM " + table + " AS t "
+            "WHERE t.player_id = p.player_id " + other_games + ")"),
+        {'player_ids':list(player_ids), 'game_id':game_id}))
+
+
+def _add_rows(session, table, raw_table, game_id, rows, types, statements,
+        params, sql_params):
+    player_ids = list(set(row[0] for row in rows))
+    _lock_shared(session, player_ids)
+
+    # players that aren't in table yet are left to the rebuild, unless they
+    # have no other games
+    known = _with_rows(session, table, player_ids)
+    unknown = [player_id for player_id in player_ids if player_id not in known]
+    if len(unknown) > 0:
+        known.update(set(unknown) -
+                _with_rows(session, raw_table, unknown, game_id))
+
+    rows = [row for row in rows if row[0] in known]
+    if len(rows) == 0:
+        return
+
+    (values, bindparams) = sql_values(rows, types)
+    params = dict(params, game_id=game_id)
+    for statement in statements:
+        session.execute(text(statement.format(values=values, **sql_params),
+            bindparams=bindparams), params)
+
+
+def add_game(session, table, raw_table, game_id, rows, types, statements,
+        params, **sql_params):
+    """
+    Adds the rows of a stored game to a player table. The rows are tuples of
+    the given SQLAlchemy types starting with the player_id, and are only
+    added for the players in table and those without other games in
+    raw_table, the table it is derived from. statements are the SQL that
+    adds them, run in order with params and :game_id, and with {values}
+    replaced by a VALUES list of the rows and the other fields by
+    sql_params. The caller commits.
+
+    statements update the existing rows and insert the missing ones, see
+    retry_in_savepoint.
+    """
+    if len(rows) == 0:
+        return
+
+    retry_in_savepoint(session,
+            "the {0} rows of game {1}".format(table, game_id),
+            _add_rows, session, table, raw_table, game_id, rows, types,
+            statements, params, sql_params)
+
+
+def rebuild_players(session, table, insert, player_ids, params={}):
+    """
+    Rebuilds the rows of a list of players in a player table: deletes them
+    and runs insert with params, an INSERT of the rows of the players in
+    :player_ids computed from the raw tables. Players a submission is
+    adding a game for are skipped. The caller commits.
+
+    Returns the number of rows written and the list of players skipped.
+    """
+    locked = _try_lock(session, player_ids)
+    skipped = sorted(set(player_ids) - set(locked))
+    if len(locked) == 0:
+        return (0, skipped)
+
+    params = dict(params, player_ids=locked)
+    session.execute(text("DELETE FROM " + table + " "
+        "WHERE player_id = ANY(:player_ids)"), params)
+    rows = session.execute(text(insert), params).rowcount
+
+    return (rows, skipped)
@@ -0,0 +1,127 @@
+import logging
+import struct
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+log = logging.getLogger(__name__)
+
+# Encodes the pixels of a cairo ARGB32 image surface as an RGBA PNG, for the
+# badges. The surface data is native-endian ARGB, which is B, G, R, A in
+# memory on the little-endian machines we run on, and is written as is
+# (premultiplied), like the badges always were.
+#
+# The channels are swapped with strided slice assignments on the whole
+# buffer and the scanlines are filtered with NumPy when it is installed, so
+# encoding costs a few passes over the buffer instead of Python code per
+# pixel.
+
+# the PNG filter types, by name. "none" leaves the scanlines as they are,
+# "sub" stores each byte as the difference to the same channel of the pixel
+# to its left, "up" as the difference to the pixel above.
+filters = {'none':0, 'sub':1, 'up':2}
+
+_signature = b'\x89PNG\r\n\x1a\n'
+
+
+def _chunk(tag, data):
+    head = tag + data
+    return struct.pack("!I", len(data)) + head + \
+            struct.pack("!I", 0xFFFFFFFF & zlib.crc32(head))
+
+
+def _png(width, height, compressed):
+    return b"".join([_signature,
+        _chunk(b'IHDR', struct.pack("!2I5B", width, height, 8, 6, 0, 0, 0)),
+        _chunk(b'IDAT', compressed),
+        _chunk(b'IEND', b'')])
+
+
+def bgra_to_rgba(buf):
+    """Swaps the B and R bytes of every pixel of buf, into a new bytearray."""
+    src = bytearray(buf)
+    rgba = bytearray(len(src))
+    rgba[0::4] = src[2::4]
+    rgba[1::4] = src[1::4]
+    rgba[2::4] = src[0::4]
+    rgba[3::4] = src[3::4]
+    return rgba
+
+
+def _filter_numpy(rgba, width, height, filter_type):
+    rows = numpy.frombuffer(bytes(rgba), dtype=numpy.uint8).\
+            reshape(height, width * 4)
+    out = numpy.empty((height, width * 4 + 1), dtype=numpy.uint8)
+    out[:, 0] = filter_type
+    if filter_type == 0:
+        out[:, 1:] = rows
+    elif filter_type == 1:
+        out[:, 1:5] = rows[:, 0:4]
+        out[:, 5:] = rows[:, 4:] - rows[:, :-4]
+    else:
+        out[0, 1:] = rows[0]
+        out[1:, 1:] = rows[1:] - rows[:-1]
+    return out.tostring()
+
+
+def _filter_python(rgba, width, height, filter_type):
+    stride = width * 4
+    lines = []
+    previous = bytearray(stride)
+    for y in xrange(height):
+        row = rgba[y * stride:(y + 1) * stride]
+        if filter_type == 1:
+            line = row[0:4] + bytearray((row[i] - row[i - 4]) & 0xFF
+                    for i in xrange(4, stride))
+        elif filter_type == 2:
+            line = bytearray((row[i] - previous[i]) & 0xFF
+                    for i in xrange(stride))
+        else:
+            line = row
+        lines.append(chr(filter_type) + bytes(line))
+        previous = row
+    return b"".join(lines)
+
+
+def filter_scanlines(rgba, width, height, png_filter='none'):
+    """
+    Prefixes each row of rgba with its filter type byte and applies the
+    filter png_filter (one of filters) to it, returning the data to
+    compress.
+    """
+    filter_type = filters[png_filter]
+    if numpy is not None:
+        return _filter_numpy(rgba, width, height, filter_type)
+
+    if filter_type == 0:
+        # only the filter bytes need inserting
+        stride = width * 4
+        return b"".join(b'\x00' + bytes(rgba[span:span + stride])
+                for span in xrange(0, height * stride, stride))
+
+    return _filter_python(rgba, width, height, filter_type)
+
+
+def encode_png(buf, width, height, level=9, png_filter='none'):
+    """
+    Returns the PNG of a cairo ARGB32 surface's data buf, of width x height
+    pixels without row padding, compressed with zlib at level (0-9) and
+    with the scanlines filtered by png_filter (see filters).
+    """
+    rgba = bgra_to_rgba(buf)
+    return _png(width, height, zlib.compress(
+        filter_scanlines(rgba, width, height, png_filter), level))
+
+
+def write_png(filename, buf, width, height, level=9, png_filter='none'):
+    """Writes encode_png(buf, width, height, level, png_filter) to filename."""
+    data = encode_png(buf, width, height, level, png_filter)
+    f = open(filename, "wb")
+    try:
+        f.write(data)
+    finally:
+        f.close()
+
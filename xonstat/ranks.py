@@ -0,0 +1,216 @@
+import logging
+from sqlalchemy import text
+
+log = logging.getLogger(__name__)
+
+# players need this many games of a game type to be ranked in it
+min_games = 32
+
+
+def configure_ranks(settings):
+    """
+    Reads the ranking settings (xonstat.rank_min_games).
+    """
+    global min_games
+
+    try:
+        min_games = int(settings['xonstat.rank_min_games'])
+    except:
+        min_games = 32
+
+
+def lock_rank_summary(session, game_type_cd):
+    """
+    Locks the summary row of a game type for the rest of the transaction,
+    creating it if needed. Rank updates for one game type are serialized on
+    this row, since each one shifts the ranks the next one reads.
+    """
+    summary = session.execute(text(
+        "SELECT max_rank, player_count FROM player_rank_summary "
+        "WHERE game_type_cd = :game_type_cd FOR UPDATE"),
+        {'game_type_cd':game_type_cd}).fetchone()
+
+    if summary is None:
+        refresh_rank_summary(session, game_type_cd)
+        summary = session.execute(text(
+            "SELECT max_rank, player_count FROM player_rank_summary "
+            "WHERE game_type_cd = :game_type_cd FOR UPDATE"),
+            {'game_type_cd':game_type_cd}).fetchone()
+
+    return summary
+
+
+def refresh_rank_summary(session, game_type_cd=None):
+    """
+    Recomputes the summary rows from player_ranks, for one game type or
+    all of them.
+    """
+    params = {}
+    where = ""
+    if game_type_cd is not None:
+        params['game_type_cd'] = game_type_cd
+        where = "WHERE game_type_cd = :game_type_cd"
+
+    session.execute(text("DELETE FROM player_rank_summary " + where), params)
+
+    if game_type_cd is not None:
+        # a game type without ranked players still gets its (empty) row
+        session.execute(text(
+            "INSERT INTO player_rank_summary "
+                "(game_type_cd, max_rank, player_count, update_dt) "
+            "SELECT :game_type_cd, coalesce(max(rank), 0), count(*), now() "
+            "FROM player_ranks "
+            "WHERE game_type_cd = :game_type_cd"), params)
+    else:
+        session.execute(text(
+            "INSERT INTO player_rank_summary "
+                "(game_type_cd, max_rank, player_count, update_dt) "
+            "SELECT game_type_cd, max(rank), count(*), now() "
+            "FROM player_ranks "
+            "GROUP BY game_type_cd"))
+
+
+def move_rank(session, game_type_cd, player_id, nick, old_elo, new_elo):
+    """
+    Moves a ranked player from old_elo to new_elo. A player's rank is one
+    more than the number of players with a higher Elo, so only the players
+    between the old and the new Elo change rank.
+    """
+    params = {'game_type_cd':game_type_cd, 'player_id':player_id,
+            'nick':nick, 'old_elo':old_elo, 'new_elo':new_elo}
+
+    if new_elo > old_elo:
+        session.execute(text(
+            "UPDATE player_ranks SET rank = rank + 1 "
+            "WHERE game_type_cd = :game_type_cd "
+            "AND elo >= :old_elo AND elo < :new_elo "
+            "AND player_id <> :player_id"), params)
+    elif new_elo < old_elo:
+        session.execute(text(
+            "UPDATE player_ranks SET rank = rank - 1 "
+            "WHERE game_type_cd = :game_type_cd "
+            "AND elo >= :new_elo AND elo < :old_elo "
+            "AND player_id <> :player_id"), params)
+
+    session.execute(text(
+        "UPDATE player_ranks SET elo = :new_elo, nick = :nick, "
+            "rank = 1 + (SELECT count(*) FROM player_ranks "
+                "WHERE game_type_cd = :game_type_cd "
+                "AND elo > :new_elo AND player_id <> :player_id) "
+        "WHERE game_type_cd = :game_type_cd "
+        "AND player_id = :player_id"), params)
+
+
+def add_rank(session, game_type_cd, player_id, nick, elo):
+    """
+    Ranks a player for the first time. Everyone below moves down one place.
+    """
+    params = {'game_type_cd':game_type_cd, 'player_id':player_id,
+            'nick':nick, 'elo':elo}
+
+    session.execute(text(
+        "UPDATE player_ranks SET rank = rank + 1 "
+        "WHERE game_type_cd = :game_type_cd AND elo < :elo"), params)
+
+    session.execute(text(
+        "INSERT INTO player_ranks (player_id, nick, game_type_cd, elo, rank) "
+        "SELECT :player_id, :nick, :game_type_cd, :elo, 1 + count(*) "
+        "FROM player_ranks "
+        "WHERE game_type_cd = :game_type_cd AND elo > :elo"), params)
+
+
+def update_game_ranks(session, game_id, game_type_cd):
+    """
+    Updates player_ranks for the players whose Elo changed in a game, once
+    the game and its Elo changes are committed. The caller commits.
+
+    Returns the number of players whose rank was updated.
+    """
+    lock_rank_summary(session, game_type_cd)
+
+    changed = session.execute(text(
+        "SELECT pe.player_id, pe.elo, pe.games, p.nick, "
+            "pr.elo AS old_elo, pr.rank AS old_rank "
+        "FROM player_game_stats pgs "
+        "JOIN player_elos pe ON pe.player_id = pgs.player_id "
+            "AND pe.game_type_cd = :game_type_cd "
+        "JOIN players p ON p.player_id = pgs.player_id "
+        "LEFT JOIN player_ranks pr ON pr.player_id = pgs.player_id "
+            "AND pr.game_type_cd = :game_type_cd "
+        "WHERE pgs.game_id = :game_id "
+        "AND pgs.elo_delta IS NOT NULL "
+        "AND p.active_ind = true"),
+        {'game_id':game_id, 'game_type_cd':game_type_cd}).fetchall()
+
+    updated = 0
+    added = 0
+    for row in changed:
+        if row.old_rank is not None:
+            if row.elo != row.old_elo:
+                move_rank(session, game_type_cd, row.player_id, row.nick,
+                        row.old_elo, row.elo)
+                updated += 1
+        elif row.games >= min_games:
+            add_rank(session, game_type_cd, row.player_id, row.nick, row.elo)
+            updated += 1
+            added += 1
+
+    if updated > 0:
+        session.execute(text(
+            "UPDATE player_rank_summary "
+            "SET player_count = player_count + :added, "
+                "max_rank = (SELECT coalesce(max(rank), 0) FROM player_ranks "
+                    "WHERE game_type_cd = :game_type_cd), "
+                "update_dt = now() "
+            "WHERE game_type_cd = :game_type_cd"),
+            {'added':added, 'game_type_cd':game_type_cd})
+
+    log.debug("Updated the {0} ranks of {1} players for game {2}".format(
+        game_type_cd, updated, game_id))
+
+    return updated
+
+
+def rebuild_ranks(session, game_type_cd=None):
+    """
+    Rebuilds player_ranks and the summary from player_elos, for one game
+    type or all of them. The caller commits.
+    """
+    params = {'min_games':min_games}
+    where = ""
+    if game_type_cd is not None:
+        params['game_type_cd'] = game_type_cd
+        where = "AND pe.game_type_cd = :game_type_cd "
+
+    if game_type_cd is not None:
+        session.execute(text("DELETE FROM player_ranks "
+            "WHERE game_type_cd = :game_type_cd"), params)
+    else:
+        session.execute(text("DELETE FROM player_ranks"))
+
+    session.execute(text(
+        "INSERT INTO player_ranks (player_id, nick, game_type_cd, elo, rank) "
+        "SELECT p.player_id, p.nick, pe.game_type_cd, pe.elo, "
+            "rank() OVER (PARTITION BY pe.game_type_cd ORDER BY pe.elo DESC) "
+        "FROM players p, player_elos pe "
+        "WHERE p.player_id = pe.player_id "
+        "AND p.active_ind = true "
+        "AND pe.games >= :min_games " + where), params)
+
+    refresh_rank_summary(session, game_type_cd)
+
+
+def ensure_rank_indexes(session):
+    """
+    Creates the indexes the incremental updates rely on, if they're missing.
+    """
+    for (name, columns) in (
+            ('player_ranks_game_type_elo_ix', 'game_type_cd, elo'),
+            ('player_ranks_game_type_rank_ix', 'game_type_cd, rank')):
+        exists = session.execute(text(
+            "SELECT 1 FROM pg_indexes WHERE indexname = :name"),
+            {'name':name}).fetchone()
+        if exists is None:
+            log.info("Creating index {0}".format(name))
+            session.execute("CREATE INDEX {0} ON player_ranks ({1})".format(
+                name, columns))
@@ -0,0 +1,283 @@
+import datetime
+import logging
+import sqlalchemy.sql.functions as func
+from sqlalchemy import Integer, Interval, text
+from xonstat.leaderboards import leaderboard
+from xonstat.models import *
+from xonstat.util import retry_in_savepoint, sql_values
+
+log = logging.getLogger(__name__)
+
+# Per-day aggregates behind the "top N over the last leaderboard_lifetime
+# days" leaderboards:
+#
+#   player_daily_stats - games, alivetime and score per player, server and map
+#   server_map_daily_stats - games per server and map
+#
+# Days are UTC dates of the create_dt of the player_game_stats and games
+# rows. store_submission adds each game to the rollups in the transaction
+# that stores it, backfill_rollups rebuilds them from the raw tables for a
+# range of days (xonstat/batch/backfill_rollups.py) and check_rollups
+# compares the two (xonstat/batch/check_rollups.py).
+
+# the players the leaderboards leave out (bots and anonymous players)
+max_untracked_player_id = 2
+
+
+def _since(lifetime):
+    """The first day of a leaderboard covering the last lifetime days."""
+    return datetime.datetime.utcnow().date() - \
+            datetime.timedelta(days=lifetime - 1)
+
+
+def player_totals(pgstats):
+    """
+    Sums a game's player_game_stats rows per player, leaving out the bots
+    and anonymous players. Returns a list of (player_id, games, alivetime,
+    score).
+    """
+    totals = {}
+    for pgstat in pgstats:
+        player_id = pgstat['player_id']
+        if player_id <= max_untracked_player_id:
+            continue
+
+        alivetime = pgstat.get('alivetime') or datetime.timedelta(seconds=0)
+        score = pgstat.get('score') or 0
+        if player_id in totals:
+            (games, total_alivetime, total_score) = totals[player_id]
+            totals[player_id] = (games + 1, total_alivetime + alivetime,
+                    total_score + score)
+        else:
+            totals[player_id] = (1, alivetime, score)
+
+    return [(player_id, games, alivetime, score)
+            for (player_id, (games, alivetime, score)) in totals.items()]
+
+
+def _add_game(session, params, player_rows):
+    params = dict(params)
+
+    session.execute(text(
+        "UPDATE server_map_daily_stats "
+        "SET games = games + 1 "
+        "WHERE stat_date = :stat_date "
+        "AND server_id = :server_id AND map_id = :map_id"), params)
+    session.execute(text(
+        "INSERT INTO server_map_daily_stats "
+            "(stat_date, server_id, map_id, games) "
+        "SELECT :stat_date, :server_id, :map_id, 1 "
+        "WHERE NOT EXISTS (SELECT 1 FROM server_map_daily_stats "
+            "WHERE stat_date = :stat_date "
+            "AND server_id = :server_id AND map_id = :map_id)"), params)
+
+    if len(player_rows) == 0:
+        return
+
+    (values, bindparams) = sql_values(player_rows,
+            (Integer, Integer, Interval, Integer))
+
+    session.execute(text(
+        "UPDATE player_daily_stats AS d "
+        "SET games = d.games + v.games, "
+            "alivetime = d.alivetime + v.alivetime, "
+            "score = d.score + v.score "
+        "FROM (" + values + ") AS v(player_id, games, alivetime, score) "
+        "WHERE d.stat_date = :stat_date "
+        "AND d.server_id = :server_id AND d.map_id = :map_id "
+        "AND d.player_id = v.player_id", bindparams=bindparams), params)
+    session.execute(text(
+        "INSERT INTO player_daily_stats "
+            "(stat_date, player_id, server_id, map_id, games, alivetime, score) "
+        "SELECT :stat_date, v.player_id, :server_id, :map_id, "
+            "v.games, v.alivetime, v.score "
+        "FROM (" + values + ") AS v(player_id, games, alivetime, score) "
+        "WHERE NOT EXISTS (SELECT 1 FROM player_daily_stats AS d "
+            "WHERE d.stat_date = :stat_date "
+            "AND d.server_id = :server_id AND d.map_id = :map_id "
+            "AND d.player_id = v.player_id)", bindparams=bindparams), params)
+
+
+def update_rollups(session, stat_date, server_id, map_id, pgstats):
+    """
+    Adds a stored game to the daily rollups: one game for its server and
+    map, and the games, alivetime and score of each of its players. The
+    caller commits.
+
+    Existing rows are updated and missing ones inserted, see
+    retry_in_savepoint.
+    """
+    params = {'stat_date':stat_date, 'server_id':server_id, 'map_id':map_id}
+    retry_in_savepoint(session,
+            "the rollups of server {0} on map {1}".format(server_id, map_id),
+            _add_game, session, params, player_totals(pgstats))
+
+
+# the rollups as computed from the raw tables, for days in [:start, :end)
+_raw_player_daily_stats = \
+    "SELECT CAST(pgs.create_dt AS DATE) AS stat_date, pgs.player_id, " \
+        "g.server_id, g.map_id, count(*) AS games, " \
+        "coalesce(sum(pgs.alivetime), interval '0') AS alivetime, " \
+        "coalesce(sum(pgs.score), 0) AS score " \
+    "FROM player_game_stats pgs " \
+    "JOIN games g ON g.game_id = pgs.game_id " \
+    "WHERE pgs.player_id > :max_untracked " \
+    "AND pgs.create_dt >= :start AND pgs.create_dt < :end " \
+    "GROUP BY CAST(pgs.create_dt AS DATE), pgs.player_id, " \
+        "g.server_id, g.map_id"
+
+_raw_server_map_daily_stats = \
+    "SELECT CAST(g.create_dt AS DATE) AS stat_date, g.server_id, g.map_id, " \
+        "count(*) AS games " \
+    "FROM games g " \
+    "WHERE g.create_dt >= :start AND g.create_dt < :end " \
+    "GROUP BY CAST(g.create_dt AS DATE), g.server_id, g.map_id"
+
+
+def _day_range(start, end):
+    return {'start':datetime.datetime.combine(start, datetime.time()),
+            'end':datetime.datetime.combine(end, datetime.time()),
+            'max_untracked':max_untracked_player_id}
+
+
+def backfill_rollups(session, start, end):
+    """
+    Rebuilds the rollups of the days from start up to, not including, end
+    from player_game_stats and games. The caller commits.
+
+    Returns the number of player and server/map rows written.
+    """
+    params = _day_range(start, end)
+
+    session.execute(text("DELETE FROM player_daily_stats "
+        "WHERE stat_date >= :start AND stat_date < :end"), params)
+    session.execute(text("DELETE FROM server_map_daily_stats "
+        "WHERE stat_date >= :start AND stat_date < :end"), params)
+
+    players = session.execute(text(
+        "INSERT INTO player_daily_stats "
+            "(stat_date, player_id, server_id, map_id, games, alivetime, score) "
+        "SELECT stat_date, player_id, server_id, map_id, games, alivetime, score "
+        "FROM (" + _raw_player_daily_stats + ") AS r"), params).rowcount
+    server_maps = session.execute(text(
+        "INSERT INTO server_map_daily_stats "
+            "(stat_date, server_id, map_id, games) "
+        "SELECT stat_date, server_id, map_id, games "
+        "FROM (" + _raw_server_map_daily_stats + ") AS r"), params).rowcount
+
+    return (players, server_maps)
+
+
+def check_rollups(session, start, end, limit=100):
+    """
+    Compares the rollups of the days from start up to, not including, end
+    with what the raw tables add up to. Returns up to limit differences as
+    (table, key, rollup values, raw values) tuples, where a missing row has
+    values of None.
+    """
+    params = _day_range(start, end)
+    params['limit'] = limit
+
+    differences = []
+
+    for row in session.execute(text(
+            "SELECT coalesce(d.stat_date, r.stat_date) AS stat_date, "
+                "coalesce(d.player_id, r.player_id) AS player_id, "
+                "coalesce(d.server_id, r.server_id) AS server_id, "
+                "coalesce(d.map_id, r.map_id) AS map_id, "
+                "d.games, d.alivetime, d.score, "
+                "r.games AS raw_games, r.alivetime AS raw_alivetime, "
+                "r.score AS raw_score "
+            "FROM (SELECT * FROM player_daily_stats "
+                "WHERE stat_date >= :start AND stat_date < :end) AS d "
+            "FULL OUTER JOIN (" + _raw_player_daily_stats + ") AS r "
+                "ON r.stat_date = d.stat_date AND r.player_id = d.player_id "
+                "AND r.server_id = d.server_id AND r.map_id = d.map_id "
+            "WHERE d.games IS DISTINCT FROM r.games "
+            "OR d.alivetime IS DISTINCT FROM r.alivetime "
+            "OR d.score IS DISTINCT FROM r.score "
+            "ORDER BY 1, 2, 3, 4 "
+            "LIMIT :limit"), params):
+        differences.append(('player_daily_stats',
+            (row.stat_date, row.player_id, row.server_id, row.map_id),
+            (row.games, row.alivetime, row.score),
+            (row.raw_games, row.raw_alivetime, row.raw_score)))
+
+    for row in session.execute(text(
+            "SELECT coalesce(d.stat_date, r.stat_date) AS stat_date, "
+                "coalesce(d.server_id, r.server_id) AS server_id, "
+                "coalesce(d.map_id, r.map_id) AS map_id, "
+                "d.games, r.games AS raw_games "
+            "FROM (SELECT * FROM server_map_daily_stats "
+                "WHERE stat_date >= :start AND stat_date < :end) AS d "
+            "FULL OUTER JOIN (" + _raw_server_map_daily_stats + ") AS r "
+                "ON r.stat_date = d.stat_date "
+                "AND r.server_id = d.server_id AND r.map_id = d.map_id "
+            "WHERE d.games IS DISTINCT FROM r.games "
+            "ORDER BY 1, 2, 3 "
+            "LIMIT :limit"), params):
+        differences.append(('server_map_daily_stats',
+            (row.stat_date, row.server_id, row.map_id),
+            (row.games,), (row.raw_games,)))
+
+    return differences[:limit]
+
+
+def top_players(session, lifetime, count, server_id=None, map_id=None):
+    """
+    The count players with the most playing time over the last lifetime
+    days, optionally on one server or map, as (player_id, nick, alivetime).
+    """
+    filters = [Player.player_id == PlayerDailyStat.player_id,
+            PlayerDailyStat.stat_date >= _since(lifetime)]
+    if server_id is not None:
+        filters.append(PlayerDailyStat.server_id == server_id)
+    if map_id is not None:
+        filters.append(PlayerDailyStat.map_id == map_id)
+
+    return leaderboard(session, (Player.player_id, Player.nick),
+            func.sum(PlayerDailyStat.alivetime), filters, count)
+
+
+def top_scorers(session, lifetime, count, server_id=None, map_id=None):
+    """
+    The count players with the highest total score over the last lifetime
+    days, optionally on one server or map, as (player_id, nick, score).
+    """
+    filters = [Player.player_id == PlayerDailyStat.player_id,
+            PlayerDailyStat.stat_date >= _since(lifetime)]
+    if server_id is not None:
+        filters.append(PlayerDailyStat.server_id == server_id)
+    if map_id is not None:
+        filters.append(PlayerDailyStat.map_id == map_id)
+
+    return leaderboard(session, (Player.player_id, Player.nick),
+            func.sum(PlayerDailyStat.score), filters, count)
+
+
+def top_servers(session, lifetime, count, map_id=None):
+    """
+    The count servers with the most games over the last lifetime days,
+    optionally on one map, as (server_id, name, games).
+    """
+    filters = [Server.server_id == ServerMapDailyStat.server_id,
+            ServerMapDailyStat.stat_date >= _since(lifetime)]
+    if map_id is not None:
+        filters.append(ServerMapDailyStat.map_id == map_id)
+
+    return leaderboard(session, (Server.server_id, Server.name),
+            func.sum(ServerMapDailyStat.games), filters, count)
+
+
+def top_maps(session, lifetime, count, server_id=None):
+    """
+    The count maps with the most games over the last lifetime days,
+    optionally on one server, as (map_id, name, games).
+    """
+    filters = [Map.map_id == ServerMapDailyStat.map_id,
+            ServerMapDailyStat.stat_date >= _since(lifetime)]
+    if server_id is not None:
+        filters.append(ServerMapDailyStat.server_id == server_id)
+
+    return leaderboard(session, (Map.map_id, Map.name),
+            func.sum(ServerMapDailyStat.games), filters, count)
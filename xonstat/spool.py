@@ -0,0 +1,193 @@
+import logging
+import os
+import sqlite3
+import time
+from collections import namedtuple
+
+log = logging.getLogger(__name__)
+
+SpooledSubmission = namedtuple('SpooledSubmission', ['submission_id', 'idfp',
+    'ip_addr', 'body', 'attempts'])
+
+
+class SubmissionSpool(object):
+    """
+    A durable local queue of verified stats submissions, kept in a SQLite
+    database. The submission handler enqueues raw bodies and a separate worker
+    (xonstat/batch/submission_worker.py) claims and applies them in batches.
+
+    Entries move through the states 'queued' -> 'processing' and are deleted
+    once applied. An entry that keeps failing is retried after retry_delay
+    seconds and marked 'dead' after max_attempts tries. An entry stuck in
+    'processing' (e.g. the worker crashed) becomes claimable again after
+    claim_timeout seconds, unless it has used up its max_attempts, in which
+    case it is marked 'dead' too.
+
+    Entries are unique on (server name, match_id), so a game resubmitted
+    while still in the spool is queued only once.
+    """
+    def __init__(self, path, max_attempts=5, retry_delay=60,
+            claim_timeout=600):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.claim_timeout = claim_timeout
+
+        spool_dir = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(spool_dir):
+            os.makedirs(spool_dir)
+
+        conn = self._connect()
+        try:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS submissions ( "
+                    "submission_id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                    "server_name TEXT NOT NULL, "
+                    "match_id TEXT NOT NULL, "
+                    "idfp TEXT, "
+                    "ip_addr TEXT, "
+                    "body BLOB NOT NULL, "
+                    "state TEXT NOT NULL DEFAULT 'queued', "
+                    "attempts INTEGER NOT NULL DEFAULT 0, "
+                    "available_at REAL NOT NULL, "
+                    "last_error TEXT, "
+                    "create_dt REAL NOT NULL, "
+                    "UNIQUE (server_name, match_id))")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS submissions_claim_idx "
+                "ON submissions (state, available_at)")
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=FULL")
+        return conn
+
+    def enqueue(self, server_name, match_id, idfp, ip_addr, body):
+        """
+        Stores a submission. Returns False if a submission for the same
+        server and match is already spooled.
+        """
+        now = time.time()
+        conn = self._connect()
+        try:
+            cur = conn.execute(
+                "INSERT OR IGNORE INTO submissions (server_name, match_id, "
+                "idfp, ip_addr, body, available_at, create_dt) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (server_name, match_id, idfp, ip_addr, buffer(body), now, now))
+            return cur.rowcount == 1
+        finally:
+            conn.close()
+
+    def claim(self, batch_size=50):
+        """
+        Claims up to batch_size submissions for processing, oldest first.
+        Submissions whose claim timed out on their last attempt, which never
+        got to fail(), are marked 'dead' instead.
+        """
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute(
+                    "UPDATE submissions "
+                    "SET state = 'dead', "
+                        "last_error = 'Not finished within the claim timeout' "
+                    "WHERE state = 'processing' "
+                    "AND available_at <= ? "
+                    "AND attempts >= ?", (now, self.max_attempts))
+
+                rows = conn.execute(
+                    "SELECT submission_id, idfp, ip_addr, body, attempts "
+                    "FROM submissions "
+                    "WHERE state IN ('queued', 'processing') "
+                    "AND available_at <= ? "
+                    "ORDER BY submission_id "
+                    "LIMIT ?", (now, batch_size)).fetchall()
+
+                conn.executemany(
+                    "UPDATE submissions "
+                    "SET state = 'processing', attempts = attempts + 1, "
+                    "available_at = ? "
+                    "WHERE submission_id = ?",
+                    [(now + self.claim_timeout, row[0]) for row in rows])
+                conn.execute("COMMIT")
+            except:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.close()
+
+        return [SpooledSubmission(submission_id=row[0], idfp=row[1],
+            ip_addr=row[2], body=str(row[3]), attempts=row[4] + 1)
+            for row in rows]
+
+    def complete(self, submission_id):
+        """Removes a submission that has been applied (or can be ignored)."""
+        conn = self._connect()
+        try:
+            conn.execute("DELETE FROM submissions WHERE submission_id = ?",
+                    (submission_id,))
+        finally:
+            conn.close()
+
+    def fail(self, submission_id, error, retry=True):
+        """
+        Records a failed attempt. The submission is retried later unless
+        retry is False or it ran out of attempts, in which case it is kept
+        as 'dead' for inspection.
+        """
+        if isinstance(error, str):
+            error = unicode(error, 'utf-8', 'replace')
+
+        conn = self._connect()
+        try:
+            conn.execute(
+                "UPDATE submissions "
+                "SET state = CASE WHEN ? AND attempts < ? "
+                                 "THEN 'queued' ELSE 'dead' END, "
+                    "available_at = ?, "
+                    "last_error = ? "
+                "WHERE submission_id = ?",
+                (retry, self.max_attempts, time.time() + self.retry_delay,
+                    error, submission_id))
+        finally:
+            conn.close()
+
+    def counts(self):
+        """Number of spooled submissions by state."""
+        conn = self._connect()
+        try:
+            return dict(conn.execute(
+                "SELECT state, count(*) FROM submissions GROUP BY state").\
+                fetchall())
+        finally:
+            conn.close()
+
+
+def spool_from_settings(settings):
+    """
+    Builds the submission spool from the xonstat.spool_* settings.
+    """
+    try:
+        path = settings['xonstat.spool_path']
+    except:
+        path = 'spool.db'
+
+    try:
+        max_attempts = int(settings['xonstat.spool_max_attempts'])
+    except:
+        max_attempts = 5
+
+    try:
+        retry_delay = int(settings['xonstat.spool_retry_delay'])
+    except:
+        retry_delay = 60
+
+    return SubmissionSpool(path, max_attempts=max_attempts,
+            retry_delay=retry_delay)
@@ -0,0 +1,209 @@
+import logging
+from collections import Counter
+
+log = logging.getLogger(__name__)
+
+# game metadata keys we keep
+META_KEYS = frozenset(['V', 'T', 'G', 'M', 'S', 'C', 'R', 'W', 'I'])
+
+# indexes into a weapon's accuracy list (see PlayerRecord)
+FIRED, MAX, HIT, ACTUAL, FRAGS = range(5)
+
+# accuracy event suffixes and the index they fill. The "cnt-" variants come
+# first since "-fired" and "-hit" are suffixes of them.
+ACC_FIELDS = (
+    ('-cnt-fired', FIRED),
+    ('-cnt-hit',   HIT),
+    ('-fired',     MAX),
+    ('-hit',       ACTUAL),
+    ('-frags',     FRAGS),
+)
+
+# "acc-<weapon>-<field>" keys split into (weapon_cd, index). Once the known
+# weapons are set this holds exactly their keys, otherwise keys are added as
+# they are seen.
+_acc_keys = {}
+_acc_keys_max = 4096
+
+# weapon codes from cd_weapon, or None when they haven't been loaded
+known_weapons = None
+
+# accuracy events dropped because of an unknown weapon code, by code
+unknown_weapons = Counter()
+
+
+def set_known_weapons(weapon_cds):
+    """
+    Sets the weapon codes accuracy events are accepted for and precomputes
+    the table of their "acc-" keys. Events for any other weapon are counted
+    in unknown_weapons and dropped.
+    """
+    global _acc_keys, known_weapons
+
+    acc_keys = {}
+    for weapon_cd in weapon_cds:
+        for (suffix, index) in ACC_FIELDS:
+            acc_keys['acc-' + weapon_cd + suffix] = (weapon_cd, index)
+
+    known_weapons = frozenset(weapon_cds)
+    _acc_keys = acc_keys
+
+
+class PlayerRecord(object):
+    """
+    Everything a submission says about one player:
+
+    hashkey - the P line (a hashkey, "bot#N" or "player#N")
+    nick - the n line, or None
+    team - the t line as an int, or None
+    matches, scoreboardvalid - whether those events were sent
+    alivetime - seconds as a float, or None
+    rank - int, or None
+    scoreboard - scoreboard-* events as ints, keyed without the prefix
+    weapons - accuracy by weapon code, as a list of the raw fired, max, hit,
+        actual and frags floats (indexed by FIRED, MAX, ...). A value is None
+        when the event was not sent.
+    """
+    __slots__ = ('hashkey', 'nick', 'team', 'matches', 'scoreboardvalid',
+            'alivetime', 'rank', 'scoreboard', 'weapons')
+
+    def __init__(self, hashkey):
+        self.hashkey = hashkey
+        self.nick = None
+        self.team = None
+        self.matches = False
+        self.scoreboardvalid = False
+        self.alivetime = None
+        self.rank = None
+        self.scoreboard = {}
+        self.weapons = {}
+
+    def __repr__(self):
+        return "<PlayerRecord(%s, %s)>" % (self.hashkey, self.rank)
+
+    def is_bot(self):
+        return self.hashkey.startswith('bot')
+
+    def has_accuracy(self):
+        """Whether any weapon has a fired count (warmup games have none)."""
+        for acc in self.weapons.itervalues():
+            if acc[FIRED] is not None:
+                return True
+        return False
+
+
+def parse_accuracy_key(subkey):
+    """
+    Splits "acc-<weapon>-<field>" into (weapon_cd, index) or returns None.
+    """
+    split = _acc_keys.get(subkey)
+    if split is not None:
+        return split
+
+    for (suffix, index) in ACC_FIELDS:
+        if subkey.endswith(suffix):
+            weapon_cd = subkey[4:-len(suffix)]
+            if not weapon_cd:
+                return None
+            split = (weapon_cd, index)
+            if known_weapons is None and len(_acc_keys) < _acc_keys_max:
+                _acc_keys[subkey] = split
+            return split
+    return None
+
+
+def _unknown_weapon(weapon_cd):
+    if unknown_weapons[weapon_cd] == 0:
+        log.warning("Dropping accuracy events for unknown weapon "
+                "{0}".format(weapon_cd))
+    unknown_weapons[weapon_cd] += 1
+
+
+def parse_submission(lines):
+    """
+    Parses the lines of a stats submission in a single pass. Returns the game
+    metadata dictionary and a list of PlayerRecord, in submission order.
+
+    Lines that don't parse are skipped, as are events following a team (Q)
+    line, which belong to the team and not to the last player.
+    """
+    game_meta = {}
+    players = []
+    player = None
+    acc_key = _acc_keys.get
+
+    for line in lines:
+        (key, sep, value) = line.strip().partition(' ')
+        if not sep:
+            # no key/value pair - move on to the next line
+            continue
+
+        if key == 'e':
+            if player is None:
+                continue
+
+            (subkey, sep, subvalue) = value.partition(' ')
+            if not sep:
+                continue
+
+            try:
+                split = acc_key(subkey)
+                if split is None and subkey.startswith('acc-'):
+                    split = parse_accuracy_key(subkey)
+                    if split is not None and known_weapons is not None:
+                        # not in the table of known weapon keys
+                        if split[0] not in known_weapons:
+                            _unknown_weapon(split[0])
+                        continue
+
+                if split is not None:
+                    acc = player.weapons.get(split[0])
+                    if acc is None:
+                        acc = player.weapons[split[0]] = [None] * 5
+                    acc[split[1]] = float(subvalue)
+                elif subkey.startswith('scoreboard-'):
+                    player.scoreboard[subkey[11:]] = int(subvalue)
+                elif subkey == 'matches':
+                    player.matches = True
+                elif subkey == 'scoreboardvalid':
+                    player.scoreboardvalid = True
+                elif subkey == 'alivetime':
+                    player.alivetime = float(subvalue)
+                elif subkey == 'rank':
+                    player.rank = int(subvalue)
+            except ValueError:
+                log.debug("Skipping malformed event: {0}".format(line))
+
+        elif key == 'P':
+            player = PlayerRecord(value)
+            players.append(player)
+
+        elif key == 'n':
+            if player is not None:
+                try:
+                    # nicks can have international characters
+                    player.nick = unicode(value, 'utf-8')
+                except UnicodeDecodeError:
+                    pass
+
+        elif key == 't':
+            if player is not None:
+                try:
+                    player.team = int(value)
+                except ValueError:
+                    pass
+
+        elif key == 'Q':
+            # team events follow, they're not for the last player
+            player = None
+
+        elif key in META_KEYS:
+            if key == 'S':
+                # server names can have international characters
+                try:
+                    value = unicode(value, 'utf-8')
+                except UnicodeDecodeError:
+                    continue
+            game_meta[key] = value
+
+    return (game_meta, players)
@@ -1,7 +1,7 @@
 <%inherit file="base.mako"/>
 <%namespace name="nav" file="nav.mako" />
 <%namespace file="scoreboard.mako" import="scoreboard" />
-<%namespace file="navlinks.mako" import="navlinks" />
+<%namespace file="navlinks.mako" import="cursorlinks" />
 
 <%block name="navigation">
 ${nav.nav('games')}
@@ -28,6 +28,6 @@ Game Index
 </div>
 
 <!-- navigation links -->
-${navlinks("game_index", games.page, games.last_page)}
+${cursorlinks("game_index", games)}
 % endif
 
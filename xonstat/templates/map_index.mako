@@ -1,6 +1,6 @@
 <%inherit file="base.mako"/>
 <%namespace name="nav" file="nav.mako" />
-<%namespace file="navlinks.mako" import="navlinks" />
+<%namespace file="navlinks.mako" import="cursorlinks" />
 
 <%block name="navigation">
 ${nav.nav('maps')}
@@ -37,6 +37,6 @@ Map Index
     % endif
 
     <!-- navigation links -->
-    ${navlinks("map_index", maps.page, maps.last_page)}
+    ${cursorlinks("map_index", maps)}
   </div> <!-- /span4 -->
 </div> <!-- /row -->
@@ -121,18 +121,18 @@ ${parent.title()}
         </tr>
       </thead>
       <tbody>
-        % for (game, srv, map, pgstat) in recent_games:
+        % for game in recent_games:
         % if game != '-':
         <tr>
           <td><a class="btn btn-primary btn-small" href="${request.route_url('game_info', id=game.game_id)}" title="View detailed information about this game">View</a></td>
           <td class="gt_icon"><img title="${game.game_type_cd}" src="/static/images/icons/24x24/${game.game_type_cd}.png" alt="${game.game_type_cd}" /></td>
           <td><span class="abstime" data-epoch="${game.epoch()}" title="${game.start_dt.strftime('%a, %d %b %Y %H:%M:%S UTC')}">${game.fuzzy_date()}</span></td>
           <td>
-            % if pgstat.player_id > 2:
-            <a href="${request.route_url('player_info', id=pgstat.player_id)}" title="Go to the player info page for this player">${pgstat.nick_html_colors()|n}</a>
+            % if game.player_id > 2:
+            <a href="${request.route_url('player_info', id=game.player_id)}" title="Go to the player info page for this player">${game.nick_html_colors()|n}</a>
           </td>
             % else:
-            ${pgstat.nick_html_colors()|n}
+            ${game.nick_html_colors()|n}
           </td>
             % endif
         </tr>
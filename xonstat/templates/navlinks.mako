@@ -66,3 +66,35 @@ if 'search_query' in kwargs.keys():
     <a class="pagination" href="${request.route_url(view, **kwargs)}" name="Go to page ${page_num}">${page_num}</a>
 % endif
 </%def>
+
+<%def name="cursorlinks(view, page, **kwargs)">
+<%
+search_query = kwargs.pop('search_query', None) or {}
+pages = page.page_count()
+%>
+% if page.previous_cursor is not None:
+    % if page.page is None:
+    <% kwargs['_query'] = dict(search_query) %>
+    <a class="pagination" href="${request.route_url(view, **kwargs)}" name="First Page">first</a>
+    % endif
+    <% kwargs['_query'] = dict(search_query, before=page.previous_cursor) %>
+    <a class="pagination" href="${request.route_url(view, **kwargs)}" name="Previous Page">previous</a>
+% endif
+% if pages is not None and pages > 1:
+    % for i in range(1, pages+1):
+        % if i == page.page:
+<span class="pagination" style="color:#d95b00;">${i}</span>
+        % else:
+    <% kwargs['_query'] = dict(search_query, page=i) %>
+    <a class="pagination" href="${request.route_url(view, **kwargs)}" name="Go to page ${i}">${i}</a>
+        % endif
+    % endfor
+% endif
+% if page.next_cursor is not None:
+    <% kwargs['_query'] = dict(search_query, after=page.next_cursor) %>
+    <a class="pagination" href="${request.route_url(view, **kwargs)}" name="Next Page">next</a>
+% endif
+% if page.item_count is not None:
+    <span class="pagination">${page.item_count} in total</span>
+% endif
+</%def>
@@ -1,6 +1,6 @@
 <%inherit file="base.mako"/>
 <%namespace name="nav" file="nav.mako" />
-<%namespace file="navlinks.mako" import="navlinks" />
+<%namespace file="navlinks.mako" import="cursorlinks" />
 
 <%block name="navigation">
 ${nav.nav('games')}
@@ -77,5 +77,5 @@ Recent Games
 </div>
 
 <!-- navigation links -->
-${navlinks("player_game_index", games.page, games.last_page, player_id=player_id)}
+${cursorlinks("player_game_index", games, player_id=player_id)}
 % endif
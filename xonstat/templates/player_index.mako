@@ -1,6 +1,6 @@
 <%inherit file="base.mako"/>
 <%namespace name="nav" file="nav.mako" />
-<%namespace file="navlinks.mako" import="navlinks" />
+<%namespace file="navlinks.mako" import="cursorlinks" />
 
 <%block name="navigation">
 ${nav.nav('players')}
@@ -35,6 +35,6 @@ Player Index
     </table>
 % endif
 
-    ${navlinks("player_index", players.page, players.last_page)}
+    ${cursorlinks("player_index", players)}
   </div> <!-- /span4 -->
 </div> <!-- /row -->
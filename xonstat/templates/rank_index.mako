@@ -1,5 +1,5 @@
 <%inherit file="base.mako"/>
-<%namespace file="navlinks.mako" import="navlinks" />
+<%namespace file="navlinks.mako" import="cursorlinks" />
 
 <%block name="title">
 % if game_type_cd == 'dm':
@@ -35,5 +35,5 @@ Capture The Flag Rank Index
 </table>
 
 <!-- navigation links -->
-${navlinks("rank_index", ranks.page, ranks.last_page, game_type_cd=game_type_cd)}
+${cursorlinks("rank_index", ranks, game_type_cd=game_type_cd)}
 % endif
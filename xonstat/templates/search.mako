@@ -1,5 +1,5 @@
 <%inherit file="base.mako"/>
-<%namespace file="navlinks.mako" import="navlinks" />
+<%namespace file="navlinks.mako" import="cursorlinks" />
 
 % if results == None:
 <h2>Advanced Search</h2>
@@ -106,7 +106,7 @@
 % endif
 
 <!-- navigation links -->
-${navlinks("search", results.page, results.last_page, search_query=query)}
+${cursorlinks("search", results, search_query=query)}
 % endif
 
 <%block name="js">
@@ -15,9 +15,9 @@ Server Game Index for ${server.name} - ${parent.title()}
 % endfor
 % endif
 
-% if games.previous_page:
-<a href="${request.route_url("server_game_index", server_id=server.server_id, page=games.previous_page)}" name="Previous Page">Previous</a>
+% if games.previous_cursor is not None:
+<a href="${request.route_url("server_game_index", server_id=server.server_id, page=1, _query={'before': games.previous_cursor})}" name="Previous Page">Previous</a>
 % endif
-% if games.next_page:
-<a href="${request.route_url("server_game_index", server_id=server.server_id, page=games.next_page)}" name="Next Page">Next</a>
+% if games.next_cursor is not None:
+<a href="${request.route_url("server_game_index", server_id=server.server_id, page=1, _query={'after': games.next_cursor})}" name="Next Page">Next</a>
 % endif
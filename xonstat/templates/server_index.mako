@@ -1,6 +1,6 @@
 <%inherit file="base.mako"/>
 <%namespace name="nav" file="nav.mako" />
-<%namespace file="navlinks.mako" import="navlinks" />
+<%namespace file="navlinks.mako" import="cursorlinks" />
 
 <%block name="navigation">
 ${nav.nav('servers')}
@@ -35,6 +35,6 @@ Server Index
     </table>
     % endif
 
-    ${navlinks("server_index", servers.page, servers.last_page)}
+    ${cursorlinks("server_index", servers)}
   </div> <!-- /span4 -->
 </div> <!-- /row -->
@@ -22,3 +22,319 @@ class TestMyView(unittest.TestCase):
         info = my_view(request)
         self.assertEqual(info['root'].name, 'root')
         self.assertEqual(info['project'], 'XonStat')
+
+
+class EloStub(object):
+    def __init__(self, player_id, elo, k=1.0, games=0):
+        self.player_id = player_id
+        self.elo = elo
+        self.k = k
+        self.games = games
+
+
+class GameStub(object):
+    def __init__(self, game_type_cd):
+        self.game_type_cd = game_type_cd
+
+
+class TestEloAdjustments(unittest.TestCase):
+    """
+    The NumPy Elo engine has to agree with the pairwise loop.
+    """
+    def setUp(self):
+        from xonstat import elo
+        if elo.numpy is None:
+            self.skipTest("NumPy is not installed")
+        self.elo = elo
+        self.random = __import__('random').Random(1234)
+
+    def make_game(self, n, score_range=(-20, 200), elo_range=(100, 1500)):
+        elos = {}
+        scores = {}
+        for pid in range(3, n + 3):
+            elos[pid] = EloStub(pid, self.random.uniform(*elo_range))
+            scores[pid] = self.random.randint(*score_range) / \
+                    float(self.random.randint(60, 600))
+        return (elos, scores)
+
+    def assertParity(self, game_type_cd, elos, scores):
+        ep = self.elo.ELOPARMS
+        expected = self.elo.elo_adjustments(game_type_cd, elos, scores, ep)
+        actual = self.elo.elo_adjustments_numpy(game_type_cd, elos, scores, ep)
+        self.assertEqual(sorted(expected.keys()), sorted(actual.keys()))
+        for pid in expected:
+            self.assertAlmostEqual(expected[pid], actual[pid], places=9)
+
+    def test_random_games(self):
+        for game_type_cd in ('dm', 'tdm', 'ctf', 'duel'):
+            for n in (2, 3, 8, 16, 32, 64):
+                (elos, scores) = self.make_game(n)
+                self.assertParity(game_type_cd, elos, scores)
+
+    def test_draws(self):
+        for game_type_cd in ('dm', 'duel'):
+            (elos, scores) = self.make_game(8, score_range=(0, 0))
+            self.assertParity(game_type_cd, elos, scores)
+
+    def test_negative_scores(self):
+        (elos, scores) = self.make_game(16, score_range=(-50, -1))
+        self.assertParity('dm', elos, scores)
+
+    def test_equal_elos(self):
+        (elos, scores) = self.make_game(16, elo_range=(100, 100))
+        self.assertParity('dm', elos, scores)
+
+    def test_clamped_elo_distance(self):
+        (elos, scores) = self.make_game(16, elo_range=(100, 100))
+        for pid in elos.keys()[:4]:
+            elos[pid].elo = 5000
+        self.assertParity('dm', elos, scores)
+
+    def test_equal_scores(self):
+        (elos, scores) = self.make_game(8)
+        for pid in scores:
+            scores[pid] = 1.5
+        self.assertParity('duel', elos, scores)
+        self.assertParity('dm', elos, scores)
+
+    def test_update_elos(self):
+        (elos, scores) = self.make_game(32)
+        (loop_elos, loop_scores) = ({}, dict(scores))
+        for (pid, e) in elos.items():
+            loop_elos[pid] = EloStub(pid, e.elo)
+
+        numpy = self.elo.numpy
+        game = GameStub('dm')
+        rows = [{'player_id':pid} for pid in elos]
+        try:
+            self.elo.update_elos(game, None, elos, scores, self.elo.ELOPARMS,
+                    rows)
+            self.elo.numpy = None
+            self.elo.update_elos(game, None, loop_elos, loop_scores,
+                    self.elo.ELOPARMS, [])
+        finally:
+            self.elo.numpy = numpy
+
+        for pid in elos:
+            self.assertAlmostEqual(elos[pid].elo, loop_elos[pid].elo, places=9)
+            self.assertEqual(elos[pid].games, loop_elos[pid].games)
+        for row in rows:
+            self.assertTrue('elo_delta' in row)
+
+
+def _reference_png(buf, width, height):
+    """
+    The PNG of buf as the badges encoded it before encode_png, one pixel at
+    a time and at level 9.
+    """
+    import zlib
+    from xonstat import png
+    buf = bytearray(buf)
+    width_byte_4 = width * 4
+    # fix color ordering (BGRA -> RGBA)
+    for byte in xrange(width*height):
+        pos = byte * 4
+        buf[pos:pos+4] = bytearray([buf[pos+2], buf[pos+1], buf[pos+0], buf[pos+3]])
+    raw_data = b"".join(b'\x00' + bytes(buf[span:span + width_byte_4]) for span in range(0, (height-1) * width * 4 + 1, width_byte_4))
+    return png._png(width, height, zlib.compress(raw_data, 9))
+
+
+def _decode_pixels(data):
+    """
+    The width, height and RGBA bytes of a PNG as written by encode_png (8
+    bit RGBA, not interlaced, in a single IDAT chunk, filters none, sub and
+    up).
+    """
+    import struct
+    import zlib
+    from xonstat.png import _signature
+    if data[0:8] != _signature:
+        raise ValueError("Not a PNG")
+
+    pos = 8
+    chunks = {}
+    while pos < len(data):
+        (length,) = struct.unpack("!I", data[pos:pos + 4])
+        tag = data[pos + 4:pos + 8]
+        chunks[tag] = data[pos + 8:pos + 8 + length]
+        pos += 12 + length
+
+    (width, height, depth, color_type, compression, filter_method,
+            interlace) = struct.unpack("!2I5B", chunks[b'IHDR'])
+    if (depth, color_type, interlace) != (8, 6, 0):
+        raise ValueError("Only 8 bit RGBA PNGs without interlacing")
+
+    raw = bytearray(zlib.decompress(chunks[b'IDAT']))
+    stride = width * 4
+    pixels = bytearray()
+    previous = bytearray(stride)
+    for y in xrange(height):
+        filter_type = raw[y * (stride + 1)]
+        line = raw[y * (stride + 1) + 1:(y + 1) * (stride + 1)]
+        if filter_type == 1:
+            for i in xrange(4, stride):
+                line[i] = (line[i] + line[i - 4]) & 0xFF
+        elif filter_type == 2:
+            for i in xrange(stride):
+                line[i] = (line[i] + previous[i]) & 0xFF
+        elif filter_type != 0:
+            raise ValueError("Unsupported filter type %d" % filter_type)
+        pixels += line
+        previous = line
+
+    return (width, height, bytes(pixels))
+
+
+class TestPngEncoding(unittest.TestCase):
+    """
+    The badge PNG encoder has to produce the same pixels as the former
+    per-pixel one, whatever the compression level and filter.
+    """
+    def setUp(self):
+        from xonstat import png
+        self.png = png
+        self.random = __import__('random').Random(1234)
+
+    def make_surface(self, width, height):
+        # a gradient with noise on top, in cairo's BGRA byte order
+        buf = bytearray(width * height * 4)
+        for y in range(height):
+            for x in range(width):
+                pos = (y * width + x) * 4
+                buf[pos] = (x * 255 // max(width - 1, 1)) & 0xFF
+                buf[pos + 1] = (y * 255 // max(height - 1, 1)) & 0xFF
+                buf[pos + 2] = self.random.randint(0, 255)
+                buf[pos + 3] = self.random.choice((0, 128, 255))
+        return str(buf)
+
+    def assertPixelParity(self, buf, width, height):
+        expected = _decode_pixels(
+                _reference_png(buf, width, height))
+        for png_filter in sorted(self.png.filters):
+            for level in (0, 1, 6, 9):
+                actual = _decode_pixels(self.png.encode_png(buf,
+                    width, height, level, png_filter))
+                self.assertEqual(expected, actual)
+
+    def test_same_file_by_default(self):
+        buf = self.make_surface(560, 70)
+        self.assertEqual(_reference_png(buf, 560, 70),
+                self.png.encode_png(buf, 560, 70))
+
+    def test_channel_order(self):
+        buf = str(bytearray([1, 2, 3, 4, 5, 6, 7, 8]))
+        (width, height, pixels) = _decode_pixels(
+                self.png.encode_png(buf, 2, 1))
+        self.assertEqual((width, height), (2, 1))
+        self.assertEqual(bytearray(pixels), bytearray([3, 2, 1, 4, 7, 6, 5, 8]))
+
+    def test_badge_sizes(self):
+        for (width, height) in ((560, 70), (560, 40), (1, 1), (3, 5)):
+            self.assertPixelParity(self.make_surface(width, height), width,
+                    height)
+
+    def test_without_numpy(self):
+        numpy = self.png.numpy
+        try:
+            self.png.numpy = None
+            self.assertPixelParity(self.make_surface(40, 12), 40, 12)
+        finally:
+            self.png.numpy = numpy
+
+    def test_writable_buffer_untouched(self):
+        buf = bytearray(self.make_surface(16, 4))
+        before = str(buf)
+        self.png.encode_png(buf, 16, 4, 6, 'up')
+        self.assertEqual(before, str(buf))
+
+
+class TestCursorTokens(unittest.TestCase):
+    """
+    Listing cursors come from the query string, so a token that decodes
+    but doesn't fit the sort columns has to be treated as no cursor.
+    """
+    def setUp(self):
+        import base64
+        import sqlalchemy as sa
+        from xonstat import pagination
+        self.pagination = pagination
+        self.b64 = base64
+        self.columns = (sa.Column('rank', sa.Integer),
+                sa.Column('game_id', sa.BigInteger))
+
+    def token(self, text):
+        return self.b64.urlsafe_b64encode(text).rstrip('=')
+
+    def test_round_trip(self):
+        token = self.pagination.encode_cursor((3, 2**40))
+        self.assertEqual(self.pagination.decode_cursor(token, self.columns),
+                [3, 2**40])
+
+    def test_bad_tokens(self):
+        for token in ('!!', self.token('{"a":1}'), self.token('[1]'),
+                self.token('["x",1]'), self.token('[1.5,1]'),
+                self.token('[true,1]'), self.token('[2147483648,1]'),
+                self.token('[1,9223372036854775808]')):
+            self.assertEqual(
+                    self.pagination.decode_cursor(token, self.columns), None)
+
+
+class TestWeaponRows(unittest.TestCase):
+    """
+    Accuracy events a player didn't send must not turn into NULLs in the
+    weapon rows, the pages and player_weapon_series need numbers.
+    """
+    def setUp(self):
+        import sys
+        import xonstat.views.submission
+        from collections import namedtuple
+        from xonstat.submission_parser import PlayerRecord
+        self.Stub = namedtuple('Stub', ['player_id', 'game_id'])
+        self.submission = sys.modules['xonstat.views.submission']
+        self.record = PlayerRecord('abc')
+        self.record.nick = 'player'
+
+    def pwstats(self, acc, version='2'):
+        self.record.weapons = {'vortex':acc}
+        return self.submission.create_player_weapon_stats(
+                player=self.Stub(player_id=3, game_id=None),
+                game=self.Stub(player_id=None, game_id=7),
+                record=self.record, game_meta={'V':version})
+
+    def test_only_fired(self):
+        from xonstat.weapon_series import series_rows
+        pwstats = self.pwstats([10.0, None, None, None, None])
+        self.assertEqual([(pwstat['fired'], pwstat['max'], pwstat['hit'],
+            pwstat['actual'], pwstat['frags']) for pwstat in pwstats],
+            [(10, 0, 0, 0, 0)])
+        self.assertEqual(series_rows(pwstats), [(3, 'vortex', 7, 10, 0, 0)])
+
+    def test_version_1_halved(self):
+        pwstats = self.pwstats([10.0, 20.0, 4.0, None, None], version='1')
+        self.assertEqual((pwstats[0]['fired'], pwstats[0]['max'],
+            pwstats[0]['hit'], pwstats[0]['actual']), (5, 10, 2, 0))
+
+
+class TestSubmissionSpool(unittest.TestCase):
+    """
+    A submission that takes the worker down never gets to fail(), so its
+    claim timing out has to count as a failed attempt.
+    """
+    def setUp(self):
+        import os
+        import tempfile
+        from xonstat.spool import SubmissionSpool
+        self.dir = tempfile.mkdtemp()
+        self.spool = SubmissionSpool(os.path.join(self.dir, 'spool.db'),
+                max_attempts=2, claim_timeout=-1)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.dir)
+
+    def test_timed_out_claims_die(self):
+        self.spool.enqueue('server', 'match', None, None, 'body')
+        self.assertEqual(len(self.spool.claim()), 1)
+        self.assertEqual(len(self.spool.claim()), 1)
+        self.assertEqual(self.spool.claim(), [])
+        self.assertEqual(self.spool.counts(), {'dead':1})
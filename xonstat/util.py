@@ -1,9 +1,19 @@
+import logging
 import re
 from colorsys import rgb_to_hls, hls_to_rgb
 from cgi import escape as html_escape
 from datetime import datetime, timedelta
 from decimal import Decimal
 from collections import namedtuple
+from sqlalchemy import bindparam
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.types import to_instance
+
+log = logging.getLogger(__name__)
+
+# the types in the casts of sql_values are spelled the way PostgreSQL does
+_sql_dialect = postgresql.dialect()
 
 # Map of special chars to ascii from Darkplace's console.c.
 _qfont_table = [
@@ -110,10 +120,6 @@ def html_colors(qstr=''):
     return html + "</span>" * len(_all_colors.findall(qstr))
 
 
-def page_url(page):
-    return current_route_url(request, page=page, _query=request.GET)
-
-
 def pretty_date(time=False):
     '''Returns a human-readable relative date.'''
     now = datetime.utcnow()
@@ -179,3 +185,70 @@ def to_json(data):
             result[key] = to_json(value.to_dict())
     return result
 
+
+def game_to_dict(game, server, gmap):
+    """A game of a listing with its server and map names, for JSON."""
+    result = game.to_dict()
+    result['server_name'] = server.name
+    result['map_id'] = gmap.map_id
+    result['map_name'] = gmap.name
+    return result
+
+
+def sql_add(total, value):
+    """Adds up like SQL's SUM: None values are skipped."""
+    if total is None:
+        return value
+    if value is None:
+        return total
+    return total + value
+
+
+def sql_values(rows, types, cast=True):
+    """
+    Builds a VALUES list for rows of tuples, returning the SQL and its bind
+    parameters. types holds the SQLAlchemy type of each tuple element, which
+    its parameter is bound with. With cast, the values are also cast to
+    their types in the SQL, as a VALUES list outside of an INSERT needs.
+    """
+    types = [to_instance(type_) for type_ in types]
+    bindparams = []
+    values = []
+    for (i, row) in enumerate(rows):
+        names = []
+        for (j, (value, type_)) in enumerate(zip(row, types)):
+            name = 'v%d_%d' % (i, j)
+            bindparams.append(bindparam(name, value, type_=type_))
+            if cast:
+                names.append("CAST(:%s AS %s)" % (name,
+                    type_.compile(dialect=_sql_dialect)))
+            else:
+                names.append(":" + name)
+        values.append("(%s)" % ", ".join(names))
+    return ("VALUES " + ", ".join(values), bindparams)
+
+
+def retry_in_savepoint(session, description, add, *args):
+    """
+    Runs add(*args), which adds to a table's rows by updating the existing
+    ones and inserting the missing ones, in a savepoint of session. When
+    another transaction inserts one of the same rows first, the unique
+    violation rolls back to the savepoint and add is retried once, which
+    then finds the row. Other errors roll back to the savepoint too, so the
+    rest of the transaction stays usable, and are raised. description says
+    what is added, for the log.
+    """
+    for attempt in (1, 2):
+        savepoint = session.begin_nested()
+        try:
+            add(*args)
+            savepoint.commit()
+            return
+        except IntegrityError:
+            savepoint.rollback()
+            if attempt == 2:
+                raise
+            log.debug("Retrying {0}".format(description))
+        except:
+            savepoint.rollback()
+            raise
@@ -4,32 +4,43 @@ import re
 import time
 from pyramid.response import Response
 from sqlalchemy import desc, func, over
-from webhelpers.paginate import Page, PageURL
 from xonstat.models import *
-from xonstat.util import page_url
+from xonstat.pagination import CursorPage, cached_count
+from xonstat.util import game_to_dict, to_json
 
 log = logging.getLogger(__name__)
 
 
-def _game_index_data(request):
-    if request.params.has_key('page'):
-        current_page = request.params['page']
-    else:
-        current_page = 1
+def get_scoreboards(game_ids):
+    """
+    The player game stats of several games with one query, as lists keyed
+    by game_id in scoreboard order.
+    """
+    pgstats = dict((game_id, []) for game_id in game_ids)
+    if len(game_ids) == 0:
+        return pgstats
+
+    for pgstat in DBSession.query(PlayerGameStat).\
+            filter(PlayerGameStat.game_id.in_(game_ids)).\
+            order_by(PlayerGameStat.game_id).\
+            order_by(PlayerGameStat.rank).\
+            order_by(PlayerGameStat.score):
+        pgstats[pgstat.game_id].append(pgstat)
+
+    return pgstats
+
 
+def _game_index_data(request):
     games_q = DBSession.query(Game, Server, Map).\
             filter(Game.server_id == Server.server_id).\
             filter(Game.map_id == Map.map_id).\
             order_by(Game.game_id.desc())
 
-    games = Page(games_q, current_page, items_per_page=10, url=page_url)
+    games = CursorPage.from_request(request, games_q, (Game.game_id,),
+            lambda (game, server, map): (game.game_id,), items_per_page=10,
+            item_count=cached_count('games', DBSession.query(Game)))
 
-    pgstats = {}
-    for (game, server, map) in games:
-        pgstats[game.game_id] = DBSession.query(PlayerGameStat).\
-                filter(PlayerGameStat.game_id == game.game_id).\
-                order_by(PlayerGameStat.rank).\
-                order_by(PlayerGameStat.score).all()
+    pgstats = get_scoreboards([game.game_id for (game, server, map) in games])
 
     return {'games':games,
             'pgstats':pgstats}
@@ -50,7 +61,18 @@ def game_index_json(request):
     These games are ordered by game_id, with the most current ones first.
     Paginated. JSON.
     """
-    return [{'status':'not implemented'}]
+    game_index_data = _game_index_data(request)
+    games = game_index_data['games']
+    pgstats = game_index_data['pgstats']
+    games.add_link_header(request)
+
+    return [{
+        'games':    [dict(game_to_dict(game, server, gmap),
+                        players=[to_json(pgstat.to_dict())
+                            for pgstat in pgstats[game.game_id]])
+                    for (game, server, gmap) in games],
+        'page':     games.to_dict(),
+    }]
 
 
 def _game_info_data(request):
@@ -127,18 +149,17 @@ def game_info_json(request):
 
 
 def _rank_index_data(request):
-    if request.params.has_key('page'):
-        current_page = request.params['page']
-    else:
-        current_page = 1
-
     game_type_cd = request.matchdict['game_type_cd']
 
     ranks_q = DBSession.query(PlayerRank).\
             filter(PlayerRank.game_type_cd==game_type_cd).\
             order_by(PlayerRank.rank)
 
-    ranks = Page(ranks_q, current_page, url=page_url)
+    ranks = CursorPage.from_request(request, ranks_q,
+            (PlayerRank.rank, PlayerRank.player_id),
+            lambda rank: (rank.rank, rank.player_id), descending=False,
+            items_per_page=20,
+            item_count=cached_count(('ranks', game_type_cd), ranks_q))
 
     if len(ranks) == 0:
         ranks = None
@@ -160,4 +181,14 @@ def rank_index_json(request):
     """
     Provide a list of gametype ranks, paginated. JSON.
     """
-    return [{'status':'not implemented'}]
+    rank_index_data = _rank_index_data(request)
+    ranks = rank_index_data['ranks'] or []
+    if ranks:
+        ranks.add_link_header(request)
+
+    return [{
+        'game_type_cd': rank_index_data['game_type_cd'],
+        'ranks':        [dict(rank.to_dict(), nick=rank.nick,
+                            elo=float(rank.elo)) for rank in ranks],
+        'page':         ranks.to_dict() if ranks else None,
+    }]
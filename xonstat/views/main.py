@@ -3,21 +3,52 @@ import sqlalchemy.sql.functions as func
 import sqlalchemy.sql.expression as expr
 from datetime import datetime, timedelta
 from pyramid.response import Response
+from pyramid.settings import asbool
+from xonstat import leaderboards, rollups
+from xonstat.cache import CachedValue
 from xonstat.models import *
 from xonstat.util import *
 
 log = logging.getLogger(__name__)
 
-def _main_index_data(request):
+# number of entries in each leaderboard and of recent games
+leaderboard_count = 10
+recent_games_count = 20
+
+# The main page data, recomputed every xonstat.leaderboard_refresh_interval
+# seconds. See configure_leaderboard_cache.
+leaderboard_cache = None
+
+
+def configure_leaderboard_cache(settings):
+    """
+    Sets up the cache of the main page data from the
+    xonstat.leaderboard_refresh_interval and
+    xonstat.leaderboard_background_refresh settings.
+    """
+    global leaderboard_cache
+
+    try:
+        refresh_interval = int(settings['xonstat.leaderboard_refresh_interval'])
+    except:
+        refresh_interval = 60
+
+    leaderboard_cache = CachedValue(lambda: _main_index_data(settings),
+            ttl=refresh_interval)
+
+    if asbool(settings.get('xonstat.leaderboard_background_refresh', False)):
+        leaderboard_cache.start_refresher(
+                on_error=lambda e: log.warning(
+                    "Refreshing the leaderboards failed: {0}".format(e)),
+                cleanup=DBSession.remove)
+
+
+def _main_index_data(settings):
     try: 
-        leaderboard_lifetime = int(
-                request.registry.settings['xonstat.leaderboard_lifetime'])
+        leaderboard_lifetime = int(settings['xonstat.leaderboard_lifetime'])
     except:
         leaderboard_lifetime = 30
 
-    leaderboard_count = 10
-    recent_games_count = 20
-
     # top ranked duelers
     duel_ranks = DBSession.query(PlayerRank.player_id, PlayerRank.nick, 
             PlayerRank.elo).\
@@ -48,48 +79,24 @@ def _main_index_data(request):
     dm_ranks = [(player_id, html_colors(nick), elo) \
             for (player_id, nick, elo) in dm_ranks]
 
-    right_now = datetime.utcnow()
-    back_then = datetime.utcnow() - timedelta(days=leaderboard_lifetime)
-
     # top players by playing time
-    top_players = DBSession.query(Player.player_id, Player.nick, 
-            func.sum(PlayerGameStat.alivetime)).\
-            filter(Player.player_id == PlayerGameStat.player_id).\
-            filter(Player.player_id > 2).\
-            filter(expr.between(PlayerGameStat.create_dt, back_then, right_now)).\
-            order_by(expr.desc(func.sum(PlayerGameStat.alivetime))).\
-            group_by(Player.nick).\
-            group_by(Player.player_id).limit(leaderboard_count).all()
+    top_players = rollups.top_players(DBSession, leaderboard_lifetime,
+            leaderboard_count)
 
     top_players = [(player_id, html_colors(nick), score) \
             for (player_id, nick, score) in top_players]
 
     # top servers by number of total players played
-    top_servers = DBSession.query(Server.server_id, Server.name, 
-            func.count()).\
-            filter(Game.server_id==Server.server_id).\
-            filter(expr.between(Game.create_dt, back_then, right_now)).\
-            order_by(expr.desc(func.count(Game.game_id))).\
-            group_by(Server.server_id).\
-            group_by(Server.name).limit(leaderboard_count).all()
+    top_servers = rollups.top_servers(DBSession, leaderboard_lifetime,
+            leaderboard_count)
 
     # top maps by total times played
-    top_maps = DBSession.query(Game.map_id, Map.name, 
-            func.count()).\
-            filter(Map.map_id==Game.map_id).\
-            filter(expr.between(Game.create_dt, back_then, right_now)).\
-            order_by(expr.desc(func.count())).\
-            group_by(Game.map_id).\
-            group_by(Map.name).limit(leaderboard_count).all()
+    top_maps = rollups.top_maps(DBSession, leaderboard_lifetime,
+            leaderboard_count)
 
     # recent games played in descending order
-    recent_games = DBSession.query(Game, Server, Map, PlayerGameStat).\
-            filter(Game.server_id==Server.server_id).\
-            filter(Game.map_id==Map.map_id).\
-            filter(PlayerGameStat.game_id==Game.game_id).\
-            filter(PlayerGameStat.rank==1).\
-            filter(expr.between(Game.create_dt, back_then, right_now)).\
-            order_by(expr.desc(Game.start_dt)).limit(recent_games_count).all()
+    recent_games = leaderboards.recent_games(DBSession, recent_games_count,
+            since=datetime.utcnow() - timedelta(days=leaderboard_lifetime))
 
     return {'top_players':top_players,
             'top_servers':top_servers,
@@ -105,11 +112,19 @@ def main_index(request):
     """
     Display the main page information.
     """
-    mainindex_data =  _main_index_data(request)
+    if leaderboard_cache is None:
+        cached = _main_index_data(request.registry.settings)
+    else:
+        cached = leaderboard_cache.get()
+        log.debug("Leaderboards are {0:.0f}s old, cache hit rate {1:.2f}".\
+                format(leaderboard_cache.age(), leaderboard_cache.hit_rate()))
+
+    # copy the lists, the padding below must not end up in the cache
+    mainindex_data = dict((key, list(value))
+            for (key, value) in cached.items())
 
-    # FIXME: code clone, should get these from _main_index_data
-    leaderboard_count = 10
-    recent_games_count = 20
+    if leaderboard_cache is not None:
+        mainindex_data['leaderboard_cache'] = leaderboard_cache.stats()
 
     for i in range(leaderboard_count-len(mainindex_data['duel_ranks'])):
         mainindex_data['duel_ranks'].append(('-', '-', '-'))
@@ -130,7 +145,7 @@ def main_index(request):
         mainindex_data['top_maps'].append(('-', '-', '-'))
 
     for i in range(recent_games_count-len(mainindex_data['recent_games'])):
-        mainindex_data['recent_games'].append(('-', '-', '-', '-'))
+        mainindex_data['recent_games'].append('-')
 
     return mainindex_data
 
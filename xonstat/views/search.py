@@ -9,8 +9,8 @@ from sqlalchemy.orm.exc import MultipleResultsFound, NoResultFound
 from sqlalchemy import func
 from xonstat.models import *
 from xonstat.util import strip_colors, qfont_decode
-from xonstat.util import page_url, html_colors
-from webhelpers.paginate import Page, PageURL
+from xonstat.util import html_colors, game_to_dict
+from xonstat.pagination import CursorPage
 
 log = logging.getLogger(__name__)
 
@@ -74,6 +74,22 @@ def search_q(nick=None, server_name=None, map_name=None, create_dt=None,
 
     return (result_type, q)
 
+
+def result_keys(result_type):
+    """
+    How a type of search result is paged: the sort columns, the key of a
+    result and whether the order is descending.
+    """
+    if result_type == "player":
+        return ((Player.player_id,), lambda player: (player.player_id,), False)
+    elif result_type == "server":
+        return ((Server.server_id,), lambda server: (server.server_id,), False)
+    elif result_type == "map":
+        return ((Map.map_id,), lambda gmap: (gmap.map_id,), False)
+    else:
+        return ((Game.game_id,), lambda (game, server, gmap): (game.game_id,),
+                True)
+
 def _search_data(request):
     fs = None
     nick = None
@@ -85,12 +101,6 @@ def _search_data(request):
     query = None
     _query = {}
 
-
-    if request.params.has_key('page'):
-        current_page = request.params['page']
-    else:
-        current_page = 1
-
     if request.params.has_key('fs'):
         query = {'fs':''}
         if request.params.has_key('nick'):
@@ -135,7 +145,9 @@ def _search_data(request):
 
         try:
             if q != None:
-                results = Page(q, current_page, items_per_page=10, url=page_url)
+                (columns, key_of, descending) = result_keys(result_type)
+                results = CursorPage.from_request(request, q, columns, key_of,
+                        descending=descending)
         except Exception as e:
             raise e
             result_type = None
@@ -152,4 +164,22 @@ def search(request):
 
 
 def search_json(request):
-    return [{'status':'not implemented'}]
+    search_data = _search_data(request)
+    result_type = search_data['result_type']
+    results = search_data['results']
+
+    if results is None:
+        return [{'result_type':None, 'results':[], 'page':None}]
+
+    results.add_link_header(request)
+    if result_type == 'game':
+        items = [game_to_dict(game, server, gmap)
+                for (game, server, gmap) in results]
+    else:
+        items = [result.to_dict() for result in results]
+
+    return [{
+        'result_type':  result_type,
+        'results':      items,
+        'page':         results.to_dict(),
+    }]
@@ -1,29 +1,29 @@
 import logging
+import pyramid.httpexceptions
 import sqlalchemy.sql.functions as func
 import sqlalchemy.sql.expression as expr
 import time
 from datetime import datetime, timedelta
 from pyramid.response import Response
 from sqlalchemy import desc
-from webhelpers.paginate import Page, PageURL
+from xonstat import leaderboards, rollups
 from xonstat.models import *
-from xonstat.util import page_url, html_colors
+from xonstat.pagination import CursorPage, cached_count
+from xonstat.util import html_colors, game_to_dict
 
 log = logging.getLogger(__name__)
 
 def _server_index_data(request):
-    if request.params.has_key('page'):
-        current_page = request.params['page']
-    else:
-        current_page = 1
-
     try:
         server_q = DBSession.query(Server).\
                 order_by(Server.server_id.desc())
 
-        servers = Page(server_q, current_page, items_per_page=10, url=page_url)
+        servers = CursorPage.from_request(request, server_q,
+                (Server.server_id,), lambda server: (server.server_id,),
+                item_count=cached_count('servers', server_q))
 
-        
+    except pyramid.httpexceptions.HTTPException:
+        raise
     except Exception as e:
         servers = None
 
@@ -41,7 +41,15 @@ def server_index_json(request):
     """
     Provides a list of all the current servers. JSON.
     """
-    return [{'status':'not implemented'}]
+    servers = _server_index_data(request)['servers']
+    if servers is None:
+        raise pyramid.httpexceptions.HTTPNotFound()
+    servers.add_link_header(request)
+
+    return [{
+        'servers':  [server.to_dict() for server in servers],
+        'page':     servers.to_dict(),
+    }]
 
 
 def _server_info_data(request):
@@ -60,56 +68,26 @@ def _server_info_data(request):
         server = DBSession.query(Server).filter_by(server_id=server_id).one()
 
         # top maps by total times played
-        top_maps = DBSession.query(Game.map_id, Map.name, 
-                func.count()).\
-                filter(Map.map_id==Game.map_id).\
-                filter(Game.server_id==server.server_id).\
-                filter(Game.create_dt > 
-                    (datetime.utcnow() - timedelta(days=leaderboard_lifetime))).\
-                order_by(expr.desc(func.count())).\
-                group_by(Game.map_id).\
-                group_by(Map.name).all()[0:leaderboard_count]
+        top_maps = rollups.top_maps(DBSession, leaderboard_lifetime,
+                leaderboard_count, server_id=server.server_id)
 
         # top players by score
-        top_scorers = DBSession.query(Player.player_id, Player.nick, 
-                func.sum(PlayerGameStat.score)).\
-                filter(Player.player_id == PlayerGameStat.player_id).\
-                filter(Game.game_id == PlayerGameStat.game_id).\
-                filter(Game.server_id == server.server_id).\
-                filter(Player.player_id > 2).\
-                filter(PlayerGameStat.create_dt > 
-                        (datetime.utcnow() - timedelta(days=leaderboard_lifetime))).\
-                order_by(expr.desc(func.sum(PlayerGameStat.score))).\
-                group_by(Player.nick).\
-                group_by(Player.player_id).all()[0:leaderboard_count]
+        top_scorers = rollups.top_scorers(DBSession, leaderboard_lifetime,
+                leaderboard_count, server_id=server.server_id)
 
         top_scorers = [(player_id, html_colors(nick), score) \
                 for (player_id, nick, score) in top_scorers]
 
         # top players by playing time
-        top_players = DBSession.query(Player.player_id, Player.nick, 
-                func.sum(PlayerGameStat.alivetime)).\
-                filter(Player.player_id == PlayerGameStat.player_id).\
-                filter(Game.game_id == PlayerGameStat.game_id).\
-                filter(Game.server_id == server.server_id).\
-                filter(Player.player_id > 2).\
-                filter(PlayerGameStat.create_dt > 
-                        (datetime.utcnow() - timedelta(days=leaderboard_lifetime))).\
-                order_by(expr.desc(func.sum(PlayerGameStat.alivetime))).\
-                group_by(Player.nick).\
-                group_by(Player.player_id).all()[0:leaderboard_count]
+        top_players = rollups.top_players(DBSession, leaderboard_lifetime,
+                leaderboard_count, server_id=server.server_id)
 
         top_players = [(player_id, html_colors(nick), score) \
                 for (player_id, nick, score) in top_players]
 
         # recent games played in descending order
-        recent_games = DBSession.query(Game, Server, Map, PlayerGameStat).\
-            filter(Game.server_id==Server.server_id).\
-            filter(Game.map_id==Map.map_id).\
-            filter(PlayerGameStat.game_id==Game.game_id).\
-            filter(PlayerGameStat.rank==1).\
-            filter(Server.server_id==server.server_id).\
-            order_by(expr.desc(Game.start_dt)).all()[0:recent_games_count]
+        recent_games = leaderboards.recent_games(DBSession,
+                recent_games_count, server_id=server.server_id)
 
     except Exception as e:
         server = None
@@ -144,7 +122,7 @@ def server_info(request):
         serverinfo_data['top_players'].append(('-', '-', '-'))
 
     for i in range(recent_games_count-len(serverinfo_data['recent_games'])):
-        serverinfo_data['recent_games'].append(('-', '-', '-', '-'))
+        serverinfo_data['recent_games'].append('-')
 
     return serverinfo_data
 
@@ -158,7 +136,6 @@ def server_info_json(request):
 
 def _server_game_index_data(request):
     server_id = request.matchdict['server_id']
-    current_page = request.matchdict['page']
 
     try:
         server = DBSession.query(Server).filter_by(server_id=server_id).one()
@@ -169,7 +146,9 @@ def _server_game_index_data(request):
                 filter(Game.map_id == Map.map_id).\
                 order_by(Game.game_id.desc())
 
-        games = Page(games_q, current_page, url=page_url)
+        games = CursorPage.from_request(request, games_q, (Game.game_id,),
+                lambda (game, theserver, map): (game.game_id,),
+                items_per_page=20)
     except Exception as e:
         server = None
         games = None
@@ -190,4 +169,12 @@ def server_game_index_json(request):
     """
     List the games played on a given server. Paginated. JSON.
     """
-    return [{'status':'not implemented'}]
+    games = _server_game_index_data(request)['games']
+    games.add_link_header(request)
+
+    return [{
+        'server_id':    int(request.matchdict['server_id']),
+        'games':        [game_to_dict(game, server, gmap)
+                            for (game, server, gmap) in games],
+        'page':         games.to_dict(),
+    }]
@@ -1,19 +1,67 @@
 import datetime
+import hashlib
 import logging
 import os
 import pyramid.httpexceptions
 import re
+import threading
 import time
+import weakref
+from collections import namedtuple
 from pyramid.response import Response
-from sqlalchemy import Sequence
+from pyramid.settings import asbool
+from sqlalchemy import Sequence, event, text
+from sqlalchemy.orm import Session, class_mapper
+from sqlalchemy.orm.util import identity_key
 from sqlalchemy.orm.exc import MultipleResultsFound, NoResultFound
-from xonstat.d0_blind_id import d0_blind_id_verify
+from xonstat.cache import LRUCache
+from xonstat.d0_blind_id import d0_blind_id_verify_pooled
 from xonstat.elo import process_elos
 from xonstat.models import *
-from xonstat.util import strip_colors, qfont_decode
+from xonstat.player_profile import update_career_stats
+from xonstat.ranks import update_game_ranks
+from xonstat.rollups import update_rollups
+from xonstat.spool import spool_from_settings
+from xonstat.submission_parser import parse_submission, set_known_weapons
+from xonstat.submission_parser import FIRED
+from xonstat.util import strip_colors, qfont_decode, sql_values
+from xonstat.weapon_series import update_weapon_series
 
 log = logging.getLogger(__name__)
 
+# Verification results keyed by a digest of the signature and the POST body.
+# Servers resubmit the same signed body when their request times out, so
+# this saves running the keygen binary again. Failed verifications are only
+# kept for negative_verify_ttl seconds.
+verify_cache = LRUCache(maxsize=1000, ttl=600)
+negative_verify_ttl = 10
+
+# When set, verified submissions are spooled here and stored later by the
+# submission worker instead of within the request. See
+# configure_submission_spool.
+submission_spool = None
+
+# Identity caches for the submission path. Nearly every submission comes
+# from a server, on a map and with players we have seen before, so these
+# keep what the lookups in get_or_create_server, get_or_create_map and
+# get_or_create_players found. Entries for rows created or changed by a
+# submission are only cached once its transaction commits.
+server_cache = LRUCache(maxsize=1000, ttl=3600)
+map_cache = LRUCache(maxsize=1000, ttl=3600)
+hashkey_cache = LRUCache(maxsize=10000, ttl=3600)
+
+# what the identity caches saw, but can't keep until the session commits
+_pending_identities = weakref.WeakKeyDictionary()
+
+# queries the identity caches saved in the current request, per thread
+_saved_queries = threading.local()
+
+# Cached stand-ins for the Server and Map records. They carry what the
+# submission needs and what the caches compare against.
+ServerRef = namedtuple('ServerRef', ['server_id', 'name', 'hashkey',
+    'ip_addr', 'revision'])
+MapRef = namedtuple('MapRef', ['map_id', 'name'])
+
 
 def is_blank_game(players):
     """Determine if this is a blank game or not. A blank game is either:
@@ -24,17 +72,15 @@ def is_blank_game(players):
     2) a match in which no player made a positive or negative score AND was
     on the scoreboard
     """
-    r = re.compile(r'acc-.*-cnt-fired')
     flg_nonzero_score = False
     flg_acc_events = False
 
-    for events in players:
-        if is_real_player(events):
-            for (key,value) in events.items():
-                if key == 'scoreboard-score' and value != '0':
-                    flg_nonzero_score = True
-                if r.search(key):
-                    flg_acc_events = True
+    for player in players:
+        if is_real_player(player):
+            if player.scoreboard.get('score', 0) != 0:
+                flg_nonzero_score = True
+            if not flg_acc_events and player.has_accuracy():
+                flg_acc_events = True
 
     return not (flg_nonzero_score and flg_acc_events)
 
@@ -56,12 +102,51 @@ def is_supported_gametype(gametype):
     return flg_supported
 
 
+def configure_verify_cache(settings):
+    """
+    Sizes the verification cache from the xonstat.verify_cache_* settings.
+    """
+    global verify_cache, negative_verify_ttl
+
+    try:
+        size = int(settings['xonstat.verify_cache_size'])
+    except:
+        size = 1000
+
+    try:
+        ttl = int(settings['xonstat.verify_cache_ttl'])
+    except:
+        ttl = 600
+
+    try:
+        negative_verify_ttl = int(settings['xonstat.verify_cache_negative_ttl'])
+    except:
+        negative_verify_ttl = 10
+
+    verify_cache = LRUCache(maxsize=size, ttl=ttl)
+
+
 def verify_request(request):
     try:
-        (idfp, status) = d0_blind_id_verify(
-                sig=request.headers['X-D0-Blind-Id-Detached-Signature'],
-                querystring='',
-                postdata=request.body)
+        sig = request.headers['X-D0-Blind-Id-Detached-Signature']
+        cache_key = hashlib.sha1(sig + '\0' + request.body).hexdigest()
+
+        cached = verify_cache.get(cache_key)
+        if cached is not None:
+            (idfp, status) = cached
+            log.debug('Verification cache hit ({0} hits, {1} misses)'.format(
+                verify_cache.hits, verify_cache.misses))
+        else:
+            (idfp, status) = d0_blind_id_verify_pooled(
+                    sig=sig,
+                    querystring='',
+                    postdata=request.body)
+
+            if idfp and status:
+                verify_cache.set(cache_key, (idfp, status))
+            else:
+                verify_cache.set(cache_key, (idfp, status),
+                        ttl=negative_verify_ttl)
 
         log.debug('\nidfp: {0}\nstatus: {1}'.format(idfp, status))
     except: 
@@ -71,23 +156,23 @@ def verify_request(request):
     return (idfp, status)
 
 
-def num_real_players(player_events, count_bots=False):
+def num_real_players(players, count_bots=False):
     """
     Returns the number of real players (those who played 
     and are on the scoreboard).
     """
     real_players = 0
 
-    for events in player_events:
-        if is_real_player(events, count_bots):
+    for player in players:
+        if is_real_player(player, count_bots):
             real_players += 1
 
     return real_players
 
 
-def has_minimum_real_players(settings, player_events):
+def has_minimum_real_players(settings, players):
     """
-    Determines if the collection of player events has enough "real" players
+    Determines if the collection of player records has enough "real" players
     to store in the database. The minimum setting comes from the config file
     under the setting xonstat.minimum_real_players.
     """
@@ -99,7 +184,7 @@ def has_minimum_real_players(settings, player_events):
     except:
         minimum_required_players = 2
 
-    real_players = num_real_players(player_events)
+    real_players = num_real_players(players)
 
     if real_players < minimum_required_players:
         flg_has_min_real_players = False
@@ -124,9 +209,9 @@ def has_required_metadata(metadata):
     return flg_has_req_metadata
 
 
-def is_real_player(events, count_bots=False):
+def is_real_player(player, count_bots=False):
     """
-    Determines if a given set of player events correspond with a player who
+    Determines if a given player record corresponds with a player who
 
     1) is not a bot (P event does not look like a bot)
     2) played in the game (matches 1)
@@ -137,9 +222,8 @@ def is_real_player(events, count_bots=False):
     flg_is_real = False
 
     # removing 'joins' here due to bug, but it should be here
-    if 'matches' in events and 'scoreboardvalid' in events:
-        if (events['P'].startswith('bot') and count_bots) or \
-            not events['P'].startswith('bot'):
+    if player.matches and player.scoreboardvalid:
+        if count_bots or not player.is_bot():
             flg_is_real = True
 
     return flg_is_real
@@ -175,6 +259,72 @@ def register_new_nick(session, player, new_nick):
     session.add(player)
 
 
+def configure_identity_caches(settings):
+    """
+    Sizes the server, map and hashkey caches from the
+    xonstat.identity_cache_* settings.
+    """
+    global server_cache, map_cache, hashkey_cache
+
+    try:
+        size = int(settings['xonstat.identity_cache_size'])
+    except:
+        size = 1000
+
+    try:
+        hashkey_size = int(settings['xonstat.identity_cache_hashkeys'])
+    except:
+        hashkey_size = 10000
+
+    try:
+        ttl = int(settings['xonstat.identity_cache_ttl'])
+    except:
+        ttl = 3600
+
+    server_cache = LRUCache(maxsize=size, ttl=ttl)
+    map_cache = LRUCache(maxsize=size, ttl=ttl)
+    hashkey_cache = LRUCache(maxsize=hashkey_size, ttl=ttl)
+
+
+def cache_after_commit(session, cache, key, value):
+    """
+    Caches value under key once session commits. The key is dropped from the
+    cache right away, so nobody sees the old value in the meantime.
+    """
+    cache.invalidate(key)
+    _pending_identities.setdefault(session, []).append((cache, key, value))
+
+
+@event.listens_for(Session, 'after_commit')
+def _store_pending_identities(session):
+    for (cache, key, value) in _pending_identities.pop(session, []):
+        cache.set(key, value)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _drop_pending_identities(session):
+    _pending_identities.pop(session, None)
+
+
+@event.listens_for(Session, 'after_begin')
+def _drop_stale_identities(session, transaction, connection):
+    # left over from a transaction that was closed without a commit
+    _pending_identities.pop(session, None)
+
+
+def reset_saved_queries():
+    _saved_queries.count = 0
+
+
+def saved_query():
+    _saved_queries.count = getattr(_saved_queries, 'count', 0) + 1
+
+
+def saved_queries():
+    """Queries the identity caches saved since reset_saved_queries."""
+    return getattr(_saved_queries, 'count', 0)
+
+
 def get_or_create_server(session=None, name=None, hashkey=None, ip_addr=None,
         revision=None):
     """
@@ -183,7 +333,17 @@ def get_or_create_server(session=None, name=None, hashkey=None, ip_addr=None,
     session - SQLAlchemy database session factory
     name - server name of the server to be found or created
     hashkey - server hashkey
+
+    A server whose hashkey, IP address and revision are unchanged since it
+    was last seen is returned from server_cache as a ServerRef.
     """
+    cached = server_cache.get(name)
+    if cached is not None and (cached.hashkey, cached.ip_addr,
+            cached.revision) == (hashkey, ip_addr, revision):
+        saved_query()
+        log.debug("Found cached server {0}".format(cached.server_id))
+        return cached
+
     try:
         # find one by that name, if it exists
         server = session.query(Server).filter_by(name=name).one()
@@ -205,6 +365,9 @@ def get_or_create_server(session=None, name=None, hashkey=None, ip_addr=None,
 
         log.debug("Found existing server {0}".format(server.server_id))
 
+        cache_after_commit(session, server_cache, name, ServerRef(
+            server.server_id, name, hashkey, ip_addr, revision))
+
     except MultipleResultsFound, e:
         # multiple found, so also filter by hashkey
         server = session.query(Server).filter_by(name=name).\
@@ -219,6 +382,9 @@ def get_or_create_server(session=None, name=None, hashkey=None, ip_addr=None,
         log.debug("Created server {0} with hashkey {1}".format(
             server.server_id, server.hashkey))
 
+        cache_after_commit(session, server_cache, name, ServerRef(
+            server.server_id, name, hashkey, server.ip_addr, server.revision))
+
     return server
 
 
@@ -228,18 +394,29 @@ def get_or_create_map(session=None, name=None):
 
     session - SQLAlchemy database session factory
     name - map name of the map to be found or created
+
+    A map seen before is returned from map_cache as a MapRef.
     """
+    cached = map_cache.get(name)
+    if cached is not None:
+        saved_query()
+        return cached
+
     try:
         # find one by the name, if it exists
         gmap = session.query(Map).filter_by(name=name).one()
         log.debug("Found map id {0}: {1}".format(gmap.map_id, 
             gmap.name))
+        cache_after_commit(session, map_cache, name, MapRef(gmap.map_id,
+            name))
     except NoResultFound, e:
         gmap = Map(name=name)
         session.add(gmap)
         session.flush()
         log.debug("Created map id {0}: {1}".format(gmap.map_id,
             gmap.name))
+        cache_after_commit(session, map_cache, name, MapRef(gmap.map_id,
+            name))
     except MultipleResultsFound, e:
         # multiple found, so use the first one but warn
         log.debug(e)
@@ -289,145 +466,250 @@ def create_game(session=None, start_dt=None, game_type_cd=None,
     return game
 
 
-def get_or_create_player(session=None, hashkey=None, nick=None):
+def get_player(session, player_id):
+    """
+    Gets a player by id, from the session's identity map if it's there.
     """
-    Finds a player by hashkey or creates a new one (along with a
-    corresponding hashkey entry. Parameters:
+    if identity_key(Player, player_id) in session.identity_map:
+        saved_query()
+    return session.query(Player).get(player_id)
+
+
+def is_bot_hashkey(hashkey):
+    return re.search('^bot#\d+$', hashkey) or re.search('^bot#\d+#', hashkey)
+
+
+def is_untracked_hashkey(hashkey):
+    return re.search('^player#\d+$', hashkey)
+
+
+def get_or_create_players(session=None, records=None):
+    """
+    Finds or creates the players for a list of PlayerRecord at once and
+    returns them in a dictionary keyed by hashkey. Parameters:
 
     session - SQLAlchemy database session factory
-    hashkey - hashkey of the player to be found or created
-    nick - nick of the player (in case of a first time create)
-    """
-    # if we have a bot
-    if re.search('^bot#\d+$', hashkey) or re.search('^bot#\d+#', hashkey):
-        player = session.query(Player).filter_by(player_id=1).one()
-    # if we have an untracked player
-    elif re.search('^player#\d+$', hashkey):
-        player = session.query(Player).filter_by(player_id=2).one()
-    # else it is a tracked player
-    else:
-        # see if the player is already in the database
-        # if not, create one and the hashkey along with it
-        try:
-            hk = session.query(Hashkey).filter_by(
-                    hashkey=hashkey).one()
-            player = session.query(Player).filter_by(
-                    player_id=hk.player_id).one()
-            log.debug("Found existing player {0} with hashkey {1}".format(
-                player.player_id, hashkey))
-        except:
-            player = Player()
-            session.add(player)
-            session.flush()
+    records - PlayerRecord of the players, the nick is used for new players
 
+    Bots all map to player 1 and untracked players to player 2. Tracked
+    players are resolved with a single query and the missing ones created
+    with one insert each for the players and their hashkeys.
+    """
+    players = {}
+    nicks = {}
+    for record in records:
+        if is_bot_hashkey(record.hashkey):
+            players[record.hashkey] = get_player(session, 1)
+        elif is_untracked_hashkey(record.hashkey):
+            players[record.hashkey] = get_player(session, 2)
+        else:
+            nicks[record.hashkey] = record.nick
+
+    if len(nicks) == 0:
+        return players
+
+    unresolved = nicks.keys()
+    cached_ids = dict((hashkey, hashkey_cache.get(hashkey)) for hashkey in nicks)
+    if None not in cached_ids.values():
+        # everyone has been seen before, so their player rows are enough
+        found = session.query(Player).\
+                filter(Player.player_id.in_(cached_ids.values())).all()
+        by_id = dict((player.player_id, player) for player in found)
+        unresolved = []
+        for (hashkey, player_id) in cached_ids.items():
+            if player_id in by_id:
+                players[hashkey] = by_id[player_id]
+                saved_query()
+            else:
+                hashkey_cache.invalidate(hashkey)
+                unresolved.append(hashkey)
+
+    if len(unresolved) > 0:
+        found = session.query(Hashkey.hashkey, Player).\
+                filter(Hashkey.player_id == Player.player_id).\
+                filter(Hashkey.hashkey.in_(unresolved)).all()
+        for (hashkey, player) in found:
+            players[hashkey] = player
+            cache_after_commit(session, hashkey_cache, hashkey,
+                    player.player_id)
+
+    missing = [hashkey for hashkey in nicks if hashkey not in players]
+    if len(missing) > 0:
+        player_rows = []
+        hashkey_rows = []
+        for (hashkey, player_id) in zip(missing,
+                next_ids(session, 'players_player_id_seq', len(missing))):
             # if nick is given to us, use it. If not, use "Anonymous Player"
             # with a suffix added for uniqueness.
+            nick = nicks[hashkey]
             if nick:
-                player.nick = nick[:128]
-                player.stripped_nick = strip_colors(qfont_decode(nick[:128]))
+                nick = nick[:128]
+                stripped_nick = strip_colors(qfont_decode(nick))
             else:
-                player.nick = "Anonymous Player #{0}".format(player.player_id)
-                player.stripped_nick = player.nick
+                nick = "Anonymous Player #{0}".format(player_id)
+                stripped_nick = nick
+
+            player_rows.append({'player_id':player_id, 'nick':nick,
+                'stripped_nick':stripped_nick})
+            hashkey_rows.append({'player_id':player_id, 'hashkey':hashkey})
+
+        bulk_insert(session, Player, player_rows)
+        bulk_insert(session, Hashkey, hashkey_rows)
+
+        created = session.query(Player).filter(Player.player_id.in_(
+            [row['player_id'] for row in player_rows])).all()
+        by_id = dict((player.player_id, player) for player in created)
+        for row in hashkey_rows:
+            players[row['hashkey']] = by_id[row['player_id']]
+            cache_after_commit(session, hashkey_cache, row['hashkey'],
+                    row['player_id'])
+            log.debug("Created player {0} with hashkey {1}".format(
+                row['player_id'], row['hashkey']))
+
+    return players
+
+
+def next_ids(session, seq_name, count):
+    """
+    Allocates count values from the given sequence in a single round-trip.
+    """
+    if count == 0:
+        return []
 
-            hk = Hashkey(player_id=player.player_id, hashkey=hashkey)
-            session.add(hk)
-            log.debug("Created player {0} ({2}) with hashkey {1}".format(
-                player.player_id, hashkey, player.nick.encode('utf-8')))
+    return [row[0] for row in session.execute(
+        "SELECT nextval('{0}') FROM generate_series(1, :count)".format(
+            seq_name), {'count':count})]
+
+
+def bulk_insert(session, mapped_class, rows, chunk_size=500):
+    """
+    Inserts a list of row dictionaries into the table of mapped_class using
+    multi-VALUES INSERT statements. Rows are grouped by the columns they set,
+    so columns a row doesn't mention still get their database default.
+    (Insert.values() only takes a list of rows from SQLAlchemy 0.8 on.)
+    """
+    table = class_mapper(mapped_class).mapped_table
+
+    groups = {}
+    for row in rows:
+        groups.setdefault(tuple(sorted(row.keys())), []).append(row)
+
+    for (columns, group) in groups.items():
+        types = [table.c[column].type for column in columns]
+        for i in range(0, len(group), chunk_size):
+            (values, bindparams) = sql_values(
+                [[row[column] for column in columns]
+                    for row in group[i:i + chunk_size]],
+                types, cast=False)
+            session.execute(text("INSERT INTO %s (%s) %s" % (table.name,
+                ", ".join(columns), values), bindparams=bindparams))
+
+
+# scoreboard fields and the player_game_stats columns they go to
+scoreboard_columns = {
+    'drops':'drops',
+    'returns':'returns',
+    'fckills':'carrier_frags',
+    'pickups':'pickups',
+    'caps':'captures',
+    'score':'score',
+    'deaths':'deaths',
+    'kills':'kills',
+    'suicides':'suicides',
+}
 
-    return player
 
 def create_player_game_stat(session=None, player=None, 
-        game=None, player_events=None):
+        game=None, record=None):
     """
-    Creates game statistics for a given player in a given game. Parameters:
+    Builds the game statistics row for a given player in a given game. The
+    row is a plain dictionary of player_game_stats columns, written later by
+    insert_player_stats. Parameters:
 
     session - SQLAlchemy session factory
     player - Player record of the player who owns the stats
     game - Game record for the game to which the stats pertain
-    player_events - dictionary for the actual stats that need to be transformed
+    record - PlayerRecord with the actual stats that need to be transformed
     """
 
     # in here setup default values (e.g. if game type is CTF then
     # set kills=0, score=0, captures=0, pickups=0, fckills=0, etc
     # TODO: use game's create date here instead of now()
-    seq = Sequence('player_game_stats_player_game_stat_id_seq')
-    pgstat_id = session.execute(seq)
-    pgstat = PlayerGameStat(player_game_stat_id=pgstat_id, 
-            create_dt=datetime.datetime.utcnow())
+    pgstat = {'create_dt':datetime.datetime.utcnow()}
 
     # set player id from player record
-    pgstat.player_id = player.player_id
+    pgstat['player_id'] = player.player_id
 
     #set game id from game record
-    pgstat.game_id = game.game_id
+    pgstat['game_id'] = game.game_id
 
     # all games have a score and every player has an alivetime
-    pgstat.score = 0
-    pgstat.alivetime = datetime.timedelta(seconds=0)
+    pgstat['score'] = 0
+    pgstat['alivetime'] = datetime.timedelta(seconds=0)
 
     if game.game_type_cd == 'dm' or game.game_type_cd == 'tdm' or game.game_type_cd == 'duel':
-        pgstat.kills = 0
-        pgstat.deaths = 0
-        pgstat.suicides = 0
+        pgstat['kills'] = 0
+        pgstat['deaths'] = 0
+        pgstat['suicides'] = 0
     elif game.game_type_cd == 'ctf':
-        pgstat.kills = 0
-        pgstat.captures = 0
-        pgstat.pickups = 0
-        pgstat.drops = 0
-        pgstat.returns = 0
-        pgstat.carrier_frags = 0
-
-    for (key,value) in player_events.items():
-        if key == 'n': 
-            pgstat.nick = value[:128]
-            pgstat.stripped_nick = strip_colors(qfont_decode(pgstat.nick))
-        if key == 't': pgstat.team = int(value)
-        if key == 'rank': pgstat.rank = int(value)
-        if key == 'alivetime': 
-            pgstat.alivetime = datetime.timedelta(seconds=int(round(float(value))))
-        if key == 'scoreboard-drops': pgstat.drops = int(value)
-        if key == 'scoreboard-returns': pgstat.returns = int(value)
-        if key == 'scoreboard-fckills': pgstat.carrier_frags = int(value)
-        if key == 'scoreboard-pickups': pgstat.pickups = int(value)
-        if key == 'scoreboard-caps': pgstat.captures = int(value)
-        if key == 'scoreboard-score': pgstat.score = int(value)
-        if key == 'scoreboard-deaths': pgstat.deaths = int(value)
-        if key == 'scoreboard-kills': pgstat.kills = int(value)
-        if key == 'scoreboard-suicides': pgstat.suicides = int(value)
+        pgstat['kills'] = 0
+        pgstat['captures'] = 0
+        pgstat['pickups'] = 0
+        pgstat['drops'] = 0
+        pgstat['returns'] = 0
+        pgstat['carrier_frags'] = 0
+
+    if record.nick is not None:
+        pgstat['nick'] = record.nick[:128]
+        pgstat['stripped_nick'] = strip_colors(qfont_decode(pgstat['nick']))
+    if record.team is not None:
+        pgstat['team'] = record.team
+    if record.rank is not None:
+        pgstat['rank'] = record.rank
+    if record.alivetime is not None:
+        pgstat['alivetime'] = datetime.timedelta(seconds=int(round(record.alivetime)))
+
+    for (field, value) in record.scoreboard.iteritems():
+        column = scoreboard_columns.get(field)
+        if column:
+            pgstat[column] = value
 
     # check to see if we had a name, and if
     # not use an anonymous handle
-    if pgstat.nick == None:
-        pgstat.nick = "Anonymous Player"
-        pgstat.stripped_nick = "Anonymous Player"
+    if pgstat.get('nick') == None:
+        pgstat['nick'] = "Anonymous Player"
+        pgstat['stripped_nick'] = "Anonymous Player"
 
     # otherwise process a nick change
-    elif pgstat.nick != player.nick and player.player_id > 2:
-        register_new_nick(session, player, pgstat.nick)
+    elif pgstat['nick'] != player.nick and player.player_id > 2:
+        register_new_nick(session, player, pgstat['nick'])
 
     # if the player is ranked #1 and it is a team game, set the game's winner
     # to be the team of that player
     # FIXME: this is a hack, should be using the 'W' field (not present)
-    if pgstat.rank == 1 and pgstat.team:
-        game.winner = pgstat.team
+    if pgstat.get('rank') == 1 and pgstat.get('team'):
+        game.winner = pgstat['team']
         session.add(game)
 
-    session.add(pgstat)
-
     return pgstat
 
 
+# player_weapon_stats columns in the order of a PlayerRecord's accuracy lists
+accuracy_columns = ('fired', 'max', 'hit', 'actual', 'frags')
+
+
 def create_player_weapon_stats(session=None, player=None, 
-        game=None, pgstat=None, player_events=None, game_meta=None):
+        game=None, pgstat=None, record=None, game_meta=None):
     """
-    Creates accuracy records for each weapon used by a given player in a
-    given game. Parameters:
+    Builds the accuracy rows for each weapon used by a given player in a
+    given game, as dictionaries of player_weapon_stats columns. The
+    player_game_stat_id is filled in by insert_player_stats. Parameters:
 
     session - SQLAlchemy session factory object
     player - Player record who owns the weapon stats
     game - Game record in which the stats were created
-    pgstat - Corresponding PlayerGameStat record for these weapon stats
-    player_events - dictionary containing the raw weapon values that need to be
+    pgstat - Corresponding player game stat row for these weapon stats
+    record - PlayerRecord containing the raw weapon values that need to be
         transformed
     game_meta - dictionary of game metadata (only used for stats version info)
     """
@@ -446,115 +728,253 @@ def create_player_weapon_stats(session=None, player=None,
     except:
         is_doubled = False
 
-    for (key,value) in player_events.items():
-        matched = re.search("acc-(.*?)-cnt-fired", key)
-        if matched:
-            weapon_cd = matched.group(1)
-            seq = Sequence('player_weapon_stats_player_weapon_stats_id_seq')
-            pwstat_id = session.execute(seq)
-            pwstat = PlayerWeaponStat()
-            pwstat.player_weapon_stats_id = pwstat_id
-            pwstat.player_id = player.player_id
-            pwstat.game_id = game.game_id
-            pwstat.player_game_stat_id = pgstat.player_game_stat_id
-            pwstat.weapon_cd = weapon_cd
-
-            if 'n' in player_events:
-                pwstat.nick = player_events['n']
-            else:
-                pwstat.nick = player_events['P']
-
-            if 'acc-' + weapon_cd + '-cnt-fired' in player_events:
-                pwstat.fired = int(round(float(
-                        player_events['acc-' + weapon_cd + '-cnt-fired'])))
-            if 'acc-' + weapon_cd + '-fired' in player_events:
-                pwstat.max = int(round(float(
-                        player_events['acc-' + weapon_cd + '-fired'])))
-            if 'acc-' + weapon_cd + '-cnt-hit' in player_events:
-                pwstat.hit = int(round(float(
-                        player_events['acc-' + weapon_cd + '-cnt-hit'])))
-            if 'acc-' + weapon_cd + '-hit' in player_events:
-                pwstat.actual = int(round(float(
-                        player_events['acc-' + weapon_cd + '-hit'])))
-            if 'acc-' + weapon_cd + '-frags' in player_events:
-                pwstat.frags = int(round(float(
-                        player_events['acc-' + weapon_cd + '-frags'])))
-
+    if record.nick is not None:
+        nick = record.nick
+    else:
+        nick = record.hashkey
+
+    for (weapon_cd, acc) in record.weapons.iteritems():
+        # only weapons that were fired get a record
+        if acc[FIRED] is None:
+            continue
+
+        pwstat = {}
+        pwstat['player_id'] = player.player_id
+        pwstat['game_id'] = game.game_id
+        pwstat['weapon_cd'] = weapon_cd
+        pwstat['nick'] = nick
+
+        # fields the player didn't send are stored as 0, as PlayerWeaponStat
+        # always did, since the pages divide by them
+        for (column, value) in zip(accuracy_columns, acc):
+            if value is None:
+                pwstat[column] = 0
+                continue
+
+            pwstat[column] = int(round(value))
             if is_doubled:
-                pwstat.fired = pwstat.fired/2
-                pwstat.max = pwstat.max/2
-                pwstat.hit = pwstat.hit/2
-                pwstat.actual = pwstat.actual/2
-                pwstat.frags = pwstat.frags/2
+                pwstat[column] = pwstat[column]/2
 
-            session.add(pwstat)
-            pwstats.append(pwstat)
+        pwstats.append(pwstat)
 
     return pwstats
 
 
-def parse_body(request):
+def insert_player_stats(session, pgstats, pwstats):
     """
-    Parses the POST request body for a stats submission
-    """
-    # storage vars for the request body
-    game_meta = {}
-    player_events = {}
-    current_team = None
-    players = []
-
-    for line in request.body.split('\n'):
-        try:
-            (key, value) = line.strip().split(' ', 1)
-
-            # Server (S) and Nick (n) fields can have international characters.
-            # We convert to UTF-8.
-            if key in 'S' 'n':
-                value = unicode(value, 'utf-8')
+    Writes the player game and weapon stat rows of a game. Ids for each table
+    come from one batched sequence allocation and the rows are written with
+    multi-VALUES inserts, so the round-trips don't grow with the number of
+    players and weapons.
 
-            if key in 'V' 'T' 'G' 'M' 'S' 'C' 'R' 'W' 'I':
-                game_meta[key] = value
+    pwstats is a list of (pgstat, pwstat) pairs tying each weapon row to the
+    player game stat row it belongs to.
+    """
+    for (pgstat, pgstat_id) in zip(pgstats, next_ids(session,
+            'player_game_stats_player_game_stat_id_seq', len(pgstats))):
+        pgstat['player_game_stat_id'] = pgstat_id
 
-            if key == 'P':
-                # if we were working on a player record already, append
-                # it and work on a new one (only set team info)
-                if len(player_events) != 0:
-                    players.append(player_events)
-                    player_events = {}
+    for ((pgstat, pwstat), pwstat_id) in zip(pwstats, next_ids(session,
+            'player_weapon_stats_player_weapon_stats_id_seq', len(pwstats))):
+        pwstat['player_weapon_stats_id'] = pwstat_id
+        pwstat['player_game_stat_id'] = pgstat['player_game_stat_id']
 
-                player_events[key] = value
+    # the game, new players and nicks have to exist before the stats do
+    session.flush()
 
-            if key == 'e':
-                (subkey, subvalue) = value.split(' ', 1)
-                player_events[subkey] = subvalue
-            if key == 'n':
-                player_events[key] = value
-            if key == 't':
-                player_events[key] = value
-        except:
-            # no key/value pair - move on to the next line
-            pass
+    bulk_insert(session, PlayerGameStat, pgstats)
+    bulk_insert(session, PlayerWeaponStat, [pwstat for (pgstat, pwstat) in pwstats])
 
-    # add the last player we were working on
-    if len(player_events) > 0:
-        players.append(player_events)
 
-    return (game_meta, players)
+def parse_body(body):
+    """
+    Parses the POST request body for a stats submission. Returns the game
+    metadata and a list of PlayerRecord (see xonstat.submission_parser).
+    """
+    return parse_submission(body.split('\n'))
 
 
 def create_player_stats(session=None, player=None, game=None, 
-        player_events=None, game_meta=None):
+        record=None, game_meta=None):
     """
-    Creates player game and weapon stats according to what type of player
+    Builds player game and weapon stat rows according to what type of player.
+    Returns the player game stat row and its list of weapon stat rows.
     """
     pgstat = create_player_game_stat(session=session, 
-        player=player, game=game, player_events=player_events)
+        player=player, game=game, record=record)
 
     #TODO: put this into a config setting in the ini file?
-    if not re.search('^bot#\d+$', player_events['P']):
-        create_player_weapon_stats(session=session, 
+    if not re.search('^bot#\d+$', record.hashkey):
+        pwstats = create_player_weapon_stats(session=session, 
             player=player, game=game, pgstat=pgstat,
-            player_events=player_events, game_meta=game_meta)
+            record=record, game_meta=game_meta)
+    else:
+        pwstats = []
+
+    return (pgstat, pwstats)
+
+
+def check_preconditions(settings, game_meta, players):
+    """
+    Runs the sanity checks that don't need a database connection, raising
+    the HTTP exception to answer with if the submission should not be
+    stored. Also normalizes the game metadata (the fake "duel" gametype and
+    the revision).
+    """
+    if not has_required_metadata(game_meta):
+        log.debug("ERROR: Required game meta missing")
+        raise pyramid.httpexceptions.HTTPUnprocessableEntity("Missing game meta")
+
+    if not is_supported_gametype(game_meta['G']):
+        log.debug("ERROR: Unsupported gametype")
+        raise pyramid.httpexceptions.HTTPOk("OK")
+
+    if not has_minimum_real_players(settings, players):
+        log.debug("ERROR: Not enough real players")
+        raise pyramid.httpexceptions.HTTPOk("OK")
+
+    if is_blank_game(players):
+        log.debug("ERROR: Blank game")
+        raise pyramid.httpexceptions.HTTPOk("OK")
+
+    # the "duel" gametype is fake
+    if num_real_players(players, count_bots=True) == 2 and \
+            game_meta['G'] == 'dm':
+        game_meta['G'] = 'duel'
+
+    # fix for DTG, who didn't #ifdef WATERMARK to set the revision info
+    if 'R' not in game_meta:
+        game_meta['R'] = "unknown"
+
+
+def store_submission(session=None, idfp=None, ip_addr=None, game_meta=None,
+        players=None):
+    """
+    Stores a verified submission that passed check_preconditions. The caller
+    commits the session. Parameters:
+
+    session - SQLAlchemy database session factory
+    idfp - the server's hashkey, from the request signature
+    ip_addr - the server's IP address
+    game_meta - dictionary of game metadata
+    players - list of PlayerRecord
+    """
+    reset_saved_queries()
+
+    server = get_or_create_server(session=session, hashkey=idfp, 
+            name=game_meta['S'], revision=game_meta['R'],
+            ip_addr=ip_addr)
+
+    gmap = get_or_create_map(session=session, name=game_meta['M'])
+
+    # FIXME: use the gmtime instead of utcnow() when the timezone bug is
+    # fixed
+    game = create_game(session=session, 
+            start_dt=datetime.datetime.utcnow(),
+            #start_dt=datetime.datetime(
+                #*time.gmtime(float(game_meta['T']))[:6]), 
+            server_id=server.server_id, game_type_cd=game_meta['G'], 
+               map_id=gmap.map_id, match_id=game_meta['I'])
+
+    # find or create a record for each player
+    # and add stats for each if they were present at the end
+    # of the game
+    records = [record for record in players
+            if record.matches and record.scoreboardvalid]
+    db_players = get_or_create_players(session=session, records=records)
+
+    pgstats = []
+    pwstats = []
+    for record in records:
+        player = db_players[record.hashkey]
+        log.debug('Creating stats for %s' % record.hashkey)
+        (pgstat, player_pwstats) = create_player_stats(session=session,
+                player=player, game=game, record=record,
+                game_meta=game_meta)
+        pgstats.append(pgstat)
+        pwstats.extend([(pgstat, pwstat) for pwstat in player_pwstats])
+
+    # update elos, which also sets the elo_delta of the stats rows
+    try:
+        process_elos(game, session, pgstats=pgstats)
+    except Exception as e:
+        log.debug('Error (non-fatal): elo processing failed.')
+
+    insert_player_stats(session, pgstats, pwstats)
+
+    # add the game to the daily leaderboard rollups. They can be rebuilt
+    # (xonstat/batch/backfill_rollups.py), so failing here isn't fatal.
+    try:
+        update_rollups(session, datetime.datetime.utcnow().date(),
+                server.server_id, gmap.map_id, pgstats)
+    except Exception as e:
+        log.warning("Error (non-fatal): updating the rollups for game "
+                "{0} failed: {1}".format(game.game_id, e))
+
+    # and to the players' career totals, which can be rebuilt the same way
+    # (xonstat/batch/rebuild_player_tables.py)
+    try:
+        update_career_stats(session, game, pgstats)
+    except Exception as e:
+        log.warning("Error (non-fatal): updating the career stats for game "
+                "{0} failed: {1}".format(game.game_id, e))
+
+    # and to the weapon series behind the accuracy and damage graphs
+    # (xonstat/batch/rebuild_player_tables.py)
+    try:
+        update_weapon_series(session, [pwstat for (pgstat, pwstat) in pwstats])
+    except Exception as e:
+        log.warning("Error (non-fatal): updating the weapon series for game "
+                "{0} failed: {1}".format(game.game_id, e))
+
+    log.debug("Identity caches saved {0} queries for game {1}".format(
+        saved_queries(), game.game_id))
+
+    return game
+
+
+def update_ranks(session, game_id, game_type_cd):
+    """
+    Updates the ranks of the players whose Elo changed in a stored game, in
+    a transaction of its own. Failing to do so is not fatal, the next
+    rebuild (xonstat/batch/rebuild_ranks.py) will set things straight.
+    """
+    try:
+        update_game_ranks(session, game_id, game_type_cd)
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        log.warning("Error (non-fatal): updating the ranks for game "
+                "{0} failed: {1}".format(game_id, e))
+
+
+def configure_submission_spool(settings):
+    """
+    Sets up the spool used when xonstat.async_submissions is enabled.
+    """
+    global submission_spool
+
+    if asbool(settings.get('xonstat.async_submissions', False)):
+        submission_spool = spool_from_settings(settings)
+        log.info("Spooling submissions to {0}".format(submission_spool.path))
+    else:
+        submission_spool = None
+
+
+def configure_weapon_codes():
+    """
+    Loads the weapon codes from cd_weapon, so the parser only accepts
+    accuracy events for weapons we know about.
+    """
+    session = DBSession()
+    try:
+        weapon_cds = [weapon_cd for (weapon_cd,) in
+                session.query(Weapon.weapon_cd).all()]
+    finally:
+        DBSession.remove()
+
+    set_known_weapons(weapon_cds)
+    log.info("Loaded {0} weapon codes".format(len(weapon_cds)))
 
 
 def stats_submit(request):
@@ -573,82 +993,35 @@ def stats_submit(request):
             log.debug("ERROR: Unverified request")
             raise pyramid.httpexceptions.HTTPUnauthorized("Unverified request")
 
-        (game_meta, players) = parse_body(request)
-
-        if not has_required_metadata(game_meta):
-            log.debug("ERROR: Required game meta missing")
-            raise pyramid.httpexceptions.HTTPUnprocessableEntity("Missing game meta")
-
-        if not is_supported_gametype(game_meta['G']):
-            log.debug("ERROR: Unsupported gametype")
-            raise pyramid.httpexceptions.HTTPOk("OK")
+        (game_meta, players) = parse_body(request.body)
 
-        if not has_minimum_real_players(request.registry.settings, players):
-            log.debug("ERROR: Not enough real players")
-            raise pyramid.httpexceptions.HTTPOk("OK")
-
-        if is_blank_game(players):
-            log.debug("ERROR: Blank game")
-            raise pyramid.httpexceptions.HTTPOk("OK")
-
-        # the "duel" gametype is fake
-        if num_real_players(players, count_bots=True) == 2 and \
-                game_meta['G'] == 'dm':
-            game_meta['G'] = 'duel'
-
-
-        # fix for DTG, who didn't #ifdef WATERMARK to set the revision info
-        try:
-            revision = game_meta['R']
-        except:
-            revision = "unknown"
+        check_preconditions(request.registry.settings, game_meta, players)
 
         #----------------------------------------------------------------------
         # This ends the "precondition" section of sanity checks. All
         # functions not requiring a database connection go ABOVE HERE.
         #----------------------------------------------------------------------
+
+        # in asynchronous mode the submission worker stores the game later
+        if submission_spool is not None:
+            submission_spool.enqueue(server_name=game_meta['S'],
+                    match_id=game_meta['I'], idfp=idfp,
+                    ip_addr=get_remote_addr(request), body=request.body)
+            log.debug('Spooled submission for later processing.')
+            return Response('202 Accepted', status='202 Accepted')
+
         session = DBSession()
 
-        server = get_or_create_server(session=session, hashkey=idfp, 
-                name=game_meta['S'], revision=revision,
-                ip_addr=get_remote_addr(request))
-
-        gmap = get_or_create_map(session=session, name=game_meta['M'])
-
-        # FIXME: use the gmtime instead of utcnow() when the timezone bug is
-        # fixed
-        game = create_game(session=session, 
-                start_dt=datetime.datetime.utcnow(),
-                #start_dt=datetime.datetime(
-                    #*time.gmtime(float(game_meta['T']))[:6]), 
-                server_id=server.server_id, game_type_cd=game_meta['G'], 
-                   map_id=gmap.map_id, match_id=game_meta['I'])
-
-        # find or create a record for each player
-        # and add stats for each if they were present at the end
-        # of the game
-        for player_events in players:
-            if 'n' in player_events:
-                nick = player_events['n']
-            else:
-                nick = None
-
-            if 'matches' in player_events and 'scoreboardvalid' \
-                in player_events:
-                player = get_or_create_player(session=session, 
-                    hashkey=player_events['P'], nick=nick)
-                log.debug('Creating stats for %s' % player_events['P'])
-                create_player_stats(session=session, player=player, game=game, 
-                        player_events=player_events, game_meta=game_meta)
-
-        # update elos
-        try:
-            process_elos(game, session)
-        except Exception as e:
-            log.debug('Error (non-fatal): elo processing failed.')
+        game = store_submission(session=session, idfp=idfp,
+                ip_addr=get_remote_addr(request), game_meta=game_meta,
+                players=players)
+        (game_id, game_type_cd) = (game.game_id, game.game_type_cd)
 
         session.commit()
         log.debug('Success! Stats recorded.')
+
+        update_ranks(session, game_id, game_type_cd)
+
         return Response('200 OK')
     except Exception as e:
         if session:
@@ -0,0 +1,189 @@
+import logging
+import sqlalchemy.sql.functions as func
+from collections import namedtuple
+from sqlalchemy import BigInteger, Integer, String
+from xonstat.models import *
+from xonstat.player_tables import add_game, rebuild_players
+from xonstat.rollups import max_untracked_player_id
+
+log = logging.getLogger(__name__)
+
+# player_weapon_series backs the accuracy and damage graphs of the player
+# pages: per player and weapon, the career sums of fired, hit and actual
+# damage and those values for the last series_length games, so a graph is
+# one row instead of an aggregate over player_weapon_stats.
+#
+# store_submission adds each game to it in the transaction that stores it
+# (update_weapon_series), like player_career_stats, and
+# xonstat/batch/rebuild_player_tables.py fills it in for the rest, see
+# xonstat.player_tables.
+
+# games kept per player and weapon, the most the graphs show
+series_length = 50
+
+WeaponSeries = namedtuple('WeaponSeries', ['fired', 'hit', 'actual',
+    'games'])
+
+
+def series_rows(pwstats):
+    """
+    The player_weapon_stats rows of a game as (player_id, weapon_cd,
+    game_id, fired, hit, actual), one per player and weapon, leaving out
+    the anonymous players. Values the player didn't send count as 0.
+    """
+    rows = {}
+    for pwstat in pwstats:
+        if pwstat['player_id'] <= max_untracked_player_id:
+            continue
+
+        key = (pwstat['player_id'], pwstat['weapon_cd'])
+        values = (pwstat.get('fired') or 0, pwstat.get('hit') or 0,
+                pwstat.get('actual') or 0)
+        if key in rows:
+            values = tuple(a + b for (a, b) in zip(rows[key][1:], values))
+        rows[key] = (pwstat['game_id'],) + values
+
+    return [key + values for (key, values) in rows.items()]
+
+
+# the player_weapon_series rows of some players as computed from the raw
+# table, the arrays in game_id order. NULL values count as 0, the series
+# columns are NOT NULL.
+_raw_weapon_series = \
+    "SELECT t.player_id, t.weapon_cd, t.games, t.fired, t.hit, t.actual, " \
+        "l.game_ids, l.fireds, l.hits, l.actuals " \
+    "FROM (SELECT player_id, weapon_cd, count(*) AS games, " \
+            "coalesce(sum(fired), 0) AS fired, " \
+            "coalesce(sum(hit), 0) AS hit, " \
+            "coalesce(sum(actual), 0) AS actual " \
+        "FROM player_weapon_stats " \
+        "WHERE player_id = ANY(:player_ids) " \
+        "GROUP BY player_id, weapon_cd) AS t " \
+    "JOIN (SELECT player_id, weapon_cd, " \
+            "array_agg(game_id ORDER BY game_id) AS game_ids, " \
+            "array_agg(coalesce(fired, 0) ORDER BY game_id) AS fireds, " \
+            "array_agg(coalesce(hit, 0) ORDER BY game_id) AS hits, " \
+            "array_agg(coalesce(actual, 0) ORDER BY game_id) AS actuals " \
+        "FROM (SELECT player_id, weapon_cd, game_id, fired, hit, actual, " \
+                "row_number() OVER (PARTITION BY player_id, weapon_cd " \
+                    "ORDER BY game_id DESC) AS n " \
+            "FROM player_weapon_stats " \
+            "WHERE player_id = ANY(:player_ids)) AS r " \
+        "WHERE n <= :series_length " \
+        "GROUP BY player_id, weapon_cd) AS l " \
+    "ON l.player_id = t.player_id AND l.weapon_cd = t.weapon_cd"
+
+
+def rebuild_weapon_series(session, player_ids):
+    """
+    Rebuilds the player_weapon_series rows of a list of players from
+    player_weapon_stats, see rebuild_players. The caller commits. Returns
+    the number of rows written and the players skipped.
+    """
+    return rebuild_players(session, 'player_weapon_series',
+        "INSERT INTO player_weapon_series (player_id, weapon_cd, games, "
+            "fired, hit, actual, game_ids, fireds, hits, actuals) " +
+        _raw_weapon_series, player_ids, {'series_length':series_length})
+
+
+# appends the VALUES rows v to the series, dropping the oldest games past
+# :series_length. Slices reaching before the start of an array are cut to it.
+# NULL values count as 0.
+_append_weapon_series = \
+    "UPDATE player_weapon_series AS s " \
+    "SET games = s.games + 1, " \
+        "fired = s.fired + coalesce(v.fired, 0), " \
+        "hit = s.hit + coalesce(v.hit, 0), " \
+        "actual = s.actual + coalesce(v.actual, 0), " \
+        "game_ids = (s.game_ids || v.game_id)[{window}], " \
+        "fireds = (s.fireds || coalesce(v.fired, 0))[{window}], " \
+        "hits = (s.hits || coalesce(v.hit, 0))[{window}], " \
+        "actuals = (s.actuals || coalesce(v.actual, 0))[{window}] " \
+    "FROM ({values}) AS v({columns}) " \
+    "WHERE s.player_id = v.player_id AND s.weapon_cd = v.weapon_cd"
+
+# the last :series_length elements of the arrays with one game appended
+_window = "array_length(s.game_ids, 1) + 2 - :series_length : " \
+        "array_length(s.game_ids, 1) + 1"
+
+_insert_weapon_series = \
+    "INSERT INTO player_weapon_series (player_id, weapon_cd, games, " \
+        "fired, hit, actual, game_ids, fireds, hits, actuals) " \
+    "SELECT v.player_id, v.weapon_cd, 1, coalesce(v.fired, 0), " \
+        "coalesce(v.hit, 0), coalesce(v.actual, 0), ARRAY[v.game_id], " \
+        "ARRAY[coalesce(v.fired, 0)], ARRAY[coalesce(v.hit, 0)], " \
+        "ARRAY[coalesce(v.actual, 0)] " \
+    "FROM ({values}) AS v({columns}) " \
+    "WHERE NOT EXISTS (SELECT 1 FROM player_weapon_series AS s " \
+        "WHERE s.player_id = v.player_id AND s.weapon_cd = v.weapon_cd)"
+
+_series_columns = 'player_id, weapon_cd, game_id, fired, hit, actual'
+
+_series_types = (Integer, String, BigInteger, Integer, Integer, Integer)
+
+
+def update_weapon_series(session, pwstats):
+    """
+    Adds a stored game's player_weapon_stats rows to player_weapon_series,
+    see add_game. The rows have to be written already. The caller commits.
+    """
+    rows = series_rows(pwstats)
+    if len(rows) == 0:
+        return
+
+    add_game(session, 'player_weapon_series', 'player_weapon_stats',
+            rows[0][2], rows, _series_types,
+            (_append_weapon_series, _insert_weapon_series),
+            {'series_length':series_length}, columns=_series_columns,
+            window=_window)
+
+
+def weapon_series(session, player_id, weapon_cd, games):
+    """
+    A player's career sums with a weapon and its values in their last games
+    (up to series_length), as a WeaponSeries of fired, hit, actual and
+    games, a list of (game_id, fired, hit, actual) oldest first. Falls back
+    to player_weapon_stats for players player_weapon_series doesn't have
+    yet. Returns None when the player never used the weapon.
+    """
+    games = min(games, series_length)
+
+    series = session.query(PlayerWeaponSeries).\
+            filter(PlayerWeaponSeries.player_id == player_id).\
+            filter(PlayerWeaponSeries.weapon_cd == weapon_cd).\
+            first()
+
+    if series is not None:
+        recent = zip(series.game_ids, series.fireds, series.hits,
+                series.actuals)
+        if games > 0:
+            recent = recent[-games:]
+        else:
+            recent = []
+        return WeaponSeries(series.fired, series.hit, series.actual, recent)
+
+    known = session.query(PlayerWeaponSeries.player_id).\
+            filter(PlayerWeaponSeries.player_id == player_id).\
+            first()
+    if known is not None:
+        return None
+
+    (fired, hit, actual) = session.query(func.sum(PlayerWeaponStat.fired),
+            func.sum(PlayerWeaponStat.hit),
+            func.sum(PlayerWeaponStat.actual)).\
+            filter(PlayerWeaponStat.player_id == player_id).\
+            filter(PlayerWeaponStat.weapon_cd == weapon_cd).\
+            one()
+    if fired is None:
+        return None
+
+    recent = session.query(PlayerWeaponStat.game_id, PlayerWeaponStat.fired,
+            PlayerWeaponStat.hit, PlayerWeaponStat.actual).\
+            filter(PlayerWeaponStat.player_id == player_id).\
+            filter(PlayerWeaponStat.weapon_cd == weapon_cd).\
+            order_by(PlayerWeaponStat.game_id.desc()).\
+            limit(games).\
+            all()
+    recent.reverse()
+
+    return WeaponSeries(fired, hit, actual, [tuple(row) for row in recent])